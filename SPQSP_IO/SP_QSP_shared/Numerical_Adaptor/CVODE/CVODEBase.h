@@ -6,16 +6,27 @@
 #include <boost/serialization/assume_abstract.hpp>
 #include <boost/serialization/utility.hpp> /* std::pair */
 
+#ifdef QSP_USE_CVODES
+#include <cvodes/cvodes.h>             /* CVODES: CVODE with sensitivity analysis */
+#else
 #include <cvode/cvode.h>               /* prototypes for CVODE fcts., consts.  */
+#endif
 #include <nvector/nvector_serial.h>    /* access to serial N_Vector            */
 #include <sunmatrix/sunmatrix_dense.h> /* access to dense SUNMatrix            */
 #include <sunlinsol/sunlinsol_dense.h> /* access to dense SUNLinearSolver      */
+#include <sundials/sundials_dense.h>   /* dense LU of diagonal blocks          */
+#include <sunmatrix/sunmatrix_sparse.h> /* access to sparse SUNMatrix          */
+#ifdef QSP_USE_KLU
+#include <sunlinsol/sunlinsol_klu.h>   /* access to KLU sparse direct solver   */
+#endif
 #include <sundials/sundials_types.h>   /* defs. of realtype, sunindextype      */
 
 
 
 #include <cmath>
+#include <cstdint>
 #include <iostream>
+#include <string>
 #include <vector>
 
 typedef std::vector< double > state_type;
@@ -29,6 +40,9 @@ protected:
 		TRIGGER_EQ,
 		TRIGGER_NEQ
 	};
+	//! forward sensitivity rhs, same signature as CVSensRhsFn of CVODES
+	typedef int(*SensRhsFn)(int Ns, realtype t, N_Vector y, N_Vector ydot, N_Vector *yS,
+		N_Vector *ySdot, void *user_data, N_Vector tmp1, N_Vector tmp2);
 
 public:
 	CVODEBase(); 
@@ -37,12 +51,30 @@ public:
 
 	//! simulate ODE model
 	void simOdeStep(double tStart, double tStep);
+	//! reset variables, events and statistics as after construction, keeping the solver memory
+	void resetSimulation(void);
 
 	//! examples of optional output
 	void PrintFinalStats(void *cvode_mem);
+	//! solver statistics accumulated over all simulation steps
+	const std::vector<long int>& getSolverStats(void) const { return _solver_stats; };
+	//! names of accumulated solver statistics
+	static std::string getSolverStatsHeader(void);
+	//! print accumulated solver statistics
+	void PrintSolverStats(std::ostream& os) const;
 
 	//! ODE state to stream
 	friend std::ostream & operator<<(std::ostream &os, const CVODEBase & ode) ;
+	//! write state to output every n-th output time
+	virtual int getOutputStride(void) const { return 1; };
+	//! number of output columns (operator<<)
+	int getNumOutput(void) const { return get_output_size(); };
+	//! output columns (operator<<) to array of getNumOutput() values
+	void getOutput(double* out) const;
+	//! write _species_var and _nonspecies_var, tagged with key, to binary stream
+	bool writeState(std::ostream& os, uint64_t key) const;
+	//! read state written with the same key; _nonspecies_var only if nonspecies is true
+	bool readState(std::istream& is, uint64_t key, bool nonspecies = true);
 
 	//! species varaible value with original units
 	double getSpeciesVar(unsigned int idx, bool raw = true)const;
@@ -52,6 +84,14 @@ public:
 	double getParameterVal(unsigned int idx, bool raw = true)const;
 	//! set non species varaible value with original units
 	void setParameterVal(unsigned int idx, double val, bool raw = true);
+	//! number of species variables (lhs of ODEs)
+	int getNumSpeciesVar(void) const { return _neq; };
+	//! number of root functions in g()
+	int getNumRoots(void) const { return _nroot; };
+	//! number of parameters with forward sensitivity
+	int getNumSensitivityParam(void) const { return _ns; };
+	//! sensitivity of species varaible idx to sensitivity parameter k, with original units
+	double getSensitivity(unsigned int idx, unsigned int k, bool raw = true)const;
 
 	unsigned int get_num_variables(void)const { return _species_var.size(); };
 
@@ -79,10 +119,18 @@ protected:
 	virtual void update_y_other(void) = 0;
 	//! evaluate one trigger component 
     virtual bool triggerComponentEvaluate(int i, realtype t, bool curr) = 0;
+	//! evaluate all trigger components; satisfied: current conditions, replaced by the results
+	virtual void triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied);
+	//! time when a time-only trigger component changes, direction 1: to true; -1: to false
+	virtual realtype triggerComponentTime(int i, int& direction) {return 0;};
 	//! update trigger conditions when root found
 	void updateTriggerComponentConditionsOnRoot(int* rootsFound);
 	//! update trigger conditions at time t, without root 
 	void updateTriggerComponentConditionsOnValue(realtype t);
+	//! update time-only trigger conditions when their time is reached
+	void updateTriggerComponentConditionsOnTime(realtype t);
+	//! sort times of time-only trigger conditions
+	void updateTriggerTimes(void);
 	//! evaluate event triggers
 	bool evaluateAllEvents(realtype t);
 	//! resolve event assignments recursively
@@ -103,6 +151,9 @@ protected:
 	virtual bool eventEvaluate(int i) = 0;
 	//! execute one event
 	virtual bool eventExecution(int i, bool delay, realtype& dt) = 0;
+	//! if the solver is reinitialized after event i: it changes y, rhs or root functions.
+	//! false: the solver keeps its step size and order
+	virtual bool eventNeedsReinit(int i) const {return true;};
 	//! get variable value with original unit
 	double getVarOriginalUnit(int i) const;
 	//! get unit conversion scalor
@@ -111,6 +162,24 @@ protected:
 	virtual realtype get_unit_conversion_nspvar(int i) const = 0;
 	//! check if a variable is allowed to become negative
 	virtual bool allow_negative(int i) const {return true;};
+	//! analytic Jacobian of rhs. NULL: solver uses difference quotient
+	virtual CVLsJacFn getJacobianFn(void) const {return NULL;};
+	//! nonzeros of sparse Jacobian. 0: dense Jacobian
+	virtual sunindextype getJacobianNNZ(void) const {return 0;};
+	//! first row of each diagonal block of a block lower triangular Jacobian. empty: not block triangular
+	virtual std::vector<sunindextype> getJacobianBlocks(void) const {return std::vector<sunindextype>();};
+	//! forward sensitivity rhs. NULL: no sensitivity analysis
+	virtual SensRhsFn getSensitivityRhsFn(void) const {return NULL;};
+	//! number of sensitivity parameters
+	virtual int getNumSensitivities(void) const {return 0;};
+	//! value of sensitivity parameter k, used to scale sensitivity tolerances
+	virtual realtype getSensitivityParam(int k) const {return 1;};
+	//! unit conversion scalor of sensitivity parameter k
+	virtual realtype get_unit_conversion_sensitivity(int k) const {return 1;};
+	//! position of output column i among y and other species (getVarOriginalUnit)
+	virtual int get_output_index(int i) const {return i;};
+	//! number of output columns
+	virtual int get_output_size(void) const {return _neq + _species_other.size();};
 
 
 	//! some functions defined by SBML interpretor
@@ -134,11 +203,15 @@ protected:
 	N_Vector _y;
 	//! number of rootfinding functions
 	int _nroot;
+	//! number of time-only trigger components, indexed after rootfinding ones
+	int _ntimed;
 	//! number of events
 	int _nevent;
 
 	//! delayed events sorted vector
 	std::vector<std::pair <realtype, int> > _delayEvents;
+	//! time-only trigger components sorted by time. Serialization not needed.
+	std::vector<std::pair <realtype, int> > _triggerTimes;
 
 	//! SUNMatrix for linear solver 
 	SUNMatrix _A;
@@ -146,6 +219,18 @@ protected:
 	SUNLinearSolver _LS;
 	//! solver memory block
 	void * _cvode_mem;
+	//! number of sensitivity parameters
+	int _ns;
+	//! forward sensitivities dy/dp, one vector per parameter. Serialization not needed.
+	N_Vector * _yS;
+
+	//! solver statistics summed over all CVode calls. Serialization not needed.
+	std::vector<long int> _solver_stats;
+	//! solver statistics since the last CVodeReInit, included in _solver_stats. Serialization not needed.
+	std::vector<long int> _solver_stats_reinit;
+	//! y, rhs or root functions changed by events or externally, or solver history ends beyond the current time:
+	//! CVodeReInit needed before the next CVode call. Serialization not needed.
+	bool _solver_reinit;
 
 	//! event only triggered when g(y, t) = 0. Serialization not needed. 
 	std::vector<EVENT_TRIGGER_ELEM_TYPE>  _trigger_element_type;
@@ -162,8 +247,12 @@ private:
 	void serialize(Archive & ar, const unsigned int /*version*/);
 
 	bool freeMem();
+	//! add statistics of the last CVode call to _solver_stats
+	void accumulateSolverStats();
 	//! get next t for potential discontinuity.
 	bool getNexTimeDisc(realtype& t);
+	//! get next t after tNow when a time-only trigger component changes.
+	bool getNextTriggerTime(realtype tNow, realtype& t);
 
 
 
@@ -172,14 +261,22 @@ private:
 BOOST_SERIALIZATION_ASSUME_ABSTRACT(CVODEBase)
 
 inline std::ostream & operator<<(std::ostream &os, const CVODEBase & ode){
-	int nrSpecies = ode._neq + ode._species_other.size();
-	for (auto i = 0; i < nrSpecies; i++)
+	int nrOutput = ode.get_output_size();
+	for (auto i = 0; i < nrOutput; i++)
 	{
-		os << "," << ode.getVarOriginalUnit(i);
+		os << "," << ode.getVarOriginalUnit(ode.get_output_index(i));
 	}
 	return os;
 }
 
+inline void CVODEBase::getOutput(double* out) const {
+	int nrOutput = get_output_size();
+	for (auto i = 0; i < nrOutput; i++)
+	{
+		out[i] = getVarOriginalUnit(get_output_index(i));
+	}
+}
+
 inline bool CVODEBase::getSatisfied(int i) {
 	return _trigger_element_satisfied[i];
 }
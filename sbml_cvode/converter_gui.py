@@ -230,6 +230,10 @@ class converter_gui:
         self.hybrid_config = None
         self.hybrid_items = set()
         self.hybrid_abm_weight = tk.DoubleVar()
+        self.sens_config = None
+        self.sens_params = set()
+        self.output_config = None
+        self.output_species = set()
         master.protocol("WM_DELETE_WINDOW", self.exit_all)
         master.mainloop()
         
@@ -442,6 +446,120 @@ class converter_gui:
         self.check_hybrid_model = tk.Checkbutton(frame, text='Configure as hybrid model', background = BG_COLOR, 
                                                  variable = self.use_hybrid_model, anchor='w',justify = 'l')
         self.check_hybrid_model.grid(row=r, column=1, sticky='ew')
+        # analytic jacobian
+        r += 1
+        self.use_jacobian = tk.BooleanVar()
+        self.check_jacobian = tk.Checkbutton(frame, text='Analytic Jacobian', background = BG_COLOR,
+                                             variable = self.use_jacobian, anchor='w',justify = 'l')
+        self.check_jacobian.grid(row=r, column=1, sticky='ew')
+        r += 1
+        self.use_sparse_jacobian = tk.BooleanVar()
+        self.check_sparse_jacobian = tk.Checkbutton(frame, text='Sparse Jacobian (KLU)', background = BG_COLOR,
+                                                    variable = self.use_sparse_jacobian, anchor='w',justify = 'l')
+        self.check_sparse_jacobian.grid(row=r, column=1, sticky='ew')
+        # common subexpression elimination
+        r += 1
+        self.use_cse = tk.BooleanVar()
+        self.check_cse = tk.Checkbutton(frame, text='Eliminate common subexpressions', background = BG_COLOR,
+                                        variable = self.use_cse, anchor='w',justify = 'l')
+        self.check_cse.grid(row=r, column=1, sticky='ew')
+        # constant folding and strength reduction
+        r += 1
+        self.use_simplify = tk.BooleanVar()
+        self.check_simplify = tk.Checkbutton(frame, text='Simplify math (fold constants, powers, roots)', background = BG_COLOR,
+                                             variable = self.use_simplify, anchor='w',justify = 'l')
+        self.check_simplify.grid(row=r, column=1, sticky='ew')
+        # forward sensitivity
+        r += 1
+        self.set_sensitivity_button = tk.Button(frame, text="Sensitivity", 
+                                                background = BG_COLOR, highlightbackground = BG_COLOR,
+                                                command=self.set_sensitivity)
+        self.set_sensitivity_button.grid(row=r, column=0, sticky='ew')
+        self.use_sensitivity = tk.BooleanVar()
+        self.check_sensitivity = tk.Checkbutton(frame, text='Forward sensitivities (CVODES)', background = BG_COLOR,
+                                                variable = self.use_sensitivity, anchor='w',justify = 'l')
+        self.check_sensitivity.grid(row=r, column=1, sticky='ew')
+        # ensemble class
+        r += 1
+        self.use_ensemble = tk.BooleanVar()
+        self.check_ensemble = tk.Checkbutton(frame, text='Ensemble class (one solver, N patients)', background = BG_COLOR,
+                                             variable = self.use_ensemble, anchor='w',justify = 'l')
+        self.check_ensemble.grid(row=r, column=1, sticky='ew')
+        # conserved moieties
+        r += 1
+        self.use_moiety_reduction = tk.BooleanVar()
+        self.check_moiety_reduction = tk.Checkbutton(frame, text='Conservation law (moiety) reduction', background = BG_COLOR,
+                                                     variable = self.use_moiety_reduction, anchor='w',justify = 'l')
+        self.check_moiety_reduction.grid(row=r, column=1, sticky='ew')
+        # block triangular order of species
+        r += 1
+        self.use_block_order = tk.BooleanVar()
+        self.check_block_order = tk.Checkbutton(frame, text='Block triangular species order', background = BG_COLOR,
+                                                variable = self.use_block_order, anchor='w',justify = 'l')
+        self.check_block_order.grid(row=r, column=1, sticky='ew')
+        # table-driven rhs
+        r += 1
+        self.rhs_table_threshold = tk.IntVar()
+        self.rhs_table_threshold.set(20000)
+        self.rhs_table_threshold_button = tk.Label(frame, text="Table rhs from", background = BG_COLOR)
+        self.rhs_table_threshold_button.grid(row=r, column=0, sticky='ew')
+        self.rhs_table_threshold_entry = tk.Entry(frame, textvariable = self.rhs_table_threshold,
+                                                  highlightbackground = BG_COLOR)
+        self.rhs_table_threshold_entry.grid(row=r, column=1, sticky='ewsn')
+        # output selection
+        r += 1
+        self.set_output_button = tk.Button(frame, text="Output", 
+                                           background = BG_COLOR, highlightbackground = BG_COLOR,
+                                           command=self.set_output_species)
+        self.set_output_button.grid(row=r, column=0, sticky='ew')
+        self.use_output_selection = tk.BooleanVar()
+        self.check_output_selection = tk.Checkbutton(frame, text='Output selected species only', background = BG_COLOR,
+                                                     variable = self.use_output_selection, anchor='w',justify = 'l')
+        self.check_output_selection.grid(row=r, column=1, sticky='ew')
+        # output stride
+        r += 1
+        self.output_stride = tk.IntVar()
+        self.output_stride.set(1)
+        self.output_stride_button = tk.Label(frame, text="Output stride", background = BG_COLOR)
+        self.output_stride_button.grid(row=r, column=0, sticky='ew')
+        self.output_stride_entry = tk.Entry(frame, textvariable = self.output_stride, highlightbackground = BG_COLOR)
+        self.output_stride_entry.grid(row=r, column=1, sticky='ewsn')
+        # benchmark driver
+        r += 1
+        self.use_benchmark = tk.BooleanVar()
+        self.check_benchmark = tk.Checkbutton(frame, text='Export benchmark driver', background = BG_COLOR,
+                                              variable = self.use_benchmark, anchor='w',justify = 'l')
+        self.check_benchmark.grid(row=r, column=1, sticky='ew')
+        # profiling counters
+        r += 1
+        self.use_profiling = tk.BooleanVar()
+        self.check_profiling = tk.Checkbutton(frame, text='Profiling counters (-DQSP_PROFILE)', background = BG_COLOR,
+                                              variable = self.use_profiling, anchor='w',justify = 'l')
+        self.check_profiling.grid(row=r, column=1, sticky='ew')
+        # vectorized rhs in python
+        r += 1
+        self.use_numpy = tk.BooleanVar()
+        self.check_numpy = tk.Checkbutton(frame, text='Export NumPy rhs (<class>_np.py)', background = BG_COLOR,
+                                          variable = self.use_numpy, anchor='w',justify = 'l')
+        self.check_numpy.grid(row=r, column=1, sticky='ew')
+        # C interface and shared library build script
+        r += 1
+        self.use_shared_library = tk.BooleanVar()
+        self.check_shared_library = tk.Checkbutton(frame, text='Export shared library (C interface)', background = BG_COLOR,
+                                                   variable = self.use_shared_library, anchor='w',justify = 'l')
+        self.check_shared_library.grid(row=r, column=1, sticky='ew')
+        # multi-sample driver
+        r += 1
+        self.use_multi_sample = tk.BooleanVar()
+        self.check_multi_sample = tk.Checkbutton(frame, text='Export multi-sample driver (threads)', background = BG_COLOR,
+                                                 variable = self.use_multi_sample, anchor='w',justify = 'l')
+        self.check_multi_sample.grid(row=r, column=1, sticky='ew')
+        # split source into translation units
+        r += 1
+        self.use_split_source = tk.BooleanVar()
+        self.check_split_source = tk.Checkbutton(frame, text='Split source (parallel build)', background = BG_COLOR,
+                                                 variable = self.use_split_source, anchor='w',justify = 'l')
+        self.check_split_source.grid(row=r, column=1, sticky='ew')
                 
         # save configuration
         r += 1
@@ -598,6 +716,26 @@ class converter_gui:
             else:
                 self.converter.hybrid_abm_weight = 0
                 self.converter.hybrid_elements  = set()
+            self.converter.use_jacobian = self.use_jacobian.get()
+            self.converter.use_sparse_jacobian = self.use_sparse_jacobian.get()
+            self.converter.use_cse = self.use_cse.get()
+            self.converter.use_simplify = self.use_simplify.get()
+            self.converter.use_sensitivity = self.use_sensitivity.get()
+            self.converter.sensitivity_params = self.sens_params
+            self.converter.use_ensemble = self.use_ensemble.get()
+            self.converter.use_moiety_reduction = self.use_moiety_reduction.get()
+            self.converter.use_block_order = self.use_block_order.get()
+            self.converter.rhs_table_threshold = self.rhs_table_threshold.get()
+            if self.use_output_selection.get():
+                self.converter.variable_output = self.output_species
+            else:
+                self.converter.variable_output = set()
+            self.converter.output_stride = self.output_stride.get()
+            self.converter.use_benchmark = self.use_benchmark.get()
+            self.converter.use_profiling = self.use_profiling.get()
+            self.converter.use_shared_library = self.use_shared_library.get()
+            self.converter.use_multi_sample = self.use_multi_sample.get()
+            self.converter.use_split_source = self.use_split_source.get()
             # update
             self.converter.update_model_with_configuration()
             self.reset_option_menu()
@@ -614,6 +752,29 @@ class converter_gui:
             message +='Hybrid model: {} ({}, ABM weight = {})\n'.format(self.converter.use_hybrid,
                                      len(self.hybrid_items),
                                      self.converter.hybrid_abm_weight)
+            message +='Analytic Jacobian: {} (sparse: {})\n'.format(self.converter.use_jacobian,
+                                                                   self.converter.use_sparse_jacobian)
+            message +='Common subexpression elimination: {}\n'.format(self.converter.use_cse)
+            message +='Simplify math: {}\n'.format(self.converter.use_simplify)
+            message +='Forward sensitivities: {} ({})\n'.format(self.converter.use_sensitivity,
+                                                                len(self.converter.sensitivityParams))
+            message +='Ensemble class: {}\n'.format(self.converter.use_ensemble)
+            message +='Conservation law reduction: {} ({} species removed from y)\n'.format(
+                self.converter.use_moiety_reduction, len(self.converter.moieties))
+            message +='Block triangular species order: {}\n'.format(self.converter.use_block_order)
+            message += self.converter.print_species_blocks()
+            message +='Table-driven rhs: {} ({} stoichiometric coefficients, threshold {})\n'.format(
+                self.converter.use_rhs_table, self.converter.rhs_table_nnz,
+                self.converter.rhs_table_threshold)
+            message +='Output: {} species, every {} output time\n'.format(
+                len(self.converter.speciesOutputOrder), self.converter.output_stride)
+            message +='Benchmark driver: {}\n'.format(self.converter.use_benchmark)
+            message +='Profiling counters: {}\n'.format(self.converter.use_profiling)
+            message +='Shared library: {}\n'.format(self.converter.use_shared_library)
+            message +='Multi-sample driver: {}\n'.format(self.converter.use_multi_sample)
+            message +='Split source: {}\n'.format(self.converter.use_split_source)
+            message +='Assignment rules evaluated in rhs: {} of {}\n'.format(
+                len(self.converter.assignmentRuleOrderReaction), len(self.converter.assignmentRuleOrder))
             self.print_info(message, TEXT_TAG_INFO)
             self.draw_main_frame_var_info()
         except Exception as e:
@@ -665,6 +826,28 @@ class converter_gui:
             self.print_info('No model loaded\n', TEXT_TAG_ERR)
         return
     
+    def set_sensitivity(self):
+        self.print_info('Configuring sensitivity parameters\n', TEXT_TAG_SYS)
+        if self.processed:
+            if not self.sens_config or not self.sens_config.winfo_exists():
+                self.draw_window_sensitivity()
+            else:
+                pass
+        else:
+            self.print_info('No model loaded\n', TEXT_TAG_ERR)
+        return
+    
+    def set_output_species(self):
+        self.print_info('Configuring output species\n', TEXT_TAG_SYS)
+        if self.processed:
+            if not self.output_config or not self.output_config.winfo_exists():
+                self.draw_window_output()
+            else:
+                pass
+        else:
+            self.print_info('No model loaded\n', TEXT_TAG_ERR)
+        return
+    
     # save configuration to file
     def save_config(self):
         try:
@@ -733,6 +916,51 @@ class converter_gui:
         hybrid_list = ET.SubElement(hybrid, 'hybrid_item_list')
         for item in self.hybrid_items:
             ET.SubElement(hybrid_list, item)
+        # analytic jacobian
+        use_jacobian = ET.SubElement(config, 'analytic_jacobian')
+        use_jacobian.text = str(int(self.use_jacobian.get()))
+        use_sparse_jacobian = ET.SubElement(config, 'sparse_jacobian')
+        use_sparse_jacobian.text = str(int(self.use_sparse_jacobian.get()))
+        use_cse = ET.SubElement(config, 'cse')
+        use_cse.text = str(int(self.use_cse.get()))
+        use_simplify = ET.SubElement(config, 'simplify')
+        use_simplify.text = str(int(self.use_simplify.get()))
+        # forward sensitivity
+        sensitivity = ET.SubElement(config, 'sensitivity')
+        use_sensitivity = ET.SubElement(sensitivity, 'use_sensitivity')
+        use_sensitivity.text = str(int(self.use_sensitivity.get()))
+        sensitivity_list = ET.SubElement(sensitivity, 'sensitivity_param_list')
+        for item in self.sens_params:
+            ET.SubElement(sensitivity_list, item)
+        use_ensemble = ET.SubElement(config, 'ensemble')
+        use_ensemble.text = str(int(self.use_ensemble.get()))
+        use_moiety_reduction = ET.SubElement(config, 'moiety_reduction')
+        use_moiety_reduction.text = str(int(self.use_moiety_reduction.get()))
+        use_block_order = ET.SubElement(config, 'block_order')
+        use_block_order.text = str(int(self.use_block_order.get()))
+        rhs_table_threshold = ET.SubElement(config, 'rhs_table_threshold')
+        rhs_table_threshold.text = str(self.rhs_table_threshold.get())
+        # output selection
+        output = ET.SubElement(config, 'output')
+        use_output_selection = ET.SubElement(output, 'use_output_selection')
+        use_output_selection.text = str(int(self.use_output_selection.get()))
+        output_stride = ET.SubElement(output, 'output_stride')
+        output_stride.text = str(self.output_stride.get())
+        output_list = ET.SubElement(output, 'output_list')
+        for item in self.output_species:
+            ET.SubElement(output_list, item)
+        use_benchmark = ET.SubElement(config, 'benchmark')
+        use_benchmark.text = str(int(self.use_benchmark.get()))
+        use_profiling = ET.SubElement(config, 'profiling')
+        use_profiling.text = str(int(self.use_profiling.get()))
+        use_numpy = ET.SubElement(config, 'numpy')
+        use_numpy.text = str(int(self.use_numpy.get()))
+        use_shared_library = ET.SubElement(config, 'shared_library')
+        use_shared_library.text = str(int(self.use_shared_library.get()))
+        use_multi_sample = ET.SubElement(config, 'multi_sample')
+        use_multi_sample.text = str(int(self.use_multi_sample.get()))
+        use_split_source = ET.SubElement(config, 'split_source')
+        use_split_source.text = str(int(self.use_split_source.get()))
         
         xml_string = minidom.parseString(ET.tostring(config, 'utf-8')).toprettyxml(indent=' '*4)
         return xml_string
@@ -782,6 +1010,53 @@ class converter_gui:
         hybrid_list = hybrid.find('hybrid_item_list')
         for child in hybrid_list:
             self.hybrid_items.add(child.tag)
+        # analytic jacobian (optional, absent in older settings)
+        use_jacobian = config.find('analytic_jacobian')
+        self.use_jacobian.set(use_jacobian is not None and bool(int(use_jacobian.text)))
+        use_sparse_jacobian = config.find('sparse_jacobian')
+        self.use_sparse_jacobian.set(use_sparse_jacobian is not None and bool(int(use_sparse_jacobian.text)))
+        use_cse = config.find('cse')
+        self.use_cse.set(use_cse is not None and bool(int(use_cse.text)))
+        use_simplify = config.find('simplify')
+        self.use_simplify.set(use_simplify is not None and bool(int(use_simplify.text)))
+        # forward sensitivity (optional)
+        self.sens_params.clear()
+        sensitivity = config.find('sensitivity')
+        self.use_sensitivity.set(sensitivity is not None and 
+                                 bool(int(sensitivity.find('use_sensitivity').text)))
+        if sensitivity is not None:
+            for child in sensitivity.find('sensitivity_param_list'):
+                self.sens_params.add(child.tag)
+        use_ensemble = config.find('ensemble')
+        self.use_ensemble.set(use_ensemble is not None and bool(int(use_ensemble.text)))
+        use_moiety_reduction = config.find('moiety_reduction')
+        self.use_moiety_reduction.set(use_moiety_reduction is not None and 
+                                      bool(int(use_moiety_reduction.text)))
+        use_block_order = config.find('block_order')
+        self.use_block_order.set(use_block_order is not None and bool(int(use_block_order.text)))
+        rhs_table_threshold = config.find('rhs_table_threshold')
+        self.rhs_table_threshold.set(20000 if rhs_table_threshold is None else int(rhs_table_threshold.text))
+        # output selection (optional)
+        self.output_species.clear()
+        output = config.find('output')
+        self.use_output_selection.set(output is not None and 
+                                      bool(int(output.find('use_output_selection').text)))
+        self.output_stride.set(1 if output is None else int(output.find('output_stride').text))
+        if output is not None:
+            for child in output.find('output_list'):
+                self.output_species.add(child.tag)
+        use_benchmark = config.find('benchmark')
+        self.use_benchmark.set(use_benchmark is not None and bool(int(use_benchmark.text)))
+        use_profiling = config.find('profiling')
+        self.use_profiling.set(use_profiling is not None and bool(int(use_profiling.text)))
+        use_numpy = config.find('numpy')
+        self.use_numpy.set(use_numpy is not None and bool(int(use_numpy.text)))
+        use_shared_library = config.find('shared_library')
+        self.use_shared_library.set(use_shared_library is not None and bool(int(use_shared_library.text)))
+        use_multi_sample = config.find('multi_sample')
+        self.use_multi_sample.set(use_multi_sample is not None and bool(int(use_multi_sample.text)))
+        use_split_source = config.find('split_source')
+        self.use_split_source.set(use_split_source is not None and bool(int(use_split_source.text)))
         # test if SId is element of model
         for key in self.var_extra:
             if key not in self.converter.key2name:
@@ -791,6 +1066,14 @@ class converter_gui:
             if not self.converter.model.getElementBySId(key):
                 self.print_info('Hybrid items SId {} not found in model items\n'.format(key), TEXT_TAG_ERR)
                 return
+        for key in self.sens_params:
+            if key not in self.converter.key2name:
+                self.print_info('Sensitivity parameter SId {} not found in model variables\n'.format(key), TEXT_TAG_ERR)
+                return
+        for key in self.output_species:
+            if key not in self.converter.key2name:
+                self.print_info('Output species SId {} not found in model variables\n'.format(key), TEXT_TAG_ERR)
+                return
         return
 
     # select output location 
@@ -810,7 +1093,20 @@ class converter_gui:
             message += 'Param.h\n'
             message += 'Param.cpp\n'
             message += '{}_params.xml\n'.format(self.export_class_name.get())
+            if self.converter.use_shared_library:
+                message += '{0}_capi.cpp\nbuild_{0}_lib.sh\n'.format(self.export_class_name.get())
+            if self.converter.use_multi_sample:
+                message += '{}_multi.cpp\n'.format(self.export_class_name.get())
+            if self.converter.use_split_source:
+                for filename in lc.getSplitSourceFiles(self.export_class_name.get())[1:]:
+                    message += filename + '\n'
+                message += '{}_sources.mk\n'.format(self.export_class_name.get())
+            if self.use_numpy.get():
+                self.converter.export_numpy(self.export_dir, self.export_class_name.get() + '_np')
+                message += '{}_np.py\n'.format(self.export_class_name.get())
             self.print_info(message, TEXT_TAG_SYS)
+            if self.converter.cse_report:
+                self.print_info(self.converter.cse_report, TEXT_TAG_INFO)
         except Exception as e:
             self.print_info(str(e)+'\n', TEXT_TAG_ERR)
         return
@@ -1123,7 +1419,8 @@ def draw_window_reaction(self):
                   ('{}*'.format(int(abs(stoic))) if abs(stoic) != 1 else '')
             #y += '+({})*ReactionFlux{}'.format(stoic, r+1)
             dydt += pre + 'ReactionFlux_{}'.format(r+1) 
-        idx = key2var[key]['idx']
+        # species removed by conservation laws are not in y
+        idx = key2var[key]['idx'] if key in key2var else '-'
         name = key2name[key]['name']
         comp = key2name[key]['compartment']
         unit = key2name[key]['unit_use']
@@ -1296,6 +1593,77 @@ def draw_window_var_config(self):
 
 converter_gui.draw_window_var_config = draw_window_var_config
 
+# sensitivity parameter selection window
+def draw_window_sensitivity(self):
+    # draw window
+    self.sens_config = tk.Toplevel(self.master)
+    self.sens_config.wm_title("Sensitivity parameters")
+    self.sens_config.wm_transient(self.master)
+    sens_window = selection_tree(self.sens_config, self.sens_params)
+    # add buttons to window
+    clear_button = tk.Button(sens_window.f_top, text="Clear",  width=15,
+                             background = BG_COLOR, highlightbackground = BG_COLOR,
+                             command=sens_window.tree_clear_selection)
+    clear_button.grid(row=0, column=0, sticky='wsn')
+    
+    # only constant parameters. Those in initial assignments are not selectable.
+    tree = sens_window.tree
+    tree['columns'] = ('origin', 'idx', 'name', 'desc')
+    col_names = ['Original designation', 'Index', 'Name', 'Remark']
+    for i, col in enumerate(tree['columns']):
+        tree.heading(col, text=col_names[i])
+        tree.column(col,minwidth=30,width=100, stretch = False)
+    tree.column('idx',minwidth=30,width=50, stretch = False)
+    tree.column('desc',minwidth=30,width=500, stretch = True)
+    model = self.converter.model
+    key2name = self.converter.key2name
+    used_init = lc.getInitialAssignmentNames(model, self.converter.assignmentRuleOrderIA)
+    for key in self.converter.varlist['p_const']:
+        select_tag = sens_window.SELECTION_FORBID if key in used_init else sens_window.SELECTION_NULL
+        origin = lc.TYPE_TO_STRING[key2name[key]['type']]
+        remark = self.converter.note_to_string(model.getElementBySId(key).getNotes())
+        entry = (origin, key2name[key]['idx'], key2name[key]['name'], remark)
+        tree.insert('', 'end', key, text=select_tag, values=entry)
+    sens_window.tree_refresh()
+    treeview_sort_column(tree, 'idx', False)
+    return
+
+converter_gui.draw_window_sensitivity = draw_window_sensitivity
+
+# output species selection window
+def draw_window_output(self):
+    # draw window
+    self.output_config = tk.Toplevel(self.master)
+    self.output_config.wm_title("Output species")
+    self.output_config.wm_transient(self.master)
+    output_window = selection_tree(self.output_config, self.output_species)
+    # add buttons to window
+    clear_button = tk.Button(output_window.f_top, text="Clear",  width=15,
+                             background = BG_COLOR, highlightbackground = BG_COLOR,
+                             command=output_window.tree_clear_selection)
+    clear_button.grid(row=0, column=0, sticky='wsn')
+    
+    tree = output_window.tree
+    tree['columns'] = ('origin', 'idx', 'name', 'desc')
+    col_names = ['Original designation', 'Index', 'Name', 'Remark']
+    for i, col in enumerate(tree['columns']):
+        tree.heading(col, text=col_names[i])
+        tree.column(col,minwidth=30,width=100, stretch = False)
+    tree.column('idx',minwidth=30,width=50, stretch = False)
+    tree.column('desc',minwidth=30,width=500, stretch = True)
+    model = self.converter.model
+    key2name = self.converter.key2name
+    for key in self.converter.varlist['sp_var'] + self.converter.varlist['sp_other']:
+        origin = lc.TYPE_TO_STRING[key2name[key]['type']]
+        remark = self.converter.note_to_string(model.getElementBySId(key).getNotes())
+        entry = (origin, key2name[key]['idx'], key2name[key]['name'], remark)
+        tree.insert('', 'end', key, text=output_window.SELECTION_NULL, values=entry)
+    output_window.tree_refresh()
+    treeview_sort_column(tree, 'idx', False)
+    return
+
+converter_gui.draw_window_output = draw_window_output
+
 # hybrid element selection window
 def draw_window_hybrid(self):
     # draw window
@@ -1,10 +1,154 @@
 #include "CVODEBase.h"
 
+#include <algorithm>
+#include <cstdlib>
 #include <iostream>
 #include <sstream>
 #include <string>
 
+#define STATE_MAGIC "QSPSTATE"
+
 const int mxstep = 10000;
+// nst, nfe, nsetups, nfeLS, nje, nni, ncfn, netf, nge
+const int nr_solver_stats = 9;
+
+/* Dense linear solver for block lower triangular matrices.
+* Only the diagonal blocks are factorized (in place, in the dense matrix);
+* the solve substitutes forward block by block.
+*/
+namespace {
+
+struct BlockTriangularContent {
+	//! first row of each diagonal block, followed by the matrix size
+	std::vector<sunindextype> start;
+	//! pivots of diagonal blocks, indexed by row
+	std::vector<sunindextype> pivots;
+	//! column pointers of diagonal blocks, indexed by column
+	std::vector<realtype*> cols;
+	sunindextype last_flag;
+};
+
+BlockTriangularContent* btContent(SUNLinearSolver S)
+{
+	return static_cast<BlockTriangularContent*>(S->content);
+}
+
+SUNLinearSolver_Type btGetType(SUNLinearSolver S)
+{
+	return SUNLINEARSOLVER_DIRECT;
+}
+
+int btInitialize(SUNLinearSolver S)
+{
+	btContent(S)->last_flag = SUNLS_SUCCESS;
+	return SUNLS_SUCCESS;
+}
+
+int btSetup(SUNLinearSolver S, SUNMatrix A)
+{
+	auto c = btContent(S);
+	for (size_t k = 0; k + 1 < c->start.size(); k++)
+	{
+		sunindextype s0 = c->start[k];
+		sunindextype n = c->start[k + 1] - s0;
+		for (sunindextype j = 0; j < n; j++)
+		{
+			c->cols[s0 + j] = SM_COLUMN_D(A, s0 + j) + s0;
+		}
+		sunindextype flag = denseGETRF(&c->cols[s0], n, n, &c->pivots[s0]);
+		if (flag > 0)
+		{
+			c->last_flag = s0 + flag;
+			return SUNLS_LUFACT_FAIL;
+		}
+	}
+	c->last_flag = SUNLS_SUCCESS;
+	return SUNLS_SUCCESS;
+}
+
+int btSolve(SUNLinearSolver S, SUNMatrix A, N_Vector x, N_Vector b, realtype tol)
+{
+	auto c = btContent(S);
+	N_VScale(1, b, x);
+	realtype* xd = N_VGetArrayPointer(x);
+	for (size_t k = 0; k + 1 < c->start.size(); k++)
+	{
+		sunindextype s0 = c->start[k];
+		sunindextype s1 = c->start[k + 1];
+		// coupling to earlier blocks
+		for (sunindextype j = 0; j < s0; j++)
+		{
+			if (xd[j] == 0)
+				continue;
+			realtype* col = SM_COLUMN_D(A, j);
+			for (sunindextype i = s0; i < s1; i++)
+			{
+				xd[i] -= col[i] * xd[j];
+			}
+		}
+		denseGETRS(&c->cols[s0], s1 - s0, &c->pivots[s0], xd + s0);
+	}
+	c->last_flag = SUNLS_SUCCESS;
+	return SUNLS_SUCCESS;
+}
+
+sunindextype btLastFlag(SUNLinearSolver S)
+{
+	return btContent(S)->last_flag;
+}
+
+int btSpace(SUNLinearSolver S, long int *lenrwLS, long int *leniwLS)
+{
+	*lenrwLS = 0;
+	*leniwLS = btContent(S)->start.size() + btContent(S)->pivots.size();
+	return SUNLS_SUCCESS;
+}
+
+int btFree(SUNLinearSolver S)
+{
+	if (S == NULL)
+		return SUNLS_SUCCESS;
+	delete btContent(S);
+	S->content = NULL;
+	std::free(S->ops);
+	S->ops = NULL;
+	std::free(S);
+	return SUNLS_SUCCESS;
+}
+
+/* blocks: first row of each diagonal block, starting with 0 */
+SUNLinearSolver SUNLinSol_BlockTriangular(const std::vector<sunindextype>& blocks, sunindextype neq)
+{
+	// allocated here as by the SUNDIALS 4 dense solver (no SUNLinSolNewEmpty before SUNDIALS 5);
+	// operations not set stay NULL
+	SUNLinearSolver S = static_cast<SUNLinearSolver>(std::malloc(sizeof *S));
+	if (S == NULL)
+		return NULL;
+	S->ops = static_cast<SUNLinearSolver_Ops>(std::calloc(1, sizeof(struct _generic_SUNLinearSolver_Ops)));
+	if (S->ops == NULL)
+	{
+		std::free(S);
+		return NULL;
+	}
+	S->ops->gettype = btGetType;
+	S->ops->initialize = btInitialize;
+	S->ops->setup = btSetup;
+	S->ops->solve = btSolve;
+	S->ops->lastflag = btLastFlag;
+	S->ops->space = btSpace;
+	S->ops->free = btFree;
+
+	auto c = new BlockTriangularContent;
+	c->start = blocks;
+	c->start.push_back(neq);
+	c->pivots.resize(neq);
+	c->cols.resize(neq);
+	c->last_flag = SUNLS_SUCCESS;
+	S->content = c;
+	return S;
+}
+
+}
 
 CVODEBase::CVODEBase()
 : _species_var()
@@ -13,11 +157,18 @@ CVODEBase::CVODEBase()
 , _neq(0)
 , _y(NULL)
 , _nroot(0)
+, _ntimed(0)
 , _nevent(0)
 , _delayEvents()
+, _triggerTimes()
 , _A(NULL)
 , _LS(NULL)
 , _cvode_mem(NULL)
+, _ns(0)
+, _yS(NULL)
+, _solver_stats(nr_solver_stats, 0)
+, _solver_stats_reinit(nr_solver_stats, 0)
+, _solver_reinit(true)
 , _trigger_element_type()
 , _trigger_element_satisfied()
 , _event_triggered()
@@ -32,11 +183,18 @@ CVODEBase::CVODEBase(const CVODEBase & c)
 , _neq(c._neq)
 , _y(NULL)
 , _nroot(0)
+, _ntimed(0)
 , _nevent(0)
 , _delayEvents()
+, _triggerTimes()
 , _A(NULL)
 , _LS(NULL)
 , _cvode_mem(NULL)
+, _ns(0)
+, _yS(NULL)
+, _solver_stats(nr_solver_stats, 0)
+, _solver_stats_reinit(nr_solver_stats, 0)
+, _solver_reinit(true)
 , _trigger_element_type()
 , _trigger_element_satisfied()
 , _event_triggered()
@@ -85,10 +243,13 @@ void CVODEBase::simOdeStep(double tStart, double tStep){
 	// 1. t = 0
 	// 2. ODE modified externally between steps.
 	resolveEvents(t);
+	// y may also have been changed externally
+	_solver_reinit = true;
 
 	while (t < tEnd){
 
 		bool delayedExecution = false;
+		bool timedTrigger = false;
 		bool discontinuity = false;
 		t1 = tEnd;
 
@@ -101,11 +262,29 @@ void CVODEBase::simOdeStep(double tStart, double tStep){
 			t1 = tNextDisc;
 			delayedExecution = true;
 		}
+
+		// time-only triggers: stop exactly at the time instead of root finding
+		realtype tNextTrigger = 0;
+		if (getNextTriggerTime(t, tNextTrigger) && tNextTrigger <= t1)
+		{
+			delayedExecution = delayedExecution && tNextTrigger == t1;
+			t1 = tNextTrigger;
+			timedTrigger = true;
+		}
 		//std::cout << "cycle: " << t << ", " << t1 << std::endl;
 
 		resetSolver(t, t1);
 
 		flag = CVode(_cvode_mem, t1, _y, &t, CV_NORMAL);
+		// counters are reset by CVodeReInit; keep the running total
+		accumulateSolverStats();
+#ifdef QSP_USE_CVODES
+		if (_ns > 0 && flag >= 0)
+		{
+			realtype tS;
+			CVodeGetSens(_cvode_mem, &tS, _yS);
+		}
+#endif
 
 		if (flag == CV_TOO_CLOSE)
 		{	// just move forward in this case
@@ -114,6 +293,8 @@ void CVODEBase::simOdeStep(double tStart, double tStep){
 		else {
 			check_flag(&flag, "CVode", 1);
 		}
+		// solver history ends beyond the root, or before t1
+		_solver_reinit |= flag != CV_SUCCESS && flag != CV_TSTOP_RETURN;
 
 		if (flag == CV_ROOT_RETURN)
 		{
@@ -138,12 +319,20 @@ void CVODEBase::simOdeStep(double tStart, double tStep){
 				int eventToExecute = _delayEvents.back().second;
 				realtype ttemp;
 				bool delay = eventExecution(eventToExecute, true, ttemp);
+				_solver_reinit |= !delay && eventNeedsReinit(eventToExecute);
 				_delayEvents.pop_back();
 				//std::cout << "delay queue size: " << _delayEvents.size() << std::endl;
 				discontinuity = !delay;
 			}
 		}
 
+		// stop time reached: also possible after a root found at that time
+		if (timedTrigger && t == t1)
+		{
+			updateTriggerComponentConditionsOnTime(t);
+			discontinuity |= evaluateAllEvents(t);
+		}
+
 		// either delayed execution or root found 
 		if (discontinuity)
 		{
@@ -174,6 +363,8 @@ void CVODEBase::resolveEvents(realtype t){
 		updateTriggerComponentConditionsOnValue(t);
 		discontinuity = evaluateAllEvents(t);
 	}
+	// event assignments may have moved trigger times
+	updateTriggerTimes();
 }
 
 /*! Manually update variable values.
@@ -237,18 +428,85 @@ void CVODEBase::setupCVODE(){
 		flag = CVodeSetUserData(_cvode_mem, this);
 		check_flag(&flag, "CVodeSVtolerances", 1);
 
-		/* Create dense SUNMatrix for use in linear solves */
-		_A = SUNDenseMatrix(_neq, _neq);
-		check_flag(&flag, "SUNDenseMatrix", 1);
-
-		/* Create dense SUNLinearSolver object for use by CVode */
-		_LS = SUNLinSol_Dense(_y, _A);
-		check_flag(&flag, "SUNLinSol_Dense", 1);
+		sunindextype nnz = getJacobianNNZ();
+		if (nnz > 0)
+		{
+#ifdef QSP_USE_KLU
+			/* Create sparse SUNMatrix (CSC) and KLU solver for sparse Jacobian */
+			_A = SUNSparseMatrix(_neq, _neq, nnz, CSC_MAT);
+			check_flag((void *)_A, "SUNSparseMatrix", 0);
+
+			_LS = SUNLinSol_KLU(_y, _A);
+			check_flag((void *)_LS, "SUNLinSol_KLU", 0);
+#else
+			throw std::string("sparse Jacobian requires KLU solver (build with QSP_USE_KLU)\n");
+#endif
+		}
+		else {
+			/* Create dense SUNMatrix for use in linear solves */
+			_A = SUNDenseMatrix(_neq, _neq);
+			check_flag(&flag, "SUNDenseMatrix", 1);
+
+			/* Create dense SUNLinearSolver object for use by CVode.
+			* With block triangular Jacobian, only diagonal blocks are factorized */
+			std::vector<sunindextype> blocks = getJacobianBlocks();
+			if (blocks.size() > 1)
+			{
+				_LS = SUNLinSol_BlockTriangular(blocks, _neq);
+				check_flag((void *)_LS, "SUNLinSol_BlockTriangular", 0);
+			}
+			else {
+				_LS = SUNLinSol_Dense(_y, _A);
+				check_flag(&flag, "SUNLinSol_Dense", 1);
+			}
+		}
 
 		/* Call CVodeSetLinearSolver to attach the matrix and linear solver to CVode */
 		flag = CVodeSetLinearSolver(_cvode_mem, _LS, _A);
 		check_flag(&flag, "CVodeSetLinearSolver", 1);
 
+		/* Use analytic Jacobian if provided by derived class;
+		* otherwise CVode approximates it with difference quotients */
+		CVLsJacFn jac = getJacobianFn();
+		if (jac)
+		{
+			flag = CVodeSetJacFn(_cvode_mem, jac);
+			check_flag(&flag, "CVodeSetJacFn", 1);
+		}
+
+		/* Forward sensitivities, if provided by derived class.
+		* Initial sensitivities are zero. */
+		_ns = getNumSensitivities();
+		if (_ns > 0)
+		{
+#ifdef QSP_USE_CVODES
+			_yS = N_VCloneVectorArray(_ns, _y);
+			check_flag((void *)_yS, "N_VCloneVectorArray", 0);
+			for (auto k = 0; k < _ns; k++)
+			{
+				N_VConst(0, _yS[k]);
+			}
+			flag = CVodeSensInit(_cvode_mem, _ns, CV_SIMULTANEOUS, getSensitivityRhsFn(), _yS);
+			check_flag(&flag, "CVodeSensInit", 1);
+
+			/* scale sensitivity tolerances with parameter magnitude */
+			std::vector<realtype> pbar(_ns, 1);
+			for (auto k = 0; k < _ns; k++)
+			{
+				realtype p = std::abs(getSensitivityParam(k));
+				pbar[k] = p > 0 ? p : 1;
+			}
+			flag = CVodeSetSensParams(_cvode_mem, NULL, pbar.data(), NULL);
+			check_flag(&flag, "CVodeSetSensParams", 1);
+			flag = CVodeSensEEtolerances(_cvode_mem);
+			check_flag(&flag, "CVodeSensEEtolerances", 1);
+			flag = CVodeSetSensErrCon(_cvode_mem, SUNTRUE);
+			check_flag(&flag, "CVodeSetSensErrCon", 1);
+#else
+			throw std::string("sensitivity analysis requires CVODES (build with QSP_USE_CVODES)\n");
+#endif
+		}
+
 	}
 	catch (std::string s){
 		std::cerr << "Initiating CVODE solver, error: " << s;
@@ -262,7 +520,8 @@ This can be:
 1. Delay of execution from variable-associated trigger condition
 (detected with root finding function)
 Time-associated trigger condition in one event used to be handled here.
-Now they are delt with in rootfinding function.
+Now they are delt with in rootfinding function, or, if they only depend 
+on time and constants, in getNextTriggerTime().
 */
 bool CVODEBase::getNexTimeDisc(realtype& t){
 	/**/
@@ -276,6 +535,35 @@ bool CVODEBase::getNexTimeDisc(realtype& t){
 	}
 	return false;
 }
+/*! get the t of the next time-only trigger component change after tNow.
+These components (e.g. t >= t_dose) are not passed to the rootfinding 
+function; the solver stops at their time instead.
+*/
+bool CVODEBase::getNextTriggerTime(realtype tNow, realtype& t){
+	for (auto& p : _triggerTimes)
+	{
+		if (p.first > tNow)
+		{
+			t = p.first;
+			return true;
+		}
+	}
+	return false;
+}
+
+/* sort time-only trigger components by their time
+*/
+void CVODEBase::updateTriggerTimes(void) {
+	_triggerTimes.clear();
+	for (auto i = _nroot; i < _nroot + _ntimed; i++)
+	{
+		int direction = 0;
+		_triggerTimes.push_back(std::make_pair(triggerComponentTime(i, direction), i));
+	}
+	std::sort(_triggerTimes.begin(), _triggerTimes.end());
+	return;
+}
+
 /* update trigger conditions
 */
 void CVODEBase::updateTriggerComponentConditionsOnRoot(int* rootsFound) {
@@ -302,13 +590,38 @@ void CVODEBase::updateTriggerComponentConditionsOnRoot(int* rootsFound) {
 	return;
 }
 
-void CVODEBase::updateTriggerComponentConditionsOnValue(realtype t) {
-	for (auto i = 0; i < _nroot; i++)
+/* update time-only trigger conditions reached at t,
+same as non-instant conditions crossing a root
+*/
+void CVODEBase::updateTriggerComponentConditionsOnTime(realtype t) {
+	for (auto& p : _triggerTimes)
 	{
-		_trigger_element_satisfied[i] = triggerComponentEvaluate(i, t,
-			_trigger_element_satisfied[i]);
+		if (p.first == t)
+		{
+			int direction = 0;
+			triggerComponentTime(p.second, direction);
+			_trigger_element_satisfied[p.second] = direction > 0;
+		}
+	}
+	return;
+}
+
+/*! evaluate all trigger components (rootfinding and time-only) at time t,
+one at a time. Generated classes override this, evaluating the assignment
+rules once for all components.
+\param [in] t: time
+\param [in,out] satisfied: current condition of each component, replaced by the result
+*/
+void CVODEBase::triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied) {
+	for (auto i = 0; i < _nroot + _ntimed; i++)
+	{
+		satisfied[i] = triggerComponentEvaluate(i, t, satisfied[i]);
 	}
-	//std::cout << std::endl;
+	return;
+}
+
+void CVODEBase::updateTriggerComponentConditionsOnValue(realtype t) {
+	triggerComponentEvaluateAll(t, _trigger_element_satisfied);
 	return;
 }
 
@@ -337,6 +650,7 @@ bool CVODEBase::evaluateAllEvents(realtype t) {
 			//std::cout << "execution: event " << i << std::endl;
 			// any event executed?
 			exec |= !setDelay;
+			_solver_reinit |= !setDelay && eventNeedsReinit(i);
 		}
 		_event_triggered[i] = trigger;
 	}
@@ -356,7 +670,7 @@ void CVODEBase::resetEventTriggers() {
 this is called after event evaluation.
 */
 void CVODEBase::resetTransient() {
-	for (auto i = 0; i < _nroot; i++)
+	for (auto i = 0; i < _nroot + _ntimed; i++)
 	{
 		if (isTransientEq(i))
 		{
@@ -405,6 +719,41 @@ void CVODEBase::PrintFinalStats(void *cvode_mem)
 		nni, ncfn, netf, nge);
 }
 
+/*!
+* Add statistics of the last integration segment to the running total
+*/
+void CVODEBase::accumulateSolverStats()
+{
+	long int stats[nr_solver_stats] = { 0 };
+	CVodeGetNumSteps(_cvode_mem, &stats[0]);
+	CVodeGetNumRhsEvals(_cvode_mem, &stats[1]);
+	CVodeGetNumLinSolvSetups(_cvode_mem, &stats[2]);
+	CVodeGetNumLinRhsEvals(_cvode_mem, &stats[3]);
+	CVodeGetNumJacEvals(_cvode_mem, &stats[4]);
+	CVodeGetNumNonlinSolvIters(_cvode_mem, &stats[5]);
+	CVodeGetNumNonlinSolvConvFails(_cvode_mem, &stats[6]);
+	CVodeGetNumErrTestFails(_cvode_mem, &stats[7]);
+	CVodeGetNumGEvals(_cvode_mem, &stats[8]);
+	for (auto i = 0; i < nr_solver_stats; i++)
+	{
+		_solver_stats[i] += stats[i] - _solver_stats_reinit[i];
+		_solver_stats_reinit[i] = stats[i];
+	}
+}
+
+std::string CVODEBase::getSolverStatsHeader(void)
+{
+	return "nst,nfe,nsetups,nfeLS,nje,nni,ncfn,netf,nge";
+}
+
+void CVODEBase::PrintSolverStats(std::ostream& os) const
+{
+	for (auto i = 0; i < nr_solver_stats; i++)
+	{
+		os << (i ? "," : "") << _solver_stats[i];
+	}
+}
+
 double CVODEBase::getSpeciesVar(unsigned int idx, bool raw) const
 {
 	if (idx < _species_var.size()){
@@ -438,6 +787,27 @@ void CVODEBase::setSpeciesVar(unsigned int idx, double val, bool raw)
 	return;
 }
 
+/*! sensitivity of species variable to sensitivity parameter.
+Event assignments to species update the sensitivities by the chain rule;
+trigger times are assumed independent of the parameters.
+*/
+double CVODEBase::getSensitivity(unsigned int idx, unsigned int k, bool raw) const
+{
+	if (idx < (unsigned int)_neq && k < (unsigned int)_ns){
+		double s = NV_DATA_S(_yS[k])[idx];
+		if (raw)
+		{
+			return s / get_unit_conversion_species(idx) * get_unit_conversion_sensitivity(k);
+		}
+		else{
+			return s;
+		}
+	}
+	else{
+		throw std::invalid_argument("Accessing sensitivity: out of range");
+	}
+}
+
 double CVODEBase::getParameterVal(unsigned int idx, bool raw) const
 {
 	if (idx < _nonspecies_var.size()){
@@ -471,6 +841,73 @@ void CVODEBase::setParameterVal(unsigned int idx, double val, bool raw)
 	return;
 }
 
+/*! reset variables, events and statistics as after construction, keeping the solver
+memory, which is reinitialized (CVodeReInit) at the start of the next simulation step.
+Then set up the next simulation as a new instance: setup_class_parameters,
+setup_instance_tolerance, setup_instance_varaibles and eval_init_assignment.
+*/
+void CVODEBase::resetSimulation(void){
+	setupVariables();
+	setupEvents();
+	update_y_other();
+	_delayEvents.clear();
+	_triggerTimes.clear();
+	std::fill(_solver_stats.begin(), _solver_stats.end(), 0);
+#ifdef QSP_USE_CVODES
+	for (int k = 0; k < _ns; k++)
+	{
+		N_VConst(0, _yS[k]);
+	}
+#endif
+	return;
+}
+
+/*! binary state: magic "QSPSTATE", key, number of species and non-species
+variables (uint64), followed by _species_var and _nonspecies_var (double),
+in simulation units.
+\param [in] os: binary output stream
+\param [in] key: identifies the parameters the state was obtained with
+*/
+bool CVODEBase::writeState(std::ostream& os, uint64_t key) const{
+	uint64_t header[3] = { key, _species_var.size(), _nonspecies_var.size() };
+	os.write(STATE_MAGIC, sizeof(uint64_t));
+	os.write(reinterpret_cast<const char*>(header), sizeof(header));
+	os.write(reinterpret_cast<const char*>(_species_var.data()), _species_var.size() * sizeof(double));
+	os.write(reinterpret_cast<const char*>(_nonspecies_var.data()), _nonspecies_var.size() * sizeof(double));
+	return bool(os);
+}
+
+/*! read a state written by writeState. Nothing is changed unless key and
+variable counts match. Call updateVar (and eval_init_assignment as needed) afterwards.
+\param [in] is: binary input stream
+\param [in] key: identifies the parameters the state was obtained with
+\param [in] nonspecies: also restore _nonspecies_var; otherwise keep current values
+*/
+bool CVODEBase::readState(std::istream& is, uint64_t key, bool nonspecies){
+	char magic[sizeof(uint64_t)];
+	uint64_t header[3];
+	is.read(magic, sizeof(magic));
+	is.read(reinterpret_cast<char*>(header), sizeof(header));
+	if (!is || std::string(magic, sizeof(magic)) != STATE_MAGIC || header[0] != key
+		|| header[1] != _species_var.size() || header[2] != _nonspecies_var.size())
+	{
+		return false;
+	}
+	state_type sp(header[1]), nsp(header[2]);
+	is.read(reinterpret_cast<char*>(sp.data()), sp.size() * sizeof(double));
+	is.read(reinterpret_cast<char*>(nsp.data()), nsp.size() * sizeof(double));
+	if (!is)
+	{
+		return false;
+	}
+	_species_var = sp;
+	if (nonspecies)
+	{
+		_nonspecies_var = nsp;
+	}
+	return true;
+}
+
 /*! copy _species_var to the serial container _y;
 reset start time and initial condition.
 \param [in] t0: start time
@@ -478,9 +915,24 @@ reset start time and initial condition.
 */
 void CVODEBase::resetSolver(realtype t0, realtype t1){
 	int flag = 0;
-	restore_y();
+	// y, rhs and root functions unchanged since the solver stopped at t0:
+	// keep step size and order
+	if (_solver_reinit)
+	{
+		restore_y();
+		// reinitialize first: stop time is checked against the current solver time,
+		// which is ahead of t0 when the instance is reused (resetSimulation)
+		flag = CVodeReInit(_cvode_mem, t0, _y);
+#ifdef QSP_USE_CVODES
+		if (_ns > 0)
+		{
+			flag = CVodeSensReInit(_cvode_mem, CV_SIMULTANEOUS, _yS);
+		}
+#endif
+		std::fill(_solver_stats_reinit.begin(), _solver_stats_reinit.end(), 0);
+		_solver_reinit = false;
+	}
 	flag = CVodeSetStopTime(_cvode_mem, t1);
-	flag = CVodeReInit(_cvode_mem, t0, _y);
 	return;
 }
 /*! copy variable value from vector to serial
@@ -503,6 +955,8 @@ void CVODEBase::save_y(){
 	{
 		_species_var[i] = NV_DATA_S(_y)[i] *
 			(NV_DATA_S(_y)[i] < 0 ? allow_negative(i) : 1 );
+		// negative value reset
+		_solver_reinit |= _species_var[i] != NV_DATA_S(_y)[i];
 	}
 }
 
@@ -528,6 +982,10 @@ bool CVODEBase::freeMem(){
 
 	/* Free y and abstol vectors */
 	N_VDestroy_Serial(_y);
+	if (_yS)
+	{
+		N_VDestroyVectorArray(_yS, _ns);
+	}
 	//N_VDestroy_Serial(_abstol);
 
 	/* Free integrator memory */
@@ -2,10 +2,20 @@
 
 #include <boost/property_tree/xml_parser.hpp>
 #include <boost/foreach.hpp>
+#include <algorithm>
 #include <iostream>
 
 namespace pt = boost::property_tree;
 
+// FNV-1a (64 bit), continued from h
+static void hash_bytes(uint64_t& h, const void* data, size_t n){
+	const unsigned char* p = static_cast<const unsigned char*>(data);
+	for (size_t i = 0; i < n; i++)
+	{
+		h = (h ^ p[i]) * 0x100000001b3ULL;
+	}
+}
+
 ParamBase::ParamBase()
 	:_paramDesc()
 	, _paramFloat()
@@ -213,3 +223,39 @@ void ParamBase::writeParamsToXml(std::string outFileName){
 	pt::write_xml(outFileName, tree, std::locale(), settings);
 
 }
+
+/*! hash of parameter paths and values, in order of _paramDesc.
+	\param [in] exclude: paths of parameters to leave out (e.g. "QSP.init_value.Parameter.dose_mg_Nivo")
+	Parameter sets differing only in excluded parameters have the same hash.
+	The path is part of the hash, so hashes of different parameter layouts differ.
+*/
+uint64_t ParamBase::getHash(const std::vector<std::string>& exclude) const{
+
+	uint64_t h = 0xcbf29ce484222325ULL;
+	size_t nrFloatParam = _paramFloat.size();
+	size_t nrIntParam = _paramInt.size();
+	for (size_t i = 0; i < _paramDesc.size(); i++)
+	{
+		const std::string& path = _paramDesc[i][0];
+		if (std::find(exclude.begin(), exclude.end(), path) != exclude.end())
+		{
+			continue;
+		}
+		// including terminating null as separator
+		hash_bytes(h, path.c_str(), path.size() + 1);
+		if (i < nrFloatParam)
+		{
+			hash_bytes(h, &_paramFloat[i], sizeof(double));
+		}
+		else if (i < nrFloatParam + nrIntParam)
+		{
+			hash_bytes(h, &_paramInt[i - nrFloatParam], sizeof(int));
+		}
+		else
+		{
+			char v = _paramBool[i - nrFloatParam - nrIntParam];
+			hash_bytes(h, &v, 1);
+		}
+	}
+	return h;
+}
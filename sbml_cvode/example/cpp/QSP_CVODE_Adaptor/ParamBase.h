@@ -1,6 +1,8 @@
 #pragma once
 
 #include <boost/property_tree/ptree.hpp>
+#include <cstdint>
+#include <string>
 #include <vector>
 //#define PARAM_DESCRIPTION_FIELDS 3
 
@@ -14,6 +16,8 @@ public:
 	void initializeParams(std::string inFileName);
 	//! export paramters to xml
 	void writeParamsToXml(std::string);
+	//! hash of parameter paths and values, except paths in exclude
+	uint64_t getHash(const std::vector<std::string>& exclude = std::vector<std::string>()) const;
 	//! get parameter value (float)
 
 protected:
@@ -0,0 +1,123 @@
+#ifndef __QSP_BENCH__
+#define __QSP_BENCH__
+
+/* Benchmark of an exported model: mean time of f() and g() on the initial
+* state, wall time and CVode statistics of full simulations.
+* Used by the driver generated with the model (<class_name>_bench.cpp,
+* use_benchmark) and by example/cpp/benchmark/QSP_bench.cpp.
+*
+* Usage: <executable> param_file [nr_call] [nr_repeat]
+* Output: header line, value line. rhs: emission mode of f() as passed by the
+* driver; f_us, g_us: mean time (microseconds) of one call on the initial state;
+* nr_repeat: number of full simulations, each with a new model instance;
+* solve_s, solve_mean_s: shortest and mean wall time of one simulation (seconds);
+* followed by the solver statistics of one simulation.
+*/
+
+#include <iostream>
+#include <string>
+#include <vector>
+#include <chrono>
+#include <algorithm> // min, max
+
+/* ODE: exported model class; P: its parameter class.
+* time_scale: simulation time unit per day (times in parameter file are in days)
+* rhs: emission mode of f() ("unrolled", "table"), empty if not known
+*/
+template <class ODE, class P>
+int qsp_bench_main(int argc, char* argv[], double time_scale, const std::string& rhs)
+{
+	typedef std::chrono::steady_clock bench_clock;
+
+	if (argc < 2)
+	{
+		std::cerr << "Usage: " << argv[0] << " param_file [nr_call] [nr_repeat]" << std::endl;
+		return 1;
+	}
+	int nrCall = argc > 2 ? std::stoi(argv[2]) : 10000;
+	int nrRepeat = argc > 3 ? std::stoi(argv[3]) : 1;
+
+	P params;
+	params.initializeParams(argv[1]);
+	ODE::setup_class_parameters(params);
+
+	double t_start0 = params.getVal(0) * time_scale;
+	double t_step = params.getVal(1) * time_scale;
+	int nrStep = int(params.getVal(2));
+	double t_end = t_start0 + t_step * nrStep;
+
+	// f() and g() on the initial state, in units used in simulation
+	double f_us = 0, g_us = 0;
+	{
+		ODE ode;
+		ode.setup_instance_tolerance(params);
+		ode.setup_instance_varaibles(params);
+		ode.eval_init_assignment();
+
+		int neq = ode.getNumSpeciesVar();
+		N_Vector y = N_VNew_Serial(neq);
+		N_Vector ydot = N_VNew_Serial(neq);
+		for (int i = 0; i < neq; i++)
+		{
+			NV_Ith_S(y, i) = ode.getSpeciesVar(i, false);
+		}
+		std::vector<realtype> gout(std::max(ode.getNumRoots(), 1));
+
+		auto tic = bench_clock::now();
+		for (int k = 0; k < nrCall; k++)
+		{
+			ODE::f(t_start0, y, ydot, &ode);
+		}
+		f_us = std::chrono::duration<double, std::micro>(bench_clock::now() - tic).count() / nrCall;
+
+		if (ode.getNumRoots())
+		{
+			tic = bench_clock::now();
+			for (int k = 0; k < nrCall; k++)
+			{
+				ODE::g(t_start0, y, gout.data(), &ode);
+			}
+			g_us = std::chrono::duration<double, std::micro>(bench_clock::now() - tic).count() / nrCall;
+		}
+		N_VDestroy_Serial(y);
+		N_VDestroy_Serial(ydot);
+	}
+
+	// full simulations; solver statistics are identical between repeats
+	std::vector<long int> stats;
+	double solve_min = 0, solve_total = 0;
+	for (int k = 0; k < nrRepeat; k++)
+	{
+		ODE ode;
+		ode.setup_instance_tolerance(params);
+		ode.setup_instance_varaibles(params);
+		ode.eval_init_assignment();
+
+		auto tic = bench_clock::now();
+		double t_start = t_start0;
+		while (t_start < t_end)
+		{
+			double t_step_sim = std::min(t_end - t_start, t_step);
+			ode.simOdeStep(t_start, t_step_sim);
+			t_start += t_step_sim;
+		}
+		double solve_s = std::chrono::duration<double>(bench_clock::now() - tic).count();
+		solve_total += solve_s;
+		solve_min = k ? std::min(solve_min, solve_s) : solve_s;
+		stats = ode.getSolverStats();
+	}
+
+	std::cout << "rhs,nr_call,f_us,g_us,nr_repeat,solve_s,solve_mean_s,"
+		<< ODE::getSolverStatsHeader() << std::endl;
+	std::cout << rhs << "," << nrCall << "," << f_us << "," << g_us << ","
+		<< nrRepeat << "," << solve_min << "," << solve_total / std::max(nrRepeat, 1);
+	for (auto s : stats)
+	{
+		std::cout << "," << s;
+	}
+	std::cout << std::endl;
+
+	return 0;
+}
+
+#endif
@@ -0,0 +1,27 @@
+/*
+################################################################################
+#                                                                              #
+#  Solver benchmark of any exported model (MODEL_NAMESPACE), see QSPBench.h.   #
+#  Same as the driver generated with use_benchmark, for models exported        #
+#  without it. Build once against a model exported with analytic Jacobian     #
+#  and once against the same model exported without it to compare the two.    #
+#                                                                              #
+################################################################################
+*/
+
+#include "ODE_system.h"
+#include "Param.h"
+#include "QSPBench.h"
+
+#define SEC_PER_DAY 86400
+
+#ifndef MODEL_NAMESPACE
+#define MODEL_NAMESPACE CancerVCT
+#endif
+
+int main(int argc, char* argv[])
+{
+	// emission mode of f() is only known to the generated driver
+	return qsp_bench_main<MODEL_NAMESPACE::ODE_system, MODEL_NAMESPACE::Param>(
+		argc, argv, SEC_PER_DAY, "");
+}
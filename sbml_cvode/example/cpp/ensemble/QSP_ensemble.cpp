@@ -0,0 +1,133 @@
+/*
+################################################################################
+#                                                                              #
+#  Ensemble simulation: one parameter file per member (virtual patient), all   #
+#  members integrated by one solver. Time settings and tolerances are taken    #
+#  from the first parameter file. Build with QSP_USE_KLU.                      #
+#                                                                              #
+################################################################################
+*/
+
+#include "ODE_system_ensemble.h"
+#include "Param.h"
+
+#include <iostream>
+#include <fstream>
+#include <string>
+#include <vector>
+#include <algorithm> // min
+
+#include <boost/program_options.hpp>
+#include <boost/filesystem.hpp>
+
+#define SEC_PER_DAY 86400
+
+#ifndef MODEL_NAMESPACE
+#define MODEL_NAMESPACE CancerVCT
+#endif
+
+namespace po = boost::program_options;
+typedef MODEL_NAMESPACE::ODE_system_ensemble QSP_Ensemble;
+using MODEL_NAMESPACE::Param;
+
+// one row per member file: t, species of member m
+void write_member(std::ofstream& f, double t, const QSP_Ensemble& ode, int m, int nrSpecies)
+{
+	f << t;
+	for (int i = 0; i < nrSpecies; i++)
+	{
+		f << "," << ode.getMemberVar(m, i);
+	}
+	f << std::endl;
+}
+
+int main(int argc, char* argv[])
+{
+	std::vector<std::string> _inputParam;
+	std::string _outPath;
+	// command line options
+	try {
+		po::options_description desc("Allowed options");
+		desc.add_options()
+			("help,h", "produce help message")
+			("input-file,i", po::value<std::vector<std::string> >(&_inputParam)->multitoken(), "parameter file names, one per member")
+			("output-path,o", po::value<std::string>(&_outPath)->default_value("output"), "output file path")
+			;
+		po::variables_map vm;
+		po::store(po::parse_command_line(argc, argv, desc), vm);
+		po::notify(vm);
+
+		if (vm.count("help")) {
+			std::cout << desc << "\n";
+			return 0;
+		}
+
+		if (!vm.count("input-file"))
+		{
+			std::cout << desc << "\n";
+			std::cerr << "no input file specified!\n";
+			return 1;
+		}
+
+	}catch (std::exception& e) {
+		std::cerr << "error: " << e.what() << "\n";
+		return 1;
+	}
+
+	// output directory
+	boost::filesystem::path pOut(_outPath);
+	boost::filesystem::create_directories(pOut);// create output directory
+
+	int nrMember = _inputParam.size();
+	QSP_Ensemble ensemble(nrMember);
+
+	// parameters of each member
+	std::vector<Param> params(nrMember);
+	for (int m = 0; m < nrMember; m++)
+	{
+		params[m].initializeParams(_inputParam[m]);
+		ensemble.setup_member(m, params[m]);
+	}
+	ensemble.setup_instance_tolerance(params[0]);
+
+	// output files, one per member
+	std::string header = "t" + QSP_Ensemble::getHeader();
+	int nrSpecies = std::count(header.begin(), header.end(), ',');
+	std::vector<std::ofstream> f(nrMember);
+	for (int m = 0; m < nrMember; m++)
+	{
+		f[m].open(_outPath + "/solution_" + std::to_string(m) + ".csv", std::ios::trunc);
+		f[m] << header << std::endl;
+	}
+
+	// solve ODE system
+	double t_start = params[0].getVal(0) * SEC_PER_DAY;
+	double t_step = params[0].getVal(1) * SEC_PER_DAY;
+	int nrStep = int(params[0].getVal(2));
+	auto t_end = t_start + t_step * nrStep;
+
+	for (int m = 0; m < nrMember; m++)
+	{
+		write_member(f[m], t_start, ensemble, m, nrSpecies);
+	}
+
+	while (t_start < t_end)
+	{
+		double t_remaining = t_end - t_start;
+		double t_step_sim = std::min(t_remaining, t_step);
+
+		ensemble.simOdeStep(t_start, t_step_sim);
+
+		t_start += t_step_sim;
+		for (int m = 0; m < nrMember; m++)
+		{
+			write_member(f[m], t_start, ensemble, m, nrSpecies);
+		}
+	}
+	for (int m = 0; m < nrMember; m++)
+	{
+		f[m].close();
+	}
+
+	return 0;
+}
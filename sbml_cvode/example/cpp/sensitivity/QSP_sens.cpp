@@ -0,0 +1,155 @@
+/*
+################################################################################
+#                                                                              #
+#  Forward sensitivity: trajectory and its sensitivities to the parameters     #
+#  selected at export, from one simulation. Build with QSP_USE_CVODES.         #
+#                                                                              #
+################################################################################
+*/
+
+#include "MolecularModelCVode.h"
+#include "ODE_system.h"
+#include "Param.h"
+
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+#include <algorithm> // min
+
+#include <boost/program_options.hpp>
+#include <boost/filesystem.hpp>
+
+#define SEC_PER_DAY 86400
+
+#ifndef MODEL_NAMESPACE
+#define MODEL_NAMESPACE CancerVCT
+#endif
+
+namespace po = boost::program_options;
+typedef MolecularModelCVode<MODEL_NAMESPACE::ODE_system> QSP;
+using MODEL_NAMESPACE::Param;
+
+// names from a header string in the format of ",name1,name2"
+std::vector<std::string> split_header(const std::string& header)
+{
+	std::vector<std::string> names;
+	std::stringstream ss(header);
+	std::string name;
+	std::getline(ss, name, ',');
+	while (std::getline(ss, name, ','))
+	{
+		names.push_back(name);
+	}
+	return names;
+}
+
+// one row per sensitivity parameter: t, parameter, d(y_i)/d(p)
+void write_sensitivity(std::ostream& f, double t, QSP& model,
+	const std::vector<std::string>& param_names)
+{
+	auto ode = model.getSystem();
+	for (int k = 0; k < ode->getNumSensitivityParam(); k++)
+	{
+		f << t << "," << param_names[k];
+		for (int i = 0; i < ode->getNumSpeciesVar(); i++)
+		{
+			f << "," << ode->getSensitivity(i, k);
+		}
+		f << std::endl;
+	}
+}
+
+int main(int argc, char* argv[])
+{
+	std::string _inputParam;
+	std::string _outPath;
+	std::string _outfile;
+	std::string _outfileSens;
+	// command line options
+	try {
+		po::options_description desc("Allowed options");
+		desc.add_options()
+			("help,h", "produce help message")
+			("input-file,i", po::value<std::string>(&_inputParam), "parameter file name")
+			("output-path,o", po::value<std::string>(&_outPath)->default_value("output"), "output file path")
+			("output-file-name,n", po::value<std::string>(&_outfile)->default_value("solution.csv"), "output file name")
+			("sensitivity-file-name,s", po::value<std::string>(&_outfileSens)->default_value("sensitivity.csv"), "sensitivity output file name")
+			;
+		po::variables_map vm;
+		po::store(po::parse_command_line(argc, argv, desc), vm);
+		po::notify(vm);
+
+		if (vm.count("help")) {
+			std::cout << desc << "\n";
+			return 0;
+		}
+
+		if (!vm.count("input-file"))
+		{
+			std::cout << desc << "\n";
+			std::cerr << "no input file specified!\n";
+			return 1;
+		}
+
+	}catch (std::exception& e) {
+		std::cerr << "error: " << e.what() << "\n";
+		return 1;
+	}
+
+	// output directory
+	boost::filesystem::path pOut(_outPath);
+	boost::filesystem::create_directories(pOut);// create output directory
+
+	// parameters
+	Param params;
+	params.initializeParams(_inputParam);
+
+	MODEL_NAMESPACE::ODE_system::setup_class_parameters(params);
+	// simulation object
+	QSP model;
+	// update variables from parameter file
+	model.getSystem()->setup_instance_tolerance(params);
+	model.getSystem()->setup_instance_varaibles(params);
+	model.getSystem()->eval_init_assignment();
+
+	// output files
+	std::ofstream f(_outPath + "/" + _outfile, std::ios::trunc);
+	std::ofstream fs(_outPath + "/" + _outfileSens, std::ios::trunc);
+
+	// header
+	f << "t" << model.getSystem()->getHeader() << std::endl;
+	auto param_names = split_header(MODEL_NAMESPACE::ODE_system::getSensitivityHeader());
+	auto species_names = split_header(model.getSystem()->getHeader());
+	fs << "t,parameter";
+	for (int i = 0; i < model.getSystem()->getNumSpeciesVar(); i++)
+	{
+		fs << "," << species_names[i];
+	}
+	fs << std::endl;
+
+	// solve ODE system
+	double t_start = params.getVal(0) * SEC_PER_DAY;
+	double t_step = params.getVal(1) * SEC_PER_DAY ;
+	int nrStep = int(params.getVal(2));
+	auto t_end = t_start + t_step * nrStep;
+
+	f << t_start << model << std::endl;
+	write_sensitivity(fs, t_start, model, param_names);
+
+	while (t_start < t_end)
+	{
+		double t_remaining = t_end - t_start;
+		double t_step_sim = std::min(t_remaining, t_step);
+
+		model.solve(t_start, t_step_sim);
+
+		t_start += t_step_sim;
+		f << t_start << model << std::endl;
+		write_sensitivity(fs, t_start, model, param_names);
+	}
+	f.close();
+	fs.close();
+
+	return 0;
+}
@@ -11,8 +11,13 @@
 #include "Param.h"
 
 #include <iostream>
+#include <fstream>
+#include <sstream>
+#include <iomanip>
 #include <string>
-#include <algorithm> // min
+#include <vector>
+#include <ctime>
+#include <algorithm> // min, sort
 
 #include <boost/program_options.hpp>
 #include <boost/filesystem.hpp>
@@ -30,6 +35,111 @@ typedef boost::archive::text_oarchive oax;
 namespace po = boost::program_options;
 typedef MolecularModelCVode<CancerVCT::ODE_system> QSP;
 using CancerVCT::Param;
+namespace fs = boost::filesystem;
+
+// cache file of a steady state: <16 hex digits of key>.state
+std::string state_file_name(uint64_t key)
+{
+	std::ostringstream s;
+	s << std::hex << std::setw(16) << std::setfill('0') << key << ".state";
+	return s.str();
+}
+
+/* integrate to steady state as with -s: class parameters and time span of the
+   pre-treatment parameter file, steady state forcing on. Write the final state
+   (CVODEBase::writeState) to os. Class parameters are left as in params.
+*/
+bool compute_steady_state(Param& params, uint64_t key, std::ostream& os)
+{
+	CancerVCT::ODE_system::use_steady_state = true;
+	CancerVCT::ODE_system::setup_class_parameters(params);
+	QSP model_ss;
+	model_ss.getSystem()->setup_instance_tolerance(params);
+	model_ss.getSystem()->setup_instance_varaibles(params);
+	model_ss.getSystem()->eval_init_assignment();
+
+	double t_start = params.getVal(0) * SEC_PER_DAY;
+	double t_step = params.getVal(1) * SEC_PER_DAY;
+	int nrStep = int(params.getVal(2));
+	auto t_end = t_start + t_step * nrStep;
+	while (t_start < t_end)
+	{
+		double t_step_sim = std::min(t_end - t_start, t_step);
+		model_ss.solve(t_start, t_step_sim);
+		t_start += t_step_sim;
+	}
+	CancerVCT::ODE_system::use_steady_state = false;
+	return model_ss.getSystem()->writeState(os, key);
+}
+
+// write to a temporary file, then rename: concurrent runs never read a partial state
+bool save_state_file(const fs::path& p, const std::string& data)
+{
+	boost::system::error_code ec;
+	fs::path tmp = p.parent_path() / fs::unique_path("%%%%-%%%%-%%%%-%%%%.tmp", ec);
+	if (ec)
+	{
+		return false;
+	}
+	std::ofstream f(tmp.string(), std::ios::binary | std::ios::trunc);
+	f.write(data.data(), data.size());
+	f.close();
+	if (f)
+	{
+		fs::rename(tmp, p, ec);
+	}
+	if (!f || ec)
+	{
+		fs::remove(tmp, ec);
+		return false;
+	}
+	return true;
+}
+
+/* remove least recently used (last written or loaded) states until the
+   cache is within maxSize bytes. keep: state of the current run.
+*/
+void evict_cache(const fs::path& cacheDir, uintmax_t maxSize, const fs::path& keep)
+{
+	struct entry {
+		std::time_t t;
+		uintmax_t size;
+		fs::path p;
+	};
+	std::vector<entry> states;
+	uintmax_t total = 0;
+	boost::system::error_code ec;
+	for (fs::directory_iterator it(cacheDir, ec), end; !ec && it != end; it.increment(ec))
+	{
+		boost::system::error_code ec_file;
+		const fs::path& p = it->path();
+		if (p.extension() != ".state")
+		{
+			continue;
+		}
+		entry e = { fs::last_write_time(p, ec_file), fs::file_size(p, ec_file), p };
+		if (!ec_file)
+		{
+			states.push_back(e);
+			total += e.size;
+		}
+	}
+	std::sort(states.begin(), states.end(),
+		[](const entry& a, const entry& b){ return a.t < b.t; });
+	for (auto& e : states)
+	{
+		if (total <= maxSize)
+		{
+			break;
+		}
+		// files removed by another run in the meantime count as removed
+		if (e.p != keep)
+		{
+			fs::remove(e.p, ec);
+			total -= e.size;
+		}
+	}
+}
 
 int main(int argc, char* argv[])
 {
@@ -38,10 +148,15 @@ int main(int argc, char* argv[])
 	std::string _outfile;
 	std::string _savePath;
 	std::string _loadFile;
+	std::string _cacheDir;
+	std::string _cachePreParam;
+	double _cacheSize = 0;
+	std::vector<std::string> _cacheExclude;
 	bool _save_stats = false;
 	bool _save_steady_state = false;
 	bool _load_steady_state = false;
 	bool _use_resection = false;
+	bool _use_cache = false;
 
 	// command line options
 	try {
@@ -54,6 +169,10 @@ int main(int argc, char* argv[])
 			("save-path,s", po::value<std::string>(&_savePath), "folder to save steady state serialization")
 			("load-file,l", po::value<std::string>(&_loadFile), "file to load steady state serialization from")
 			("use-resection,r", po::bool_switch(&_use_resection), "to perform resection")
+			("cache-dir,c", po::value<std::string>(&_cacheDir), "steady state cache folder: load steady state of the parameter set, or compute and save it")
+			("cache-size", po::value<double>(&_cacheSize)->default_value(1024), "cache size limit (MB), least recently used states are removed")
+			("cache-pre-file,p", po::value<std::string>(&_cachePreParam), "pre-treatment parameter file of the steady state run (as with -s), default: input file")
+			("cache-exclude,x", po::value<std::vector<std::string> >(&_cacheExclude)->multitoken(), "parameters of the pre-treatment file not affecting the steady state, excluded from the cache key")
 			;
 		po::variables_map vm;
 		po::store(po::parse_command_line(argc, argv, desc), vm);
@@ -89,6 +208,21 @@ int main(int argc, char* argv[])
 		{
 			_load_steady_state = true;
 		}
+		if (vm.count("cache-dir"))
+		{
+			_use_cache = true;
+		}
+		if (!vm.count("cache-pre-file"))
+		{
+			_cachePreParam = _inputParam;
+		}
+		if (_use_cache && _cacheExclude.size() && !vm.count("cache-pre-file"))
+		{
+			std::cout << desc << "\n";
+			std::cerr << "Excluded parameters need the pre-treatment parameter file (-p):"
+				<< " the steady state must not depend on them" << std::endl;
+			return 1;
+		}
 		if (_save_steady_state && _load_steady_state)
 		{
 			std::cout << desc << "\n";
@@ -96,6 +230,12 @@ int main(int argc, char* argv[])
 				<< " in the same simulation" << std::endl;
 			return 1;
 		}
+		if (_use_cache && (_save_steady_state || _load_steady_state))
+		{
+			std::cout << desc << "\n";
+			std::cerr << "Steady state cache replaces save and load of steady-states" << std::endl;
+			return 1;
+		}
 	}catch (std::exception& e) {
 		std::cerr << "error: " << e.what() << "\n";
 		return 1;
@@ -118,10 +258,6 @@ int main(int argc, char* argv[])
 
 	CancerVCT::ODE_system::setup_class_parameters(params);
 
-	if (_use_resection)
-	{
-		CancerVCT::ODE_system::use_resection = true;
-	}
 	// simulation object
 	QSP model;
 	// update variables from parameter file
@@ -155,6 +291,55 @@ int main(int argc, char* argv[])
 		model.getSystem()->updateVar();
 	}
 
+	// steady state from cache; integrated and saved if not found.
+	// Same as a -s run with the pre-treatment file followed by -l, with a state
+	// per pre-treatment parameter set, keyed by the hash of all its parameters
+	// except _cacheExclude.
+	if (_use_cache)
+	{
+		Param paramsPre;
+		paramsPre.initializeParams(_cachePreParam);
+		uint64_t key = paramsPre.getHash(_cacheExclude);
+		fs::path pCache(_cacheDir);
+		fs::create_directories(pCache);
+		fs::path pState = pCache / state_file_name(key);
+
+		boost::system::error_code ec;
+		std::ifstream in_state(pState.string(), std::ios::binary);
+		// species only: non-species variables (e.g. dosing) from parameter file
+		if (in_state && model.getSystem()->readState(in_state, key, false))
+		{
+			// most recently used
+			fs::last_write_time(pState, std::time(0), ec);
+		}
+		else
+		{
+			std::stringstream state(std::ios::in | std::ios::out | std::ios::binary);
+			if (!compute_steady_state(paramsPre, key, state))
+			{
+				std::cerr << "Failed to compute steady state" << std::endl;
+				return 1;
+			}
+			// class parameters of this run (the steady state run used the pre-treatment
+			// values, and its events may have changed them)
+			CancerVCT::ODE_system::setup_class_parameters(params);
+			if (!save_state_file(pState, state.str()))
+			{
+				std::cerr << "Warning: steady state not saved to " << pState.string() << std::endl;
+			}
+			model.getSystem()->readState(state, key, false);
+			evict_cache(pCache, uintmax_t(_cacheSize * 1024 * 1024), pState);
+		}
+		in_state.close();
+		model.getSystem()->eval_init_assignment();
+		model.getSystem()->updateVar();
+	}
+
+	if (_use_resection)
+	{
+		CancerVCT::ODE_system::use_resection = true;
+	}
+
 	//std::cout << "resection: " << CancerVCT::ODE_system::use_resection << std::endl;
 	// header
 	if (_save_stats)
@@ -92,6 +92,9 @@ int main(int argc, char* argv[])
 
 	f << t_start << model << std::endl;
 
+	// write every n-th output time, and the last one
+	int stride = model.getSystem()->getOutputStride();
+	int step = 0;
 	while (t_start < t_end)
 	{
 		double t_remaining = t_end - t_start;
@@ -100,7 +103,11 @@ int main(int argc, char* argv[])
 		model.solve(t_start, t_step_sim);
 
 		t_start += t_step_sim;
-		f << t_start << model << std::endl;
+		step++;
+		if (step % stride == 0 || t_start >= t_end)
+		{
+			f << t_start << model << std::endl;
+		}
 		//std::cout << t_start / SEC_PER_DAY << std::endl;
 	}
 	f.close();
@@ -6,10 +6,17 @@ Created on Fri Nov 30 15:41:06 2018
 """
 
 import libsbml as lsb
+import math as pymath
+import os
+import types
+import textwrap
+import numpy as np
 
 #import xml.etree.ElementTree as ET
 import lxml.etree as ET
 
+import paramBinary as pb
+
 # version
 CONVERTER_VERSION = '1.0'
 
@@ -20,6 +27,11 @@ ODE_TIME_NAME = 't'
 # macro for QSP weight if used in a hybrid model
 QSP_WEIGHT_NAME = 'QSP_W'
 
+# translation units of a split source (use_split_source), <class_name><unit>.cpp:
+# constructor, solver and output; parameter and variable setup; initial assignments;
+# rhs, Jacobian and sensitivities; events and root functions
+SPLIT_SOURCE_UNITS = ['', 'param', 'init', 'rhs', 'events']
+
 # xml tags
 XML_ROOT = 'QSP'
 XML_SIM = 'simulation'
@@ -59,7 +71,34 @@ ASTNameToCppToken = {
         'power': 'std::pow',
         'root': 'std::sqrt',
         SBML_FUNCTION_NTHROOT: 'std::pow',
-        'ln': 'std::log'
+        'ln': 'std::log',
+        'cbrt': 'std::cbrt'
+        }
+
+# same, for NumPy expressions (AstTranslatorNumpy)
+ASTNameToNumpyToken = {
+        #operators
+        'times': ' * ',
+        'divide': ' / ',
+        'plus': ' + ',
+        'minus': ' - ',
+        #relational
+        'eq': ' == ',
+        'geq': ' >= ',
+        'gt': ' > ',
+        'leq': ' <= ',
+        'lt': ' < ',
+        'neq': ' != ',
+        #logical, elementwise
+        'and': ' & ',
+        'or': ' | ',
+        # functions:
+        'power': 'np.power',
+        'root': 'np.sqrt',
+        SBML_FUNCTION_NTHROOT: 'np.power',
+        'ln': 'np.log',
+        'cbrt': 'np.cbrt',
+        'ceiling': 'np.ceil'
         }
 #%% 
 ############################################################
@@ -73,6 +112,46 @@ class sbmlConverter:
         self.convert_unit = True
         self.use_hybrid = False
         self.use_variable_finetune = False
+        # emit analytic Jacobian
+        self.use_jacobian = False
+        # analytic Jacobian in sparse format, solved with KLU
+        self.use_sparse_jacobian = False
+        # common subexpression elimination in generated functions
+        self.use_cse = False
+        self.cse_report = ''
+        # fold constants, strength reduction of powers and roots
+        self.use_simplify = False
+        # forward sensitivity (CVODES) with respect to constant parameters
+        self.use_sensitivity = False
+        self.sensitivity_params = set()
+        # also export an ensemble class: many parameter sets, one solver
+        self.use_ensemble = False
+        # remove species linked by conserved totals from y
+        self.use_moiety_reduction = False
+        self.moieties = []
+        # y in order of strongly connected species blocks, block triangular Jacobian
+        self.use_block_order = False
+        self.speciesBlocks = []
+        # constant parameters fixed at export (export_model)
+        self.frozenParams = {}
+        # dydt from a sparse stoichiometry table (CSR) and a flux array instead of unrolled sums,
+        # for rhs with at least this many stoichiometric coefficients (use_rhs_table, set by the model)
+        self.rhs_table_threshold = 20000
+        self.use_rhs_table = False
+        self.rhs_table_nnz = 0
+        # write every n-th output time; species in output: variable_output (all if empty)
+        self.output_stride = 1
+        # also export a benchmark driver: cost of f(), g() and one full solve
+        self.use_benchmark = False
+        # counters and timers in f(), g() and eventExecution(), active with -DQSP_PROFILE
+        self.use_profiling = False
+        # also export a C interface and build script of a shared library (thread-local class parameters)
+        self.use_shared_library = False
+        # also export a multi-sample driver: parameter matrix, one model instance per thread
+        self.use_multi_sample = False
+        # write <class_name>.cpp as several translation units with a shared internal header
+        # and a Makefile fragment listing them (<class_name>_sources.mk), for parallel builds
+        self.use_split_source = False
         self.reltol = 0
         self.abstol = 0
         return
@@ -138,13 +217,41 @@ class sbmlConverter:
         if not self.has_model():
             raise NameError('No model loaded')
         return
+    # write vectorized rhs as python module (NumPy), <module_name>.py
+    def export_numpy(self, path, module_name):
+        if not self.has_model():
+            raise NameError('No model loaded')
+        if self.use_hybrid or self.moieties:
+            raise ValueError('NumPy module: hybrid models and moiety reduction are not supported.')
+        with open(path + '/' + module_name + '.py', 'w') as file:
+            file.write(getNumpyModuleContent(self.model, self.assignmentRuleOrder, 
+                                             self.assignmentRuleOrderIA, self.initialAssignmentOrder,
+                                             self.speciesStoichiometry, self.convert_unit,
+                                             self.key2var, self.key2name, self.varlist,
+                                             self.variable_name_string, 
+                                             AstSimplifier(False) if self.use_simplify else None,
+                                             self.arGraph if self.use_jacobian else None))
+        return
     # write model to cpp/h class files
-    def export_model(self, path, class_name, name_space):
+    # param_file: reference parameter file. If given, constant parameters
+    # other than variable_params are fixed to its values at compile time.
+    def export_model(self, path, class_name, name_space, param_file = None, variable_params = ()):
         if not self.has_model():
             raise NameError('No model loaded')
+        # profiling counters are plain globals, updated from every thread calling f() and g()
+        if self.use_profiling and (self.use_shared_library or self.use_multi_sample):
+            raise ValueError('Profiling counters: not supported with the shared library '
+                             'and multi-sample driver (threads).')
+        self.set_frozen_params(param_file, variable_params)
         self.write_xml(path, class_name)
         self.write_header(path, class_name, name_space)
         self.write_cpp(path, class_name, name_space)
+        if self.use_benchmark:
+            self.write_benchmark(path, class_name, name_space)
+        if self.use_shared_library:
+            self.write_shared_library(path, class_name, name_space)
+        if self.use_multi_sample:
+            self.write_multi_sample(path, class_name, name_space)
         return
 
 # sbmlconverter supporting functions
@@ -291,6 +398,250 @@ def print_event_triggers(self):
 
 sbmlConverter.print_event_triggers = print_event_triggers
 
+# strongly connected species blocks, in block triangular order
+def print_species_blocks(self):
+    message = 'Species blocks ({}, largest: {}):\n'.format(len(self.speciesBlocks),
+        max((len(b) for b in self.speciesBlocks), default = 0))
+    for k, b in enumerate(self.speciesBlocks):
+        message += '{}: {}\n'.format(k, ', '.join(self.variable_name_string(sid) for sid in b))
+    return message
+
+sbmlConverter.print_species_blocks = print_species_blocks
+
+# counters written by code exported with use_profiling, built with -DQSP_PROFILE.
+# returns one entry per counter, most time consuming first
+def read_profile(self, filename):
+    model = self.model
+    # generated trigger components: root-finding ones first (write_cpp)
+    triggerOrder = sorted(range(len(self.allTriggers)), key = lambda i: self.triggerCompTime[i] is not None)
+    entries = []
+    with open(filename) as f:
+        f.readline()
+        for line in f:
+            t, i, count, seconds = line.strip().split(',')
+            i = int(i)
+            if t == 'rule':
+                sid = model.getRule(i).getVariable()
+                name = self.variable_name_string(sid)
+                notes = self.note_to_string(model.getElementBySId(sid).getNotes())
+            elif t == 'flux':
+                r = model.getReaction(i)
+                sid = r.getId()
+                name = 'ReactionFlux{}'.format(i+1) + (': ' + r.getName() if r.getName() else '')
+                notes = self.note_to_string(r.getNotes())
+            elif t == 'trigger':
+                k = triggerOrder[i]
+                sid = ','.join(model.getEvent(j).getId() for j, m in enumerate(self.eventToTrigger) if k in m)
+                name = self.general_translator.mathToString(self.allTriggers[k])
+                notes = ''
+            else:
+                e = model.getEvent(i)
+                sid = e.getId()
+                name = e.getName()
+                notes = self.note_to_string(e.getNotes())
+            entries.append({'type': t, 'index': i, 'sid': sid, 'name': name, 'notes': notes,
+                            'count': int(count), 'seconds': float(seconds)})
+    entries.sort(key = lambda e: e['seconds'], reverse = True)
+    return entries
+
+def print_profile(self, filename, top = 20):
+    entries = self.read_profile(filename)
+    total = sum(e['seconds'] for e in entries) or 1
+    message = 'Profile ({}, top {} of {}):\n'.format(filename, min(top, len(entries)), len(entries))
+    for e in entries[:top]:
+        message += '{:>5.1f}% {:>12} {:<8} {} ({})\n'.format(100*e['seconds']/total, e['count'],
+                                                          e['type'], e['name'], e['sid'])
+    return message
+
+sbmlConverter.read_profile = read_profile
+sbmlConverter.print_profile = print_profile
+
+# Jacobian spectra along a reference trajectory (stiffness analysis).
+# param_file: parameter file of the reference simulation.
+# trajectory_file: output of a simulation (t, species in original units) with all species in y;
+# if None, the NumPy rhs is integrated with scipy (BDF) from the parameter file, without events.
+# analytic: analytic Jacobian instead of difference quotients of the NumPy rhs.
+# times in days, eigenvalues in 1/day
+def analyze_stiffness(self, param_file, trajectory_file = None, nr_sample = 20, analytic = False):
+    if not self.has_model():
+        raise NameError('No model loaded')
+    if self.use_hybrid or self.moieties:
+        raise ValueError('Stiffness analysis: hybrid models and moiety reduction are not supported.')
+    m = types.ModuleType(self.model.getId() + '_np')
+    exec(getNumpyModuleContent(self.model, self.assignmentRuleOrder, self.assignmentRuleOrderIA,
+                               self.initialAssignmentOrder, self.speciesStoichiometry, self.convert_unit,
+                               self.key2var, self.key2name, self.varlist, self.variable_name_string,
+                               None, self.arGraph if analytic else None), m.__dict__)
+    time_scale = 86400 if self.convert_unit else 1
+    V = np.array(pb.xml_to_values(ET.parse(param_file).getroot(), pb.get_layout(self.param_root)))
+    reltol, abstol = V[self.param_id_reltol], V[self.param_id_abstol]
+    t_start, t_step, n_step = V[0], V[1], int(V[2])
+    Y0, P = m.init(V)
+    atol = abstol * m.Y_SCALING
+    nrStepReference = None
+    if trajectory_file:
+        with open(trajectory_file) as f:
+            header = f.readline().strip().split(',')
+        data = np.loadtxt(trajectory_file, delimiter = ',', skiprows = 1, ndmin = 2)
+        missing = [s for s in m.SPECIES if s not in header]
+        if missing:
+            raise ValueError('Trajectory file: species missing: {}'.format(', '.join(missing)))
+        idx = np.unique(np.linspace(0, len(data) - 1, nr_sample).round().astype(int))
+        T = data[idx, 0]
+        Y = data[idx][:, [header.index(s) for s in m.SPECIES]] * m.Y_SCALING
+    else:
+        from scipy.integrate import solve_ivp
+        jac = (lambda t, y, P: m.jac(t, y[None], P)[0]) if analytic else None
+        sol = solve_ivp(m.f_ivp, (t_start * time_scale, (t_start + t_step * n_step) * time_scale), Y0[0],
+                        method = 'BDF', dense_output = True, args = (P,), rtol = reltol, atol = atol, jac = jac)
+        if not sol.success:
+            raise ValueError('Reference integration failed: {}'.format(sol.message))
+        nrStepReference = len(sol.t) - 1
+        T = np.linspace(sol.t[0], sol.t[-1], nr_sample)
+        Y = sol.sol(T).T
+    ns, n = Y.shape
+    Ps = np.repeat(P, ns, axis = 0)
+    if analytic:
+        J = m.jac(T, Y, Ps)
+    else:
+        # forward differences, all samples and columns in one call
+        h = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(Y), atol)
+        Yh = np.repeat(Y[:, None, :], n + 1, axis = 1)
+        Yh[:, 1:, :] += h[:, :, None] * np.eye(n)
+        F = m.f(np.repeat(T, n + 1), Yh.reshape(-1, n), np.repeat(Ps, n + 1, axis = 0)).reshape(ns, n + 1, n)
+        J = np.transpose((F[:, 1:, :] - F[:, :1, :]) / h[:, :, None], (0, 2, 1))
+    if not np.all(np.isfinite(J)):
+        raise ValueError('Jacobian not finite at t = {}'.format(T[~np.all(np.isfinite(J), axis = (1, 2))] / time_scale))
+    return {'t': T / time_scale, 'eigenvalues': np.linalg.eigvals(J) * time_scale,
+            'pattern': np.any(J != 0, axis = 0) | np.eye(n, dtype = bool),
+            'species': m.SPECIES, 'scaling': m.Y_SCALING,
+            'max_value': np.max(np.abs(Y), axis = 0) / m.Y_SCALING,
+            'reltol': reltol, 'abstol': abstol, 't_step': t_step, 't_span': t_step * n_step,
+            'nr_step_reference': nrStepReference}
+
+# flops of one LU factorization: dense, diagonal blocks of the species blocks, sparse (COLAMD order)
+def getLUCost(pattern, blocks):
+    n = len(pattern)
+    cost = {'dense': 2 * n**3 / 3, 'block': sum(2 * len(b)**3 / 3 for b in blocks) or 2 * n**3 / 3}
+    try:
+        import scipy.sparse as sps
+        from scipy.sparse.linalg import splu
+    except ImportError:
+        return cost
+    A = sps.csc_matrix(pattern * np.random.default_rng(0).uniform(1, 2, pattern.shape) + n * np.eye(n))
+    lu = splu(A, permc_spec = 'COLAMD', diag_pivot_thresh = 0)
+    nrL = np.diff(lu.L.tocsc().indptr) - 1
+    nrU = np.diff(lu.U.tocsr().indptr) - 1
+    cost['sparse'] = float(np.sum(2 * nrL * nrU + nrL))
+    return cost
+
+def print_stiffness(self, param_file, trajectory_file = None, nr_sample = 20, analytic = False):
+    r = self.analyze_stiffness(param_file, trajectory_file, nr_sample, analytic)
+    lam, t = r['eigenvalues'], r['t']
+    n = lam.shape[1]
+    rho = np.max(np.abs(lam), axis = 1)
+    decay = -lam.real
+    fast = np.max(decay, axis = 1)
+    slow = np.array([np.min(d[d > 1e-12 * max(fd, 1e-300)], initial = np.inf) for d, fd in zip(decay, fast)])
+    # explicit (Adams) steps limited by stability: h * rho <= 2
+    nrExplicit = np.sum(np.diff(t) * (rho[1:] + rho[:-1])) / 4 if len(t) > 1 else rho[0] * r['t_span'] / 2
+    stiff = np.max(rho) * r['t_step'] > 100
+    message = 'Stiffness ({} samples, {} Jacobian, t = {:g} to {:g} days):\n'.format(
+        len(t), 'analytic' if analytic else 'difference quotient', t[0], t[-1])
+    message += '{:>10} {:>12} {:>12} {:>12} {:>12}\n'.format('t', 'max|lambda|', 'max -Re', 'min -Re', 'ratio')
+    for k in range(len(t)):
+        message += '{:>10.4g} {:>12.4g} {:>12.4g} {:>12.4g} {:>12.4g}\n'.format(
+            t[k], rho[k], fast[k], slow[k], fast[k] / slow[k] if np.isfinite(slow[k]) else np.inf)
+    message += 'Explicit steps required for stability: {:.3g}'.format(nrExplicit)
+    if r['nr_step_reference'] is not None:
+        message += ' (reference BDF: {} steps)'.format(r['nr_step_reference'])
+    message += '\n\nRecommendation:\n'
+    if stiff:
+        message += 'Method: BDF with Newton iteration (CV_BDF, as in CVODEBase::setupCVODE).\n'
+        if r['nr_step_reference']:
+            message += '    estimated speedup over Adams: {:.3g}x (steps)\n'.format(
+                nrExplicit / r['nr_step_reference'])
+    else:
+        message += 'Method: Adams with fixed-point iteration (CV_ADAMS): no Jacobian or linear solver needed.\n'
+    # linear solver
+    pattern = r['pattern']
+    cost = getLUCost(pattern, self.speciesBlocks)
+    current = 'sparse' if self.use_sparse_jacobian else 'block' if self.use_block_order else 'dense'
+    # KLU: about twice the cost per flop of dense LU
+    weighted = {k: c * (2 if k == 'sparse' else 1) for k, c in cost.items()}
+    best = min(weighted, key = weighted.get)
+    options = {'dense': 'dense (default)', 'block': 'block triangular (use_block_order)',
+               'sparse': 'sparse KLU (use_sparse_jacobian, -DQSP_USE_KLU)'}
+    message += 'Linear solver: {} (nnz {} of {}, {:.1f}%; LU flops: {})\n'.format(
+        options[best], int(pattern.sum()), n * n, 100 * pattern.sum() / n**2,
+        ', '.join('{} {:.3g}'.format(k, c) for k, c in cost.items()))
+    if best != current:
+        message += '    estimated speedup per factorization over current ({}): {:.3g}x\n'.format(
+            current, weighted[current] / weighted[best])
+    if not self.use_jacobian:
+        message += '    analytic Jacobian (use_jacobian) saves {} rhs evaluations per Jacobian\n'.format(n)
+    # weakly damped oscillations shorter than the output interval
+    osc = np.abs(lam.imag) > np.abs(lam.real)
+    periods = 2 * np.pi / np.abs(lam.imag[osc]) if np.any(osc) else np.array([])
+    periods = periods[periods < r['t_step']]
+    if len(periods):
+        message += 'Maximum step: {:.3g} days (weakly damped oscillation, period {:.3g} days)\n'.format(
+            periods.min() / 10, periods.min())
+    else:
+        message += 'Maximum step: not needed (no weakly damped mode faster than the output interval {:g} days)\n'.format(
+            r['t_step'])
+    if np.max(1 / slow[np.isfinite(slow)], initial = 0) > r['t_span']:
+        message += 'Slowest time scale {:.3g} days exceeds the simulated time\n'.format(
+            np.max(1 / slow[np.isfinite(slow)]))
+    # absolute tolerance larger than the relative error allowed at the species peak
+    message += '\nBadly scaled species (abstol {:g}, reltol {:g}, original units):\n'.format(r['abstol'], r['reltol'])
+    flagged = [i for i in range(n) if 0 < r['max_value'][i] and r['reltol'] * r['max_value'][i] < r['abstol']]
+    for i in sorted(flagged, key = lambda i: r['max_value'][i]):
+        message += '{}: max {:.3g}{}, scaling_SI {:g}, abstol should be <= {:.3g}\n'.format(
+            r['species'][i], r['max_value'][i], ' (below abstol)' if r['max_value'][i] < r['abstol'] else '',
+            r['scaling'][i], r['reltol'] * r['max_value'][i])
+    if not flagged:
+        message += 'none\n'
+    return message
+
+sbmlConverter.analyze_stiffness = analyze_stiffness
+sbmlConverter.print_stiffness = print_stiffness
+
+# parameters fixed at export: values from a reference parameter file,
+# except for variable_params, sensitivity parameters, hybrid elements
+# and parameters set by initial assignments
+def set_frozen_params(self, param_file, variable_params = ()):
+    self.frozenParams = {}
+    if param_file is None:
+        return
+    if self.use_ensemble:
+        raise ValueError('Frozen parameters: ensemble class is not supported.')
+    for sid in variable_params:
+        if sid not in self.key2var or self.key2var[sid]['vartype'] != 'p_const':
+            raise ValueError('Variable parameter {}: not a constant parameter.'.format(sid))
+    variable = set(variable_params) | set(self.sensitivityParams) | set(self.hybrid_elements)
+    # set by initial assignments
+    variable |= {self.model.getInitialAssignment(i).getSymbol()
+                 for i in range(self.model.getNumInitialAssignments())}
+    # values in order of parameter file index (build_param_element_tree)
+    root = ET.parse(param_file).getroot()
+    values = []
+    for e in self.param_root.iter():
+        if len(e):
+            continue
+        path = '/'.join([a.tag for a in reversed(list(e.iterancestors()))][1:] + [e.tag])
+        ref = root.find(path)
+        if ref is None:
+            raise ValueError('Reference parameter file: {} not found.'.format(path))
+        values.append(float(ref.text))
+    for sid in self.varlist['p_const']:
+        if sid not in variable:
+            e = self.key2name[sid]
+            self.frozenParams[sid] = values[e['init_id']] * e['scaling_use']
+    return
+
+sbmlConverter.set_frozen_params = set_frozen_params
+
 #%
 def process_variables(self):
     #assignment hierarchy: 
@@ -328,6 +679,15 @@ def process_variables(self):
     self.assignmentRuleOrderTrigger = [i for i in self.assignmentRuleOrder if i in triggerVarWithDep]    
     eaVarWithDep = {j for i in self.eaVars for j in self.arGraph.getDependent(i)}
     self.assignmentRuleOrderEA = [i for i in self.assignmentRuleOrder if i in eaVarWithDep]
+    # sliced per event: rules needed by its assignments
+    self.assignmentRuleOrderEvent = [getAssignmentRulesRequiredForMath(
+        model, [ea.getMath() for ea in e.getListOfEventAssignments()],
+        self.assignmentRuleOrder, self.arGraph) for e in model.getListOfEvents()]
+    # rules live in rhs evaluation: used by kinetic laws or compartment scaling
+    reactionVars = getAssignmentRulesRequiredForReactions(self.model, self.speciesStoichiometry,
+                                                          self.convert_unit)
+    reactionVarWithDep = {j for i in reactionVars for j in self.arGraph.getDependent(i)}
+    self.assignmentRuleOrderReaction = [i for i in self.assignmentRuleOrder if i in reactionVarWithDep]
     
     # variables dependent on assignment rule
     #print("extra species order")
@@ -338,7 +698,8 @@ def process_variables(self):
     extraSpecVars = set()
     for sp in model.getListOfSpecies():
         sid = sp.getId()
-        if sid not in self.speciesStoichiometry and sid in idxAssignmentRule:
+        if sid not in self.speciesStoichiometry and sid in idxAssignmentRule and \
+            (not self.variable_output or sid in self.variable_output):
             extraSpecVars.add(idxAssignmentRule[sid])
     extraSpecVarWithDep = {j for i in extraSpecVars for j in self.arGraph.getDependent(i)}
     self.assignmentRuleOrderExtraSpec = [i for i in self.assignmentRuleOrder if i in extraSpecVarWithDep]    
@@ -350,6 +711,71 @@ def process_variables(self):
     self.key2var, self.varlist, self.key2var_0 = checkVariables(self.model, self.key2name, self.speciesStoichiometry, 
                                          self.triggerVars, self.eaVars, self.variable_modifiable)
     
+    # parameters for forward sensitivity, in order of p_const
+    self.sensitivityParams = []
+    if self.use_sensitivity:
+        # initial sensitivities are zero
+        iaNames = getInitialAssignmentNames(model, self.assignmentRuleOrderIA)
+        for sid in self.sensitivity_params:
+            if sid not in self.key2var or self.key2var[sid]['vartype'] != 'p_const':
+                raise ValueError('Sensitivity parameter {}: not a constant parameter.'.format(sid))
+            if sid in iaNames:
+                raise ValueError('Sensitivity parameter {}: used in initial assignments, not supported.'.format(sid))
+        self.sensitivityParams = sorted(self.sensitivity_params, key = lambda x: self.key2var[x]['idx'])
+
+    # ensemble members have their own parameters, not shared by the class
+    if self.use_ensemble and (self.use_hybrid or self.sensitivityParams):
+        raise ValueError('Ensemble class: hybrid models and sensitivity are not supported.')
+
+    # species output order, before removing conserved moieties from y
+    self.speciesOutputOrder = self.varlist['sp_var'] + self.varlist['sp_other']
+    if self.variable_output:
+        if self.use_hybrid or self.sensitivityParams:
+            raise ValueError('Output selection: hybrid models and sensitivity are not supported.')
+        for sid in self.variable_output:
+            if sid not in self.speciesOutputOrder:
+                raise ValueError('Output variable {}: not a species.'.format(sid))
+        self.speciesOutputOrder = [sid for sid in self.speciesOutputOrder if sid in self.variable_output]
+    if int(self.output_stride) < 1:
+        raise ValueError('Output stride: must be a positive integer.')
+    self.moieties = []
+    if self.use_moiety_reduction:
+        if self.use_hybrid or self.sensitivityParams or self.use_ensemble:
+            raise ValueError('Moiety reduction: hybrid models, sensitivity and ensemble class are not supported.')
+        # totals only hold between events: species assigned by events are excluded.
+        # amount is y times a constant compartment.
+        eaTargets = {ea.getVariable() for e in model.getListOfEvents()
+                     for ea in e.getListOfEventAssignments()}
+        species = [sid for sid in self.varlist['sp_var'] if sid not in eaTargets and 
+                   (not self.convert_unit or model.getSpecies(sid).getHasOnlySubstanceUnits() or
+                    self.key2var.get(model.getSpecies(sid).getCompartment(), {}).get('vartype') == 'p_const')]
+        # species removed from y are only computed in f(), Jac() and update_y_other()
+        maths = list(self.allTriggers)
+        maths += [model.getRule(i).getMath() for i in 
+                  self.assignmentRuleOrderTrigger + self.assignmentRuleOrderEA]
+        for e in model.getListOfEvents():
+            if e.isSetDelay():
+                maths.append(e.getDelay().getMath())
+            maths += [ea.getMath() for ea in e.getListOfEventAssignments()]
+        fixed = {n for m in maths for n in get_variable_names_from_astnodes(m)}
+        fixed |= getInitialAssignmentNames(model, self.assignmentRuleOrderIA)
+        fixed |= {model.getInitialAssignment(i).getSymbol() for i in range(model.getNumInitialAssignments())}
+        candidates = {sid for sid in species if sid not in fixed}
+        self.moieties = getConservedMoieties(model, species, candidates, self.speciesStoichiometry)
+        reduceConservedMoieties(self.key2var, self.varlist, self.moieties)
+
+    # block triangular structure of the species interaction graph
+    self.speciesBlocks = getSpeciesBlocks(model, self.assignmentRuleOrder, self.speciesStoichiometry,
+                                          self.convert_unit, self.key2var, self.moieties)
+    if self.use_block_order:
+        if self.use_hybrid or self.sensitivityParams or self.use_ensemble:
+            raise ValueError('Block order: hybrid models, sensitivity and ensemble class are not supported.')
+        reorderSpeciesBlocks(self.key2var, self.varlist, self.speciesBlocks)
+    if int(self.rhs_table_threshold) < 1:
+        raise ValueError('Table rhs threshold: must be a positive integer.')
+    self.rhs_table_nnz = getRhsTableNNZ(self.speciesStoichiometry, self.key2var)
+    self.use_rhs_table = self.rhs_table_nnz >= int(self.rhs_table_threshold)
+
     #print("Initial condition processing")
     """
     
@@ -360,6 +786,14 @@ def process_variables(self):
     """
     #print("trigger components")       
     self.triggerCompDep = getTriggerComponentDependency(self.model, self.assignmentRuleOrder, self.allTriggers, self.key2var)
+    # time-only components are scheduled as solver stop times, not root-found
+    self.triggerCompTime = getTriggerComponentTime(self.model, self.assignmentRuleOrder, self.allTriggers, self.key2var)
+    # rules live in g(): used by remaining root-finding trigger components
+    rootVars = {idxAssignmentRule[n] for i, t in enumerate(self.allTriggers) 
+                if self.triggerCompDep[i] and self.triggerCompTime[i] is None
+                for n in get_variable_names_from_astnodes(t) if n in idxAssignmentRule}
+    rootVarWithDep = {j for i in rootVars for j in self.arGraph.getDependent(i)}
+    self.assignmentRuleOrderRoot = [i for i in self.assignmentRuleOrder if i in rootVarWithDep]
     return
 
 sbmlConverter.process_variables = process_variables    
@@ -368,7 +802,17 @@ sbmlConverter.process_variables = process_variables
 # write header of model and parameter class
 def write_header(self, path, class_name, name_space):
     with open(path + '/' + '{}.h'.format(class_name), 'w') as file:
-        file.write(getHeaderFileContent(class_name, name_space, self.use_hybrid))
+        file.write(getHeaderFileContent(class_name, name_space, self.use_hybrid,
+                                        self.use_jacobian, self.use_sparse_jacobian,
+                                        len(self.sensitivityParams), len(self.moieties),
+                                        self.speciesOutputOrder != self.varlist['sp_var'] + self.varlist['sp_other'],
+                                        len(self.speciesBlocks) if self.use_block_order else 0,
+                                        len(self.speciesOutputOrder) if self.variable_output else 0,
+                                        int(self.output_stride),
+                                        self.use_shared_library or self.use_multi_sample))
+    if self.use_ensemble:
+        with open(path + '/' + '{}_ensemble.h'.format(class_name), 'w') as file:
+            file.write(getEnsembleHeaderContent(class_name + '_ensemble', name_space))
     with open(path + '/' + 'Param.h', 'w') as file:
         file.write(getParamHeaderContent(name_space))
     return
@@ -384,10 +828,15 @@ def write_cpp(self, path, class_name, name_space):
                    'nsp_var': 'NSPVAR',
                    'p_const': 'PARAM'}
                    
+    # parameters fixed at export: compile time constants in all functions
+    frozenIdx = {sid: k for k, sid in enumerate(self.frozenParams)}
+
     # mainly for initialization
     def cppMemberVariable(varName):
         if varName == LC_TIME_NAME:
             return ODE_TIME_NAME
+        elif varName in frozenIdx:
+            return '_frozen_parameter[{}]'.format(frozenIdx[varName])
         elif varName in self.key2var:
             tmp = '{}[{}]'.format(vartype2CppMember[self.key2var[varName]['vartype']],
                                 self.key2var[varName]['idx'])
@@ -400,6 +849,8 @@ def write_cpp(self, path, class_name, name_space):
     def cppInSimVariable(varName):
         if varName == LC_TIME_NAME:
             return ODE_TIME_NAME
+        elif varName in frozenIdx:
+            return '_frozen_parameter[{}]'.format(frozenIdx[varName])
         elif varName in self.key2var:
             if self.key2var[varName]['vartype'] == 'sp_var':
                 return 'NV_DATA_S(_y)[{}]'.format(self.key2var[varName]['idx'])
@@ -415,6 +866,8 @@ def write_cpp(self, path, class_name, name_space):
     def cppStaticVariable(varName):
         if varName == LC_TIME_NAME:
             return ODE_TIME_NAME
+        elif varName in frozenIdx:
+            return '_frozen_parameter[{}]'.format(frozenIdx[varName])
         elif varName in self.key2var:
             tmp = '{}({})'.format(vartype2CppStatic[self.key2var[varName]['vartype']],
                                 self.key2var[varName]['idx'])
@@ -427,65 +880,249 @@ def write_cpp(self, path, class_name, name_space):
     translatorInSim = AstTranslator(cppInSimVariable, ASTNameToCppToken)
     translatorStatic = AstTranslator(cppStaticVariable, ASTNameToCppToken)
 
-    with open(path + '/'  + '{}.cpp'.format(class_name),'w') as cppfile:
-        v = getSourceFileMacro(class_name)
-        v += 'namespace {}{{\n'.format(name_space)
-        cppfile.write(v)
-
-        v = getSourceFileConstructor(class_name, self.use_hybrid, 1-self.hybrid_abm_weight)
-        cppfile.write(v)
-        v =  getSourceFileInitSolver(class_name)
-        cppfile.write(v)
-        v = getSourceFileStaticParam(class_name, self.key2name, self.key2var, 
-                                         self.varlist, self.hybrid_elements,
-                                         self.variable_name_string)
-        cppfile.write(v)
-        v =  getSourceFileVariableSetup(class_name, self.model, self.key2name, self.key2var, 
-                                         self.varlist, self.param_id_reltol, self.param_id_abstol,
-                                        self.hybrid_elements, self.variable_name_string)
-        cppfile.write(v)
-
-        v = getSourceFileInitialAssginment(class_name, self.model, self.varlist, self.key2var, 
-                                         self.key2name, ODE_TIME_NAME,
-                              self.assignmentRuleOrderIA, self.assignmentRuleOrder, 
-                              self.initialAssignmentOrder, translatorMember)
-        cppfile.write(v)
-        
-        v = getSourceFileEventSetup(class_name, self.model, self.allTriggers, 
-                                       self.triggerParser, self.general_translator)
-        cppfile.write(v)
-        v = getSourceFileReaction(class_name, self.model, self.assignmentRuleOrder, 
-                                  self.speciesStoichiometry, self.convert_unit, 
-                                  self.key2var, self.hybrid_elements, 
-                                  translatorStatic, self.variable_name_string)
-        cppfile.write(v)
-        v = getSourceFileEventDetails(class_name, self.model, self.allTriggers, self.triggerCompDep, self.eventToTrigger,
-                                      self.assignmentRuleOrderTrigger, self.assignmentRuleOrderEA,
-                                      self.general_translator, translatorStatic, 
-                                      translatorInSim, translatorMember, 
-                                      self.triggerParser)
-        cppfile.write(v)
-        
-        v = getSourceFileHandleOutput(class_name, self.model, self.varlist, self.key2name, 
-                                        translatorInSim, self.general_translator,
-                                        self.assignmentRuleOrderExtraSpec)
-        cppfile.write(v)
-        v = '\n};\n'
-        cppfile.write(v)
+    cse = CommonSubexpressionEliminator() if self.use_cse else None
+    # repeated bases in power expansion are only cheap if eliminated later
+    simplifier = AstSimplifier(self.use_cse) if self.use_simplify else None
+
+    # trigger components: root-finding ones first, followed by time-only ones
+    triggerOrder = sorted(range(len(self.allTriggers)), key = lambda i: self.triggerCompTime[i] is not None)
+    triggerIdx = {k: n for n, k in enumerate(triggerOrder)}
+    allTriggers = [self.allTriggers[k] for k in triggerOrder]
+    triggerCompDep = [self.triggerCompDep[k] for k in triggerOrder]
+    triggerCompTime = [self.triggerCompTime[k] for k in triggerOrder]
+    eventToTrigger = [[triggerIdx[k] for k in m] for m in self.eventToTrigger]
+
+    # events assigning species change y
+    yEvents = {i for i, e in enumerate(self.model.getListOfEvents())
+               if any(ea.getVariable() in self.key2var and
+                      self.key2var[ea.getVariable()]['vartype'] == 'sp_var'
+                      for ea in e.getListOfEventAssignments())}
+    # and update the sensitivities
+    sensitivityEvents = yEvents if self.sensitivityParams else set()
+    # the solver is reinitialized after events changing y, rhs or root functions;
+    # otherwise its problem is unchanged and it keeps its step size history
+    model = self.model
+    solverMaths = [r.getKineticLaw().getMath() for r in model.getListOfReactions()]
+    solverMaths += [model.getRule(i).getMath() for i in 
+                    self.assignmentRuleOrderReaction + self.assignmentRuleOrderRoot]
+    solverMaths += [trigger for i, trigger in enumerate(allTriggers)
+                    if triggerCompTime[i] is None and triggerCompDep[i]]
+    solverNames = {n for m in solverMaths for n in get_variable_names_from_astnodes(m)}
+    solverNames |= {getReactionFluxCompartment(model, i, self.convert_unit)
+                    for i in range(model.getNumReactions())}
+    solverNames |= {model.getSpecies(sid).getCompartment() for sid in self.speciesStoichiometry}
+    reinitEvents = yEvents | {i for i, e in enumerate(model.getListOfEvents())
+                              if any(ea.getVariable() in solverNames
+                                     for ea in e.getListOfEventAssignments())}
+
+    profile = None
+    if self.use_profiling:
+        profile = getProfileSlots(self.model, self.assignmentRuleOrderReaction,
+                                  sum(1 for c in triggerCompTime if c is None))
+
+    # sections of {class_name}.cpp, in order, with the translation unit they go to
+    # when the source is split (SPLIT_SOURCE_UNITS; '': {class_name}.cpp itself)
+    sections = []
+    sections.append(('', getSourceFileConstructor(class_name, self.use_hybrid, 1-self.hybrid_abm_weight,
+                                                  not self.use_split_source)))
+    sections.append(('', getSourceFileInitSolver(class_name)))
+    v = getSourceFileStaticParam(class_name, self.key2name, self.key2var, 
+                                     self.varlist, self.hybrid_elements,
+                                     self.variable_name_string, self.use_simplify, frozenIdx,
+                                     self.use_shared_library or self.use_multi_sample)
+    sections.append(('param', v))
+    v =  getSourceFileVariableSetup(class_name, self.model, self.key2name, self.key2var, 
+                                     self.varlist, self.param_id_reltol, self.param_id_abstol,
+                                    self.hybrid_elements, self.variable_name_string,
+                                    self.use_simplify, self.moieties)
+    sections.append(('param', v))
+
+    v = getSourceFileInitialAssginment(class_name, self.model, self.varlist, self.key2var, 
+                                     self.key2name, ODE_TIME_NAME,
+                          self.assignmentRuleOrderIA, self.assignmentRuleOrder, 
+                          self.initialAssignmentOrder, translatorMember,
+                          self.convert_unit, self.moieties)
+    sections.append(('init', v))
+    
+    v = getSourceFileEventSetup(class_name, self.model, allTriggers, triggerCompTime,
+                                   self.triggerParser, self.general_translator)
+    sections.append(('events', v))
+    v = getSourceFileReaction(class_name, self.model, self.assignmentRuleOrderReaction, 
+                              self.speciesStoichiometry, self.convert_unit, 
+                              self.key2var, self.hybrid_elements, 
+                              translatorStatic, self.variable_name_string, cse, simplifier,
+                              self.moieties, profile, self.use_rhs_table)
+    sections.append(('rhs', v))
+    if self.use_sparse_jacobian:
+        v = getSourceFileJacobianSparse(class_name, self.model, self.assignmentRuleOrder, self.arGraph,
+                                        self.speciesStoichiometry, self.convert_unit,
+                                        self.key2var, self.varlist, self.hybrid_elements,
+                                        translatorStatic, self.variable_name_string, self.moieties)
+        sections.append(('rhs', v))
+    elif self.use_jacobian:
+        v = getSourceFileJacobian(class_name, self.model, self.assignmentRuleOrder, self.arGraph,
+                                  self.speciesStoichiometry, self.convert_unit,
+                                  self.key2var, self.hybrid_elements,
+                                  translatorStatic, self.variable_name_string, self.moieties)
+        sections.append(('rhs', v))
+    if self.use_block_order:
+        v = getSourceFileJacobianBlocks(class_name, self.speciesBlocks)
+        sections.append(('rhs', v))
+    if self.sensitivityParams:
+        v = getSourceFileSensitivity(class_name, self.model, self.assignmentRuleOrder, self.arGraph,
+                                     self.speciesStoichiometry, self.convert_unit,
+                                     self.key2var, self.varlist, self.key2name, self.hybrid_elements,
+                                     self.sensitivityParams, translatorStatic, translatorInSim,
+                                     self.variable_name_string)
+        sections.append(('rhs', v))
+    v = getSourceFileEventDetails(class_name, self.model, allTriggers, triggerCompDep, eventToTrigger,
+                                  triggerCompTime, self.assignmentRuleOrderRoot,
+                                  self.assignmentRuleOrderTrigger, self.assignmentRuleOrderEvent,
+                                  self.general_translator, translatorStatic, 
+                                  translatorInSim, translatorMember, 
+                                  self.triggerParser, cse, simplifier, sensitivityEvents,
+                                  reinitEvents, profile)
+    sections.append(('events', v))
+    
+    v = getSourceFileHandleOutput(class_name, self.model, self.varlist, self.key2name, 
+                                    translatorInSim, self.general_translator,
+                                    self.assignmentRuleOrderExtraSpec, self.convert_unit,
+                                    self.moieties, self.speciesOutputOrder)
+    sections.append(('', v))
+
+    # files of an earlier split export, listed in its Makefile fragment, would be built twice
+    fragment = path + '/' + '{}_sources.mk'.format(class_name)
+    if not self.use_split_source and os.path.exists(fragment):
+        for filename in getSplitSourceFiles(class_name)[1:]:
+            if os.path.exists(path + '/' + filename):
+                os.remove(path + '/' + filename)
+        os.remove(fragment)
+
+    if self.use_split_source:
+        with open(path + '/' + '{}_internal.h'.format(class_name), 'w') as hfile:
+            hfile.write(getSplitSourceHeader(class_name, name_space, profile, self.use_hybrid,
+                                             getSourceFileFrozenParam(self.frozenParams, self.key2name,
+                                                                      self.key2var, self.variable_name_string)
+                                             if self.frozenParams else ''))
+        for unit in SPLIT_SOURCE_UNITS:
+            with open(path + '/' + getSplitSourceName(class_name, unit), 'w') as cppfile:
+                v = '#include "{}_internal.h"\n\n'.format(class_name)
+                v += 'namespace {}{{\n'.format(name_space)
+                cppfile.write(v)
+                if unit == '':
+                    if profile:
+                        cppfile.write(getSourceFileProfile(profile, 'definition'))
+                    if self.use_hybrid:
+                        cppfile.write('\ndouble {0}::_QSP_weight = {1};\n'.format(
+                            class_name, 1-self.hybrid_abm_weight))
+                for (u, v) in sections:
+                    if u == unit:
+                        cppfile.write(v)
+                cppfile.write('\n};\n')
+        with open(fragment, 'w') as file:
+            file.write(getSplitSourceMakefile(class_name))
+    else:
+        with open(path + '/'  + '{}.cpp'.format(class_name),'w') as cppfile:
+            v = getSourceFileMacro(class_name)
+            if profile:
+                v += getSourceFileProfileInclude()
+            v += 'namespace {}{{\n'.format(name_space)
+            cppfile.write(v)
+            if profile:
+                cppfile.write(getSourceFileProfile(profile))
+            if self.frozenParams:
+                v = getSourceFileFrozenParam(self.frozenParams, self.key2name, self.key2var,
+                                             self.variable_name_string)
+                cppfile.write(v)
+            for (u, v) in sections:
+                cppfile.write(v)
+            v = '\n};\n'
+            cppfile.write(v)
+
+    if self.use_ensemble:
+        ensemble_name = class_name + '_ensemble'
+        with open(path + '/'  + '{}.cpp'.format(ensemble_name),'w') as cppfile:
+            v = getSourceFileEnsembleMacro(ensemble_name, self.model, self.varlist, triggerCompTime)
+            v += 'namespace {}{{\n'.format(name_space)
+            cppfile.write(v)
+            v = getSourceFileEnsembleSetup(ensemble_name, self.model, self.key2name, self.key2var,
+                                           self.varlist, allTriggers, triggerCompTime,
+                                           self.param_id_reltol, self.param_id_abstol,
+                                           self.assignmentRuleOrderIA, self.initialAssignmentOrder,
+                                           self.triggerParser, translatorStatic,
+                                           self.variable_name_string, self.use_simplify)
+            cppfile.write(v)
+            v = getSourceFileEnsembleRhs(ensemble_name, self.model, self.assignmentRuleOrder, self.arGraph,
+                                         self.assignmentRuleOrderReaction, self.speciesStoichiometry,
+                                         self.convert_unit, self.key2var, self.varlist,
+                                         translatorStatic, self.variable_name_string,
+                                         CommonSubexpressionEliminator() if self.use_cse else None,
+                                         simplifier, self.use_rhs_table)
+            cppfile.write(v)
+            v = getSourceFileEnsembleEvents(ensemble_name, self.model, allTriggers, triggerCompDep,
+                                            eventToTrigger, triggerCompTime, self.assignmentRuleOrderRoot,
+                                            self.assignmentRuleOrderTrigger, self.assignmentRuleOrderEvent,
+                                            translatorStatic, self.triggerParser, simplifier, reinitEvents)
+            cppfile.write(v)
+            v = getSourceFileEnsembleOutput(ensemble_name, self.model, self.varlist, self.key2name,
+                                            translatorStatic, self.variable_name_string,
+                                            self.assignmentRuleOrderExtraSpec)
+            cppfile.write(v)
+            cppfile.write('\n};\n')
 
     with open(path + '/'  + 'Param.cpp','w') as cppfile:
         v = getParamSourceConetent(name_space, self.model, self.key2name)
         cppfile.write(v)
+    self.cse_report = cse.getReport() if cse else ''
     return
 
 def write_xml(self, path, class_name):
     with open(path + '/' + class_name+'_params.xml', 'w') as file:
         file.write('<?xml version="1.0" encoding="utf-8"?>\n')
         file.write(ET.tostring(self.param_root, pretty_print = True, encoding='unicode'))
+    # binary image of the same values (paramBinary.py converts between the two)
+    paths = pb.get_layout(self.param_root)
+    pb.write_binary(path + '/' + class_name+'_params.bin', paths, 
+                    pb.xml_to_values(self.param_root, paths))
+    return
+
+def write_benchmark(self, path, class_name, name_space):
+    with open(path + '/' + class_name+'_bench.cpp', 'w') as cppfile:
+        cppfile.write(getBenchmarkSourceContent(class_name, name_space, 
+                                                86400 if self.convert_unit else 1,
+                                                'table' if self.use_rhs_table else 'unrolled'))
+    return
+
+# C interface (<class_name>_capi.cpp) and shared library build script; see qspLibrary.py
+def write_shared_library(self, path, class_name, name_space):
+    if self.use_hybrid:
+        raise ValueError('Shared library: hybrid models are not supported.')
+    with open(path + '/' + class_name+'_capi.cpp', 'w') as cppfile:
+        cppfile.write(getSharedLibrarySourceContent(class_name, name_space,
+                                                    86400 if self.convert_unit else 1,
+                                                    len(self.varlist['p_const'])))
+    script = path + '/' + 'build_{}_lib.sh'.format(class_name)
+    with open(script, 'w') as file:
+        file.write(getSharedLibraryBuildScript(class_name, 
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example', 'cpp', 'QSP_CVODE_Adaptor'),
+            getSplitSourceFiles(class_name)[:-1] if self.use_split_source else ()))
+    os.chmod(script, 0o755)
+    return
+
+def write_multi_sample(self, path, class_name, name_space):
+    if self.use_hybrid:
+        raise ValueError('Multi-sample driver: hybrid models are not supported.')
+    with open(path + '/' + class_name+'_multi.cpp', 'w') as cppfile:
+        cppfile.write(getMultiSampleSourceContent(class_name, name_space,
+                                                  86400 if self.convert_unit else 1,
+                                                  'second' if self.convert_unit else 'day'))
     return
 sbmlConverter.write_header = write_header
 sbmlConverter.write_cpp = write_cpp
 sbmlConverter.write_xml = write_xml
+sbmlConverter.write_benchmark = write_benchmark
+sbmlConverter.write_shared_library = write_shared_library
+sbmlConverter.write_multi_sample = write_multi_sample
 
 #%%
 ############################################################
@@ -680,6 +1317,29 @@ class AstTranslator:
                 name_list += ['unprocessed node, AST_TYPE={}'.format(current.getType())]
         return formula, name_list
 
+"""
+Translate one math AST to a NumPy expression, operating on columns of arrays.
+Elementwise logical operators bind tighter than relational ones in python:
+operands of logical operators are always grouped. Other functions map to the
+NumPy function of the same name (exp, log2, ...), where there is one.
+"""
+class AstTranslatorNumpy(AstTranslator):
+
+    def __init__(self, fname):
+        super().__init__(fname, ASTNameToNumpyToken)
+
+    def nodeFormat(self, current, name_list):
+        name = current.getName()
+        if (current.getNumChildren() > 0 and current.isFunction() and 
+            name not in self.ASTNameToCppToken and hasattr(np, name)):
+            return 'np.' + name, name_list
+        return super().nodeFormat(current, name_list)
+
+    def isGrouped(self, parent, current):
+        if parent and parent.isLogical():
+            return True
+        return super().isGrouped(parent, current)
+
 
 """
 Parse math AST to expression of a Event trigger
@@ -802,6 +1462,480 @@ class EventTriggerParser:
                 print('Unknown relational operator: {}'.format(ro))
         return rel, formula
 
+"""
+Symbolic differentiation of math AST.
+Derivatives are returned as new AST trees, which can be formatted
+with AstTranslator. None is returned in place of a tree when the
+derivative is identically zero.
+New nodes are always binary, so that they are properly handled
+by AstTranslator.nodeVisitGeneral.
+"""
+class AstDifferentiator:
+
+    def __init__(self):
+        self.unaryFunctionDerivative = {
+            lsb.AST_FUNCTION_EXP: self.derivativeExp,
+            lsb.AST_FUNCTION_LN: self.derivativeLn,
+            lsb.AST_FUNCTION_SIN: self.derivativeSin,
+            lsb.AST_FUNCTION_COS: self.derivativeCos,
+            }
+        # functions not interpreted by libSBML, referenced by name
+        self.namedFunctionDerivative = {
+            'log2': lambda u: self.derivativeLog(u, self.number(pymath.log(2))),
+            'log10': lambda u: self.derivativeLog(u, self.number(pymath.log(10))),
+            }
+
+    """
+    partial derivative of math with respect to variable sid 'name'
+    """
+    def derivative(self, math, name):
+        t = math.getType()
+        nrChild = math.getNumChildren()
+        if math.isNumber() or math.isConstantNumber() or t in {lsb.AST_CONSTANT_TRUE,
+                lsb.AST_CONSTANT_FALSE, lsb.AST_NAME_AVOGADRO}:
+            return None
+        elif t == lsb.AST_NAME_TIME:
+            return self.number(1) if name == LC_TIME_NAME else None
+        elif t == lsb.AST_NAME:
+            return self.number(1) if math.getName() == name else None
+        elif math.isRelational() or math.isLogical():
+            # piecewise constant
+            return None
+        elif t == lsb.AST_PLUS:
+            d = None
+            for i in range(nrChild):
+                d = self.plus(d, self.derivative(math.getChild(i), name))
+            return d
+        elif t == lsb.AST_MINUS:
+            d0 = self.derivative(math.getChild(0), name)
+            if nrChild == 1:
+                return self.negate(d0)
+            return self.minus(d0, self.derivative(math.getChild(1), name))
+        elif t == lsb.AST_TIMES:
+            # product rule, n-ary
+            d = None
+            for i in range(nrChild):
+                di = self.derivative(math.getChild(i), name)
+                if di is None:
+                    continue
+                for k in range(nrChild):
+                    if k != i:
+                        di = self.times(di, self.copy(math.getChild(k)))
+                d = self.plus(d, di)
+            return d
+        elif t == lsb.AST_DIVIDE:
+            u = math.getChild(0)
+            v = math.getChild(1)
+            du = self.derivative(u, name)
+            dv = self.derivative(v, name)
+            d = self.divide(du, self.copy(v)) if du is not None else None
+            if dv is not None:
+                # u/v^2*dv
+                d = self.minus(d, self.divide(self.times(self.copy(u), dv),
+                                        self.times(self.copy(v), self.copy(v))))
+            return d
+        elif t in {lsb.AST_POWER, lsb.AST_FUNCTION_POWER}:
+            return self.derivativePower(math.getChild(0), math.getChild(1), name)
+        elif t == lsb.AST_FUNCTION_ROOT:
+            # first child is degree
+            return self.derivativeRoot(math.getChild(1), math.getChild(0), name)
+        elif math.getName() == SBML_FUNCTION_NTHROOT:
+            return self.derivativeRoot(math.getChild(0), math.getChild(1), name)
+        elif t == lsb.AST_FUNCTION_LOG:
+            # log(base, x)
+            base = math.getChild(0) if nrChild == 2 else None
+            u = math.getChild(nrChild - 1)
+            du = self.derivative(u, name)
+            if base is not None and self.derivative(base, name) is not None:
+                raise ValueError('Logarithm with variable base cannot be differentiated: {}'.format(
+                    lsb.formulaToL3String(math)))
+            if du is None:
+                return None
+            if base is None:
+                lnBase = self.number(pymath.log(10))
+            else:
+                lnBase = self.node(lsb.AST_FUNCTION_LN, [self.copy(base)])
+            return self.times(self.derivativeLog(u, lnBase), du)
+        elif t in self.unaryFunctionDerivative or (t == lsb.AST_FUNCTION and
+                                                    math.getName() in self.namedFunctionDerivative):
+            u = math.getChild(0)
+            du = self.derivative(u, name)
+            if du is None:
+                return None
+            if t in self.unaryFunctionDerivative:
+                return self.times(self.unaryFunctionDerivative[t](u), du)
+            return self.times(self.namedFunctionDerivative[math.getName()](u), du)
+        else:
+            raise ValueError('Cannot differentiate expression: {}'.format(lsb.formulaToL3String(math)))
+
+    def derivativePower(self, u, v, name):
+        du = self.derivative(u, name)
+        dv = self.derivative(v, name)
+        d = None
+        if du is not None:
+            # v*u^(v-1)*du
+            if v.isNumber():
+                e = v.getValue() - 1
+                if e == 0:
+                    d = self.times(self.copy(v), du)
+                elif e == 1:
+                    d = self.times(self.times(self.copy(v), self.copy(u)), du)
+                else:
+                    d = self.times(self.times(self.copy(v), self.node(lsb.AST_FUNCTION_POWER,
+                                [self.copy(u), self.number(e)])), du)
+            else:
+                d = self.times(self.times(self.copy(v), self.node(lsb.AST_FUNCTION_POWER,
+                            [self.copy(u), self.minus(self.copy(v), self.number(1))])), du)
+        if dv is not None:
+            # u^v*ln(u)*dv
+            d = self.plus(d, self.times(self.times(self.node(lsb.AST_FUNCTION_POWER,
+                        [self.copy(u), self.copy(v)]), self.node(lsb.AST_FUNCTION_LN,
+                        [self.copy(u)])), dv))
+        return d
+
+    def derivativeRoot(self, u, n, name):
+        if self.derivative(n, name) is not None:
+            raise ValueError('Root with variable degree cannot be differentiated')
+        du = self.derivative(u, name)
+        if du is None:
+            return None
+        # u^(1/n): 1/n*u^(1/n-1)*du
+        e = self.divide(self.number(1), self.copy(n))
+        return self.times(self.times(self.copy(e), self.node(lsb.AST_FUNCTION_POWER,
+                        [self.copy(u), self.minus(e, self.number(1))])), du)
+
+    def derivativeExp(self, u):
+        return self.node(lsb.AST_FUNCTION_EXP, [self.copy(u)])
+
+    def derivativeLn(self, u):
+        return self.divide(self.number(1), self.copy(u))
+
+    # 1/(u*ln(base)), lnBase: new node
+    def derivativeLog(self, u, lnBase):
+        return self.divide(self.number(1), self.times(self.copy(u), lnBase))
+
+    def derivativeSin(self, u):
+        return self.node(lsb.AST_FUNCTION_COS, [self.copy(u)])
+
+    def derivativeCos(self, u):
+        return self.negate(self.node(lsb.AST_FUNCTION_SIN, [self.copy(u)]))
+
+    """
+    node construction with simplification of zeros (None) and ones
+    """
+    def copy(self, math):
+        return math.deepCopy()
+
+    def node(self, astType, children):
+        n = lsb.ASTNode(astType)
+        for c in children:
+            n.addChild(c)
+        return n
+
+    def number(self, v):
+        n = lsb.ASTNode(lsb.AST_REAL)
+        n.setValue(float(v))
+        return n
+
+    def isOne(self, math):
+        return math is not None and math.isNumber() and math.getValue() == 1
+
+    def plus(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return self.node(lsb.AST_PLUS, [a, b])
+
+    def minus(self, a, b):
+        if b is None:
+            return a
+        if a is None:
+            return self.negate(b)
+        return self.node(lsb.AST_MINUS, [a, b])
+
+    def negate(self, a):
+        if a is None:
+            return None
+        return self.node(lsb.AST_MINUS, [a])
+
+    def times(self, a, b):
+        if a is None or b is None:
+            return None
+        if self.isOne(a):
+            return b
+        if self.isOne(b):
+            return a
+        return self.node(lsb.AST_TIMES, [a, b])
+
+    def divide(self, a, b):
+        if a is None:
+            return None
+        if self.isOne(b):
+            return a
+        return self.node(lsb.AST_DIVIDE, [a, b])
+
+"""
+Rewrite math AST into cheaper equivalent forms before printing:
+    literal arithmetic is folded;
+    multiplication/division by 1 and addition/subtraction of 0 are removed;
+    integer powers become multiplication chains;
+    square and cube roots (nthroot, root, power of 1/2 or 1/3) become sqrt/cbrt.
+duplicate: allow non-leaf bases to be repeated in multiplication chains.
+    Only worthwhile if repeated subtrees are eliminated afterwards.
+"""
+class AstSimplifier:
+
+    def __init__(self, duplicate = False, maxPower = 4):
+        self.duplicate = duplicate
+        self.maxPower = maxPower
+        self.foldable = {lsb.AST_PLUS, lsb.AST_MINUS, lsb.AST_TIMES, lsb.AST_DIVIDE,
+                         lsb.AST_POWER, lsb.AST_FUNCTION_POWER}
+
+    """
+    return simplified copy of math
+    """
+    def simplify(self, math):
+        children = [self.simplify(math.getChild(i)) for i in range(math.getNumChildren())]
+        node = self.rewrite(math, children)
+        if node is None:
+            node = math.deepCopy()
+            for i, c in enumerate(children):
+                node.replaceChild(i, c, True)
+        return node
+
+    """
+    apply rewriting rules to one node, children already simplified.
+    return None if no rule applies.
+    """
+    def rewrite(self, math, children):
+        t = math.getType()
+        if t in self.foldable and children and all(self.isNumber(c) for c in children):
+            v = self.fold(t, [c.getValue() for c in children])
+            if v is not None:
+                return self.number(v)
+        if t == lsb.AST_TIMES:
+            rest = [c for c in children if not self.isValue(c, 1)]
+            if len(rest) < len(children):
+                return self.chain(t, rest) if rest else self.number(1)
+        elif t == lsb.AST_PLUS:
+            rest = [c for c in children if not self.isValue(c, 0)]
+            if len(rest) < len(children):
+                return self.chain(t, rest) if rest else self.number(0)
+        elif t == lsb.AST_MINUS and len(children) == 2 and self.isValue(children[1], 0):
+            return children[0]
+        elif t == lsb.AST_DIVIDE and self.isValue(children[1], 1):
+            return children[0]
+        elif t in {lsb.AST_POWER, lsb.AST_FUNCTION_POWER} and self.isNumber(children[1]):
+            return self.rewritePower(children[0], children[1].getValue())
+        elif t == lsb.AST_FUNCTION_ROOT and len(children) == 2 and self.isValue(children[0], 3):
+            return self.node(lsb.AST_FUNCTION, [children[1]], 'cbrt')
+        elif math.getName() == SBML_FUNCTION_NTHROOT and self.isNumber(children[1]):
+            return self.rewritePower(children[0], 1 / children[1].getValue())
+        return None
+
+    def rewritePower(self, base, e):
+        if e == 1:
+            return base
+        elif e == 0:
+            return self.number(1)
+        elif e == 0.5:
+            return self.node(lsb.AST_FUNCTION_ROOT, [self.number(2, lsb.AST_INTEGER), base])
+        elif e == 1 / 3:
+            return self.node(lsb.AST_FUNCTION, [base], 'cbrt')
+        elif e == int(e) and abs(e) <= self.maxPower and (self.duplicate or base.getNumChildren() == 0):
+            d = self.chain(lsb.AST_TIMES, [base] + [base.deepCopy() for i in range(int(abs(e))-1)])
+            return d if e > 0 else self.node(lsb.AST_DIVIDE, [self.number(1), d])
+        return None
+
+    def fold(self, t, values):
+        try:
+            if t == lsb.AST_PLUS:
+                v = sum(values)
+            elif t == lsb.AST_MINUS:
+                v = -values[0] if len(values) == 1 else values[0] - values[1]
+            elif t == lsb.AST_TIMES:
+                v = 1.0
+                for x in values:
+                    v *= x
+            elif t == lsb.AST_DIVIDE:
+                v = values[0] / values[1]
+            else:
+                v = pymath.pow(values[0], values[1])
+        except (ZeroDivisionError, ValueError, OverflowError):
+            return None
+        return v if pymath.isfinite(v) else None
+
+    def isNumber(self, math):
+        return math.isNumber() or math.isConstantNumber()
+
+    def isValue(self, math, v):
+        return self.isNumber(math) and math.getValue() == v
+
+    def number(self, v, astType = lsb.AST_REAL):
+        n = lsb.ASTNode(astType)
+        n.setValue(int(v) if astType == lsb.AST_INTEGER else float(v))
+        return n
+
+    def node(self, astType, children, name = None):
+        n = lsb.ASTNode(astType)
+        if name:
+            n.setName(name)
+        for c in children:
+            n.addChild(c)
+        return n
+
+    # left associative binary tree of n-ary operation
+    def chain(self, astType, children):
+        d = children[0]
+        for c in children[1:]:
+            d = self.node(astType, [d, c])
+        return d
+
+"""
+Common subexpression elimination over math AST.
+Statements of one C++ function are processed together; subtrees that
+are structurally identical and evaluated more than once are replaced
+by references (AST_NAME) to temporaries, defined before first use.
+Subtrees with boolean value (relational/logical) and branches of
+piecewise functions are never hoisted.
+Number of operations (operator/function nodes) before and after
+elimination is recorded for each function in self.report.
+"""
+class CommonSubexpressionEliminator:
+
+    def __init__(self, prefix = 'CSE'):
+        self.prefix = prefix
+        self.report = []
+
+    """
+    statements: list of math AST, in order of evaluation
+    excluded: names whose value changes between statements.
+        subtrees referencing them are not hoisted.
+    start: index of first temporary, to keep names unique in one function
+    returns:
+    1. list of temporary definitions to be placed before each statement:
+        [[(name, math), ...], ...]
+    2. list of rewritten statements
+    """
+    def eliminate(self, statements, excluded = set(), start = 0):
+        trees = [self.build(m, excluded) for m in statements]
+        counts = {}
+        for t in trees:
+            self.countCandidates(t, counts)
+        hoisted = {k for k, c in counts.items() if c > 1}
+        # a subtree is only evaluated once inside a hoisted parent;
+        # drop those no longer used more than once, until stable
+        while True:
+            uses = {}
+            defined = set()
+            for t in trees:
+                self.countUses(t, hoisted, uses, defined)
+            drop = {k for k in hoisted if uses.get(k, 0) < 2}
+            if not drop:
+                break
+            hoisted -= drop
+        temps = {}
+        defs = []
+        rewritten = []
+        for t in trees:
+            d = []
+            rewritten.append(self.rewrite(t, hoisted, temps, d, start))
+            defs.append(d)
+        return defs, rewritten
+
+    """
+    record number of operations before and after elimination
+    """
+    def addReport(self, function, statements, defs, rewritten):
+        before = sum(self.countOps(m) for m in statements)
+        after = sum(self.countOps(m) for m in rewritten)
+        after += sum(self.countOps(m) for d in defs for (name, m) in d)
+        nrTemp = sum(len(d) for d in defs)
+        self.report.append((function, before, after, nrTemp))
+
+    def getReport(self):
+        message = 'Common subexpression elimination:\n'
+        for (function, before, after, nrTemp) in self.report:
+            message += '{}: {} operations, {} removed ({} temporaries)\n'.format(function,
+                        before, before - after, nrTemp)
+        return message
+
+    """
+    translator formatting temporaries by name, other variables with trans
+    """
+    def getTranslator(self, trans):
+        prefix = self.prefix
+        return AstTranslator(lambda x: x if x.startswith(prefix) else trans.fname(x),
+                             trans.ASTNameToCppToken)
+
+    """
+    mirror of AST with structural key of each subtree.
+    node: [key, math, children, hoistable]
+    """
+    def build(self, math, excluded):
+        t = math.getType()
+        children = []
+        if not t == lsb.AST_FUNCTION_PIECEWISE:
+            children = [self.build(math.getChild(i), excluded) for i in range(math.getNumChildren())]
+        if math.isNumber() or math.isConstantNumber():
+            key = '{}:{}'.format(t, repr(math.getValue()))
+        elif math.getNumChildren() == 0:
+            key = '{}:{}'.format(t, math.getName())
+        else:
+            key = '{}:{}({})'.format(t, math.getName() if math.isFunction() else '',
+                                     ','.join(c[0] for c in children))
+        hoistable = (math.getNumChildren() > 0 and not t == lsb.AST_FUNCTION_PIECEWISE
+                     and not math.isRelational() and not math.isLogical()
+                     and all(c[3] or c[1].getNumChildren() == 0 for c in children))
+        if math.getNumChildren() == 0 and math.isName() and math.getName() in excluded:
+            hoistable = False
+        if hoistable and any(c[1].getNumChildren() == 0 and c[1].isName()
+                             and c[1].getName() in excluded for c in children):
+            hoistable = False
+        return [key, math, children, hoistable]
+
+    def countCandidates(self, tree, counts):
+        key, math, children, hoistable = tree
+        if hoistable:
+            counts[key] = counts.get(key, 0) + 1
+        for c in children:
+            self.countCandidates(c, counts)
+
+    def countUses(self, tree, hoisted, uses, defined):
+        key, math, children, hoistable = tree
+        if key in hoisted:
+            uses[key] = uses.get(key, 0) + 1
+            if key in defined:
+                return
+            defined.add(key)
+        for c in children:
+            self.countUses(c, hoisted, uses, defined)
+
+    def rewrite(self, tree, hoisted, temps, defs, start):
+        key, math, children, hoistable = tree
+        if key in hoisted and key in temps:
+            return self.nameNode(temps[key])
+        node = math.deepCopy()
+        for i, c in enumerate(children):
+            node.replaceChild(i, self.rewrite(c, hoisted, temps, defs, start), True)
+        if key in hoisted:
+            name = '{}{}'.format(self.prefix, start + len(temps))
+            temps[key] = name
+            defs.append((name, node))
+            return self.nameNode(name)
+        return node
+
+    def nameNode(self, name):
+        n = lsb.ASTNode(lsb.AST_NAME)
+        n.setName(name)
+        return n
+
+    def countOps(self, math):
+        if math.getNumChildren() == 0:
+            return 0
+        return 1 + sum(self.countOps(math.getChild(i)) for i in range(math.getNumChildren()))
+
 """
 Class Directed acyclic graphs.
 handles topological sorting of assignment orders.
@@ -867,6 +2001,52 @@ class DirectedAcyclicGraph:
         if graph:
             noCycleDetected = False
         return sortedVertices, noCycleDetected
+    # strongly connected components (Tarjan), for graphs with cycles.
+    # components are ordered as topoSort orders vertices:
+    # all vertices a component has edges to are in itself or earlier ones.
+    # key: sort function for vertices, to make the order of components reproducible
+    def getStronglyConnectedComponents(self, key = None):
+        ordered = lambda vertices: sorted(vertices, key = key) if key else list(vertices)
+        index = {}
+        lowlink = {}
+        stack = []
+        onStack = set()
+        components = []
+        for root in ordered(self.graph):
+            if root in index:
+                continue
+            # iterative depth first search: (vertex, remaining children)
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(ordered(self.graph[root])))]
+            while work:
+                v, children = work[-1]
+                child = next(children, None)
+                if child is not None:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(ordered(self.graph[child]))))
+                    elif child in onStack:
+                        lowlink[v] = min(lowlink[v], index[child])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[v])
+                # v is the root of a component
+                if lowlink[v] == index[v]:
+                    comp = []
+                    while True:
+                        w = stack.pop()
+                        onStack.remove(w)
+                        comp.append(w)
+                        if w == v:
+                            break
+                    components.append(comp)
+        return components
 
 
 """
@@ -1475,6 +2655,18 @@ def getAssignmentRulesRequiredForInitAssignment(model):
                     iaVars.add(idxAssignmentRule[nodeName])             
     return iaVars
 
+"""
+Names referenced by initial assignments, directly or through the
+assignment rules required for them (assignmentRuleOrderIA).
+"""
+def getInitialAssignmentNames(model, assignmentRuleOrderIA):
+    names = set()
+    for i in range(model.getNumInitialAssignments()):
+        names.update(get_variable_names_from_astnodes(model.getInitialAssignment(i).getMath()))
+    for i in assignmentRuleOrderIA:
+        names.update(get_variable_names_from_astnodes(model.getRule(i).getMath()))
+    return names
+
 """
 Get the list of variables subject to rule assignments which are
 also needed for event tigger evaluation or event assignments rhs.
@@ -1511,6 +2703,44 @@ def getAssignmentRulesRequiredForEvents(model):
                         eaVars.add(idxAssignmentRule[nodeName])               
     return triggerVars, eaVars
 
+"""
+Get the assignment rules needed for evaluating maths, including the rules
+they depend on (transitive closure in arGraph), in order of assignmentRuleOrder.
+"""
+def getAssignmentRulesRequiredForMath(model, maths, assignmentRuleOrder, arGraph):
+    idxAssignmentRule = {model.getRule(i).getVariable(): i for i in range(model.getNumRules())}
+    names = {n for m in maths for n in get_variable_names_from_astnodes(m)}
+    dep = {j for n in names if n in idxAssignmentRule
+           for j in arGraph.getDependent(idxAssignmentRule[n])}
+    return [i for i in assignmentRuleOrder if i in dep]
+
+"""
+Get the list of assignment rules needed for evaluating ODE rhs:
+variables in kinetic laws, and compartments used to convert
+between concentration and amount.
+"""
+def getAssignmentRulesRequiredForReactions(model, speciesStoichiometry, convert_unit):
+    idxAssignmentRule = {}
+    for i in range(model.getNumRules()):
+        arName = model.getRule(i).getVariable()
+        idxAssignmentRule[arName] = i
+    reactionVars = set()
+    for i in range(model.getNumReactions()):
+        names = get_variable_names_from_astnodes(model.getReaction(i).getKineticLaw().getMath())
+        c = getReactionFluxCompartment(model, i, convert_unit)
+        if c:
+            names.append(c)
+        for nodeName in names:
+            if nodeName in idxAssignmentRule:
+                reactionVars.add(idxAssignmentRule[nodeName])
+    if convert_unit:
+        for sp in model.getListOfSpecies():
+            c = sp.getCompartment()
+            if (sp.getId() in speciesStoichiometry and not sp.getHasOnlySubstanceUnits()
+                and c in idxAssignmentRule):
+                reactionVars.add(idxAssignmentRule[c])
+    return reactionVars
+
 """
 Variables in SBML documents can be Species, Compartments or Parameters.
 Depending on their role in the model, they can be reorganized into the
@@ -1709,9 +2939,179 @@ def getAssignmentRuleYDependency(model, assignmentRuleOrder, key2var):
                    depAssignmentRule[vName] = True
                    break
     return depAssignmentRule
-    
+
+"""
+Check which y (sp_var) each assignment rule variable depends on,
+directly or through other assignment rules.
+independent: other sids to track as y, e.g. sensitivity parameters
+algebraic: dict[sid] = set of sp_var sids, for other variables computed from y
+(species removed by conserved moieties); included in the result
+Return dict[sid] = set of sp_var sids
+"""
+def getAssignmentRuleSpeciesDependency(model, assignmentRuleOrder, key2var, independent = (),
+                                       algebraic = {}):
+    depAssignmentRule = dict(algebraic)
+    for i in assignmentRuleOrder:
+        ar = model.getRule(i)
+        dep = set()
+        for nodeName in get_variable_names_from_astnodes(ar.getMath()):
+            if nodeName in depAssignmentRule:
+                dep |= depAssignmentRule[nodeName]
+            elif nodeName in key2var and key2var[nodeName]['vartype'] == 'sp_var':
+                dep.add(nodeName)
+            elif nodeName in independent:
+                dep.add(nodeName)
+        depAssignmentRule[ar.getVariable()] = dep
+    return depAssignmentRule
+
+"""
+Check which y (sp_var) each reaction flux depends on,
+directly or through assignment rules.
+Compartment size multiplied to substance/volume/time fluxes is included.
+independent: other sids to track as y, e.g. sensitivity parameters
+Return list: [set of sp_var sids] for each reaction
+"""
+def getReactionFluxSpeciesDependency(model, convert_unit, key2var, depAssignmentRule, independent = ()):
+    fluxDep = []
+    for i in range(model.getNumReactions()):
+        names = get_variable_names_from_astnodes(model.getReaction(i).getKineticLaw().getMath())
+        c = getReactionFluxCompartment(model, i, convert_unit)
+        if c:
+            names.append(c)
+        dep = set()
+        for nodeName in names:
+            if nodeName in depAssignmentRule:
+                dep |= depAssignmentRule[nodeName]
+            elif nodeName in key2var and key2var[nodeName]['vartype'] == 'sp_var':
+                dep.add(nodeName)
+            elif nodeName in independent:
+                dep.add(nodeName)
+        fluxDep.append(dep)
+    return fluxDep
+
 """
-Check if trigger components contain variables 
+Conserved moieties: combinations of species amounts that no reaction changes,
+from the left null space of the stoichiometry matrix (L*N = 0).
+species: rows of the stoichiometry matrix, species with constant amount scaling
+candidates: species allowed to be removed from y
+Return list of (dependent sid, [(sid, coefficient)]): amount of the dependent
+species plus the weighted amounts of the others is constant.
+"""
+def getConservedMoieties(model, species, candidates, speciesStoichiometry, tol = 1e-9):
+    if not species or not model.getNumReactions():
+        return []
+    N = np.zeros((len(species), model.getNumReactions()))
+    for i, sid in enumerate(species):
+        for r, stoic in speciesStoichiometry[sid]:
+            N[i, r] += stoic
+    u, s, vt = np.linalg.svd(N.T)
+    rank = int(np.sum(s > tol * max(1, s[0])))
+    L = vt[rank:]
+    # reduced row echelon form, pivots (dependent species) among candidates
+    pivots = []
+    for j, sid in enumerate(species):
+        k = len(pivots)
+        if k == len(L):
+            break
+        if sid not in candidates:
+            continue
+        p = k + int(np.argmax(np.abs(L[k:, j])))
+        if abs(L[p, j]) < tol:
+            continue
+        L[[k, p]] = L[[p, k]]
+        L[k] /= L[k, j]
+        for q in range(len(L)):
+            if q != k:
+                L[q] -= L[q, j] * L[k]
+        pivots.append(j)
+    moieties = []
+    for k, j in enumerate(pivots):
+        terms = []
+        for i, sid in enumerate(species):
+            c = L[k, i]
+            if i == j or abs(c) < tol:
+                continue
+            # stoichiometry is mostly integer
+            if abs(c - round(c)) < tol:
+                c = int(round(c))
+            terms.append((sid, c))
+        moieties.append((species[j], terms))
+    return moieties
+
+"""
+Remove dependent species of conserved moieties from y. They are stored
+after the other species (sp_other) and computed from the totals.
+"""
+def reduceConservedMoieties(key2var, varlist, moieties):
+    dependent = [sid for sid, terms in moieties]
+    varlist['sp_var'] = [sid for sid in varlist['sp_var'] if sid not in dependent]
+    varlist['sp_other'] += dependent
+    for sid in dependent:
+        del key2var[sid]
+    for i, sid in enumerate(varlist['sp_var']):
+        key2var[sid] = {'vartype': 'sp_var', 'idx': i}
+    return
+
+"""
+Block structure of the species interaction graph: d(y_i)/dt depends on y_j
+through reaction fluxes, assignment rules or the compartment of species i.
+Strongly connected components are ordered so that each block only depends on
+itself and earlier blocks: in this order the Jacobian is block lower triangular.
+Return list of blocks, each a list of sp_var sids in order of y.
+"""
+def getSpeciesBlocks(model, assignmentRuleOrder, speciesStoichiometry, convert_unit, key2var,
+                     moieties = ()):
+    algebraic = {sid: {j for (j, c) in terms} for (sid, terms) in moieties}
+    depAR = getAssignmentRuleSpeciesDependency(model, assignmentRuleOrder, key2var, (), algebraic)
+    fluxDep = getReactionFluxSpeciesDependency(model, convert_unit, key2var, depAR)
+    order = lambda sid: key2var[sid]['idx']
+    graph = DirectedAcyclicGraph()
+    for sid in speciesStoichiometry:
+        if sid not in key2var or key2var[sid]['vartype'] != 'sp_var':
+            continue
+        graph.addVertex(sid)
+        for (r, stoic) in speciesStoichiometry[sid]:
+            for j in fluxDep[r]:
+                graph.addEdge(sid, j)
+        sp = model.getSpecies(sid)
+        if convert_unit and not sp.getHasOnlySubstanceUnits():
+            for j in depAR.get(sp.getCompartment(), ()):
+                graph.addEdge(sid, j)
+    blocks = graph.getStronglyConnectedComponents(key = order)
+    return [sorted(b, key = order) for b in blocks]
+
+"""
+State layout in block order (getSpeciesBlocks): y is renumbered block by block.
+"""
+def reorderSpeciesBlocks(key2var, varlist, blocks):
+    varlist['sp_var'] = [sid for b in blocks for sid in b]
+    for i, sid in enumerate(varlist['sp_var']):
+        key2var[sid] = {'vartype': 'sp_var', 'idx': i}
+    return
+
+"""
+Check if math contains variables dependent of y or time,
+directly or inderectly.
+isContinuousAR: from getAssignmentRuleYDependency()
+"""
+def isContinuousMath(math, isContinuousAR, key2var):
+    l = math.getListOfNodes()
+    for j in range(l.getSize()):
+        node = l.get(j)
+        if node.isName():
+            nodeName = node.getName()
+            if nodeName in isContinuousAR:
+                if isContinuousAR[nodeName] == True:
+                    return True
+            elif nodeName in key2var:
+                if key2var[nodeName]['vartype'] == 'sp_var':
+                    return True
+            elif node.getType() == lsb.AST_NAME_TIME:
+               return True
+    return False
+
+"""
+Check if trigger components contain variables
 dependent of y, directly or inderectly.
 """
 def getTriggerComponentDependency(model, assignmentRuleOrder, allTriggers, key2var):
@@ -1721,24 +3121,38 @@ def getTriggerComponentDependency(model, assignmentRuleOrder, allTriggers, key2v
     triggerCompDep = [False]*len(allTriggers)
     # trigger component dependencies
     for i, t in enumerate(allTriggers):
-        l = t.getListOfNodes()
-        for j in range(l.getSize()):
-            node = l.get(j)
-            if node.isName():
-                nodeName = node.getName()
-                if nodeName in isContinuousAR:
-                    if isContinuousAR[nodeName] == True:
-                        triggerCompDep[i] = True
-                        break
-                elif nodeName in key2var:
-                    if key2var[nodeName]['vartype'] == 'sp_var':
-                        triggerCompDep[i] = True
-                        break
-                elif node.getType() == lsb.AST_NAME_TIME:
-                   triggerCompDep[i] = True
-                   break
+        triggerCompDep[i] = isContinuousMath(t, isContinuousAR, key2var)
     return triggerCompDep
 
+"""
+Find trigger components comparing time with an expression of
+constants and parameters only, e.g. t >= t_dose.
+These are satisfied at a time known in advance, so the solver
+can stop there instead of locating a root.
+Return list, one element per trigger component:
+    None if not time-only; otherwise (direction, math of the time),
+    direction = 1 if the component turns true as time passes, -1 if false.
+"""
+def getTriggerComponentTime(model, assignmentRuleOrder, allTriggers, key2var):
+    
+    isContinuousAR = getAssignmentRuleYDependency(model, assignmentRuleOrder, key2var)
+    
+    triggerCompTime = [None]*len(allTriggers)
+    for i, t in enumerate(allTriggers):
+        ro = t.getName()
+        if not (t.isRelational() and t.getNumChildren() == 2 and 
+                ro in {'geq', 'gt', 'leq', 'lt'}):
+            continue
+        direction = 1 if ro in {'geq', 'gt'} else -1
+        lhs, rhs = t.getLeftChild(), t.getRightChild()
+        if rhs.getType() == lsb.AST_NAME_TIME:
+            lhs, rhs = rhs, lhs
+            direction = -direction
+        if (lhs.getType() == lsb.AST_NAME_TIME and 
+            not isContinuousMath(rhs, isContinuousAR, key2var)):
+            triggerCompTime[i] = (direction, rhs)
+    return triggerCompTime
+
 """
 Deprecated 
 initial assignment are now handled in getSourceFileInitialAssginment()
@@ -1818,7 +3232,12 @@ def processInitConditions(model, varlist, key2var, key2name, ODE_TIME_NAME,
 #
 ############################################################
 
-def getHeaderFileContent(class_name, name_space, use_hybrid):
+def getHeaderFileContent(class_name, name_space, use_hybrid, use_jacobian = False,
+                         use_sparse_jacobian = False, nr_sensitivity = 0, nr_moiety = 0,
+                         reorder_output = False, nr_block = 0, nr_output = 0, output_stride = 1,
+                         thread_local_param = False):
+    # sparse Jacobian is always analytic
+    use_jacobian = use_jacobian or use_sparse_jacobian
     header = """#pragma once
 
 #include "CVODEBase.h"
@@ -1833,8 +3252,27 @@ public:
     //! ODE right hand side
     static int f(realtype t, N_Vector y, N_Vector ydot, void *user_data);
     //! Root finding (for events)
-    static int g(realtype t, N_Vector y, realtype *gout, void *user_data);
+    static int g(realtype t, N_Vector y, realtype *gout, void *user_data);"""
+    if use_jacobian:
+        header += """
+    //! Jacobian of ODE right hand side
+    static int Jac(realtype t, N_Vector y, N_Vector fy, SUNMatrix J, void *user_data,
+        N_Vector tmp1, N_Vector tmp2, N_Vector tmp3);"""
+    if nr_sensitivity:
+        header += """
+    //! forward sensitivity right hand side
+    static int fS(int Ns, realtype t, N_Vector y, N_Vector ydot, N_Vector *yS, N_Vector *ySdot,
+        void *user_data, N_Vector tmp1, N_Vector tmp2);
+    //! names of sensitivity parameters
+    static std::string getSensitivityHeader();"""
+    if output_stride > 1:
+        header += """
+    //! write every n-th output time
+    int getOutputStride(void) const {{ return {4}; }};"""
+    header += """
     static std::string getHeader();
+    //! units of output columns (getHeader), original units
+    static std::vector<std::string> getHeaderUnits();
     static void setup_class_parameters(Param& param);
 
     // accessing class parameters
@@ -1847,11 +3285,19 @@ public:
     if use_hybrid:
         header += """
     static double _QSP_weight;"""
-    header += """
+    if thread_local_param:
+        header += """
+private:
+    // parameters shared by all instances of this class in one thread
+    static thread_local state_type _class_parameter;
+public:"""
+    else:
+        header += """
 private:
     // parameters shared by all instances of this class
     static state_type _class_parameter;
-public:
+public:"""
+    header += """
     {0}();
     {0}(const {0}& c);
     ~{0}();
@@ -1874,23 +3320,71 @@ protected:
     void initSolver(realtype t0);
     void update_y_other(void);
     bool triggerComponentEvaluate(int i, realtype t, bool curr);
+    //! evaluate all trigger components, assignment rules once
+    void triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied);
+    //! time when a time-only trigger component changes
+    realtype triggerComponentTime(int i, int& direction);
     //! evaluate one event trigger
     bool eventEvaluate(int i);
     //! execute one event
     bool eventExecution(int i, bool delay, realtype& dt);
+    //! if event i changes y, rhs or root functions
+    bool eventNeedsReinit(int i) const;
     //! unit conversion factor for species (y and non-y)
     realtype get_unit_conversion_species(int i) const;
     //! unit conversion foactor for non-species variables
-    realtype get_unit_conversion_nspvar(int i) const;
+    realtype get_unit_conversion_nspvar(int i) const;"""
+    if use_jacobian:
+        header += """
+    //! analytic Jacobian passed to the solver
+    CVLsJacFn getJacobianFn(void) const {{ return Jac; }};"""
+    if use_sparse_jacobian:
+        header += """
+    //! number of nonzero elements in sparse Jacobian
+    sunindextype getJacobianNNZ(void) const;"""
+    if nr_sensitivity:
+        header += """
+    //! forward sensitivity rhs passed to the solver
+    SensRhsFn getSensitivityRhsFn(void) const {{ return fS; }};
+    //! number of sensitivity parameters
+    int getNumSensitivities(void) const {{ return {2}; }};
+    //! value of sensitivity parameter k
+    realtype getSensitivityParam(int k) const;
+    //! unit conversion factor for sensitivity parameter k
+    realtype get_unit_conversion_sensitivity(int k) const;
+    //! update sensitivities by the event assignments of event i
+    void eventSensitivity(int i);"""
+    if nr_block:
+        header += """
+    //! first row of each diagonal block of the block triangular Jacobian
+    std::vector<sunindextype> getJacobianBlocks(void) const;"""
+    if reorder_output:
+        header += """
+    //! position of output column i: y in block order, species removed from y stored after other species
+    int get_output_index(int i) const;"""
+    if nr_output:
+        header += """
+    //! number of output columns (selected species)
+    int get_output_size(void) const {{ return {3}; }};"""
+    header += """
 private:
     friend class boost::serialization::access;
     template<class Archive>
-    void serialize(Archive & ar, const unsigned int /*version*/);
+    void serialize(Archive & ar, const unsigned int /*version*/);"""
+    if nr_moiety:
+        header += """
+    //! conserved totals of species removed from y
+    state_type _moiety_total;"""
+    header += """
 }};
 
 template<class Archive>
 inline void {0}::serialize(Archive & ar, const unsigned int /* version */){{
-    ar & BOOST_SERIALIZATION_BASE_OBJECT_NVP(CVODEBase);
+    ar & BOOST_SERIALIZATION_BASE_OBJECT_NVP(CVODEBase);"""
+    if nr_moiety:
+        header += """
+    ar & BOOST_SERIALIZATION_NVP(_moiety_total);"""
+    header += """
 }}
 
 template<class Archive>
@@ -1917,7 +3411,7 @@ inline void {0}::set_class_param(unsigned int i, double v){{
 
 }};
 """
-    return header.format(class_name, name_space)
+    return header.format(class_name, name_space, nr_sensitivity, nr_output, output_stride)
 
 def getParamHeaderContent(name_space):
     header = """#pragma once
@@ -1933,8 +3427,19 @@ public:
     ~Param(){{}};
     //! get parameter value
     inline double getVal(unsigned int n) const {{ return _paramFloat[n];}};
+    //! number of parameter values
+    inline size_t getNumVals(void) const {{ return _paramFloat.size();}};
+    //! initialize from xml parameter file or binary parameter image
+    void initializeParams(std::string inFileName);
+
+    //! true if file starts with the binary parameter image magic
+    static bool isBinaryParamFile(std::string inFileName);
+    //! set all values from array of n values, in order of the parameter file
+    bool setVals(const double* values, size_t n);
 
 private:
+    //! copy values from memory-mapped binary parameter image
+    bool readParamsFromBinary(std::string inFileName);
     //! setup content of _paramDesc
     virtual void setupParam();
     //! process all internal parameters
@@ -1956,11 +3461,61 @@ def getSourceFileMacro(class_name):
 """ 
     return source.format(class_name)  
 
+def getSourceFileProfileInclude():
+    return """#ifdef QSP_PROFILE
+#include <chrono>
+#include <fstream>
+#include <cstdlib>
+#endif
+
+"""
 
+# source file of a translation unit of the split source (SPLIT_SOURCE_UNITS)
+def getSplitSourceName(class_name, unit):
+    return '{}{}.cpp'.format(class_name, '_' + unit if unit else '')
 
-def getSourceFileConstructor(class_name, use_hybrid, qsp_weight):
-    source = ""
+# files written with split source, other than the Makefile fragment
+def getSplitSourceFiles(class_name):
+    return ([getSplitSourceName(class_name, unit) for unit in SPLIT_SOURCE_UNITS] +
+            ['{}_internal.h'.format(class_name)])
+
+"""
+Internal header shared by the translation units of the split source:
+macros of getSourceFileMacro, profiling counter declarations, frozen parameters
+and the QSP weight macro of hybrid models. Not part of the class interface.
+frozen: source of frozen parameters (getSourceFileFrozenParam), empty if none
+"""
+def getSplitSourceHeader(class_name, name_space, profile, use_hybrid, frozen):
+    source = '#ifndef {0}_INTERNAL_H\n#define {0}_INTERNAL_H\n\n'.format(class_name.upper())
+    source += getSourceFileMacro(class_name)
+    if profile:
+        source += getSourceFileProfileInclude()
+    source += 'namespace {}{{\n'.format(name_space)
+    if profile:
+        source += getSourceFileProfile(profile, 'declaration')
+    source += frozen
     if use_hybrid:
+        source += '\n#define {1} {0}::_QSP_weight\n'.format(class_name, QSP_WEIGHT_NAME)
+    source += '\n};\n#endif\n'
+    return source
+
+# Makefile fragment: MODEL_SRCS, translation units of the split source
+def getSplitSourceMakefile(class_name):
+    source = """# translation units of {0} (split source), generated with the model.
+# Include it in a makefile and build $(MODEL_SRCS) instead of {0}.cpp, with make -j.
+# Objects depend on {0}_internal.h through the generated dependencies (-MMD).
+{0}_DIR := $(dir $(lastword $(MAKEFILE_LIST)))
+MODEL_SRCS := $(addprefix $({0}_DIR),{1})
+"""
+    return source.format(class_name, ' '.join(getSplitSourceName(class_name, unit)
+                                              for unit in SPLIT_SOURCE_UNITS))
+
+
+
+# weight_definition: also define _QSP_weight and its macro (not with split source)
+def getSourceFileConstructor(class_name, use_hybrid, qsp_weight, weight_definition = True):
+    source = ""
+    if use_hybrid and weight_definition:
         source += '#define {1} {0}::_QSP_weight\n\n'.format(class_name, QSP_WEIGHT_NAME)
         source += 'double {0}::_QSP_weight = {1};\n'.format(class_name, qsp_weight)
 
@@ -2011,24 +3566,52 @@ void {0}::initSolver(realtype t){{
 """
     return source.format(class_name)
 
+"""
+value from parameter file, converted to units used in simulation
+fold: omit conversion factors equal to 1
+"""
+def getScaledParamString(e, fold = False):
+    if fold and e['scaling_use'] == 1:
+        return 'PFILE({})'.format(e['init_id'])
+    return 'PFILE({}) * {}'.format(e['init_id'], e['scaling_use'])
+
+"""
+Constant parameters fixed at export (set_frozen_params), in SI units if converted.
+"""
+def getSourceFileFrozenParam(frozenParams, key2name, key2var, fname):
+    source = '\n//constant parameters fixed at export\n'
+    source += 'static constexpr realtype _frozen_parameter[{}] = {{\n'.format(len(frozenParams))
+    for key, v in frozenParams.items():
+        source += '    //{}, {}, index: {}\n'.format(fname(key), key, key2var[key]['idx'])
+        source += '    {!r},\n'.format(v)
+    source += '};\n'
+    return source
+
+# frozen: parameters fixed at export, not read from parameter file
 def getSourceFileStaticParam(class_name, key2name, key2var, varlist,
-                             hybrid_elements, fname):
+                             hybrid_elements, fname, fold = False, frozen = {},
+                             thread_local_param = False):
 
-    source = '\nstate_type {}::_class_parameter = state_type({}, {});\n'.format(class_name, len(varlist['p_const']), 0)
+    source = '\n{}state_type {}::_class_parameter = state_type({}, {});\n'.format(
+        'thread_local ' if thread_local_param else '', class_name, len(varlist['p_const']), 0)
     source += '\nvoid {}::setup_class_parameters(Param& param){{\n'.format(class_name)
     for i, key in enumerate(varlist['p_const']):
         e = key2name[key]
         source += '    //{}, {}, index: {}\n'.format(fname(key), key, key2var[key]['idx'])
         source += '    //Unit: {}\n'.format(e['unit_use'])
+        if key in frozen:
+            source += '    _class_parameter[{}] = _frozen_parameter[{}];\n'.format(i, frozen[key])
+            continue
         source += '    _class_parameter[{}] = '.format(i)
         if key in hybrid_elements:
             source += '{} * '.format(QSP_WEIGHT_NAME)
-        source += 'PFILE({}) * {};\n'.format(e['init_id'], e['scaling_use'])
+        source += '{};\n'.format(getScaledParamString(e, fold))
     source += '}\n'
     return source
 
 def getSourceFileVariableSetup(class_name, model, key2name, key2var, varlist, 
-                               id_reltol, id_abstol, hybrid_elements, fname):
+                               id_reltol, id_abstol, hybrid_elements, fname, fold = False,
+                               moieties = ()):
     source = """
 void {}::setupVariables(void){{
 
@@ -2037,6 +3620,9 @@ void {}::setupVariables(void){{
     source += '    _nonspecies_var = std::vector<realtype>({}, 0);\n'.format(len(varlist['nsp_var']))
     source += '    //species not part of ode left-hand side\n'
     source += '    _species_other =  std::vector<realtype>({}, 0);\n'.format(len(varlist['sp_other']))    
+    if moieties:
+        source += '    //conserved totals of species removed from y\n'
+        source += '    _moiety_total = std::vector<realtype>({}, 0);\n'.format(len(moieties))
 
     source += """    
     return;
@@ -2053,14 +3639,24 @@ void {}::setup_instance_varaibles(Param& param){{
         source += '    //{}, {}, index: {}\n'.format(fname(key), key, key2var[key]['idx'])
         source += '    //Unit: {}\n'.format(e['unit_use'])
         source += '    _species_var[{}] = '.format(i)
-        source += 'PFILE({}) * {};\n'.format(e['init_id'], e['scaling_use'])
+        source += '{};\n'.format(getScaledParamString(e, fold))
     
     for i, key in enumerate(varlist['nsp_var']):
         e = key2name[key]
         source += '    //{}, {}, index: {}\n'.format(fname(key), key, key2var[key]['idx'])
         source += '    //Unit: {}\n'.format(e['unit_use'])
         source += '    _nonspecies_var[{}] = '.format(i)
-        source += 'PFILE({}) * {};\n'.format(e['init_id'], e['scaling_use'])
+        source += '{};\n'.format(getScaledParamString(e, fold))
+
+    # initial values of species removed from y, for the conserved totals
+    dependent = {sid for (sid, terms) in moieties}
+    for i, key in enumerate(varlist['sp_other']):
+        if key in dependent:
+            e = key2name[key]
+            source += '    //{}, {}, conserved moiety\n'.format(fname(key), key)
+            source += '    //Unit: {}\n'.format(e['unit_use'])
+            source += '    _species_other[{}] = '.format(i)
+            source += '{};\n'.format(getScaledParamString(e, fold))
     source += """    
     return;
 }
@@ -2101,7 +3697,9 @@ void {}::setup_instance_tolerance(Param& param){{
     source += '    }\n'
         
     source += '    int flag = CVodeSVtolerances(_cvode_mem, reltol, abstol);\n'
-    source += '    check_flag(&flag, "CVodeSVtolerances", 1);\n\n'
+    source += '    check_flag(&flag, "CVodeSVtolerances", 1);\n'
+    # the solver keeps its own copy
+    source += '    N_VDestroy_Serial(abstol);\n\n'
     source += """    
     return;
 }
@@ -2115,7 +3713,7 @@ Initial assignment
 def getSourceFileInitialAssginment(class_name, model, varlist, key2var, key2name, ODE_TIME_NAME,
                           assignmentRuleOrderIA, 
                           assignmentRuleOrder, 
-                          initialAssignmentOrder, translator):
+                          initialAssignmentOrder, translator, convert_unit = True, moieties = ()):
 
     source = """
 void {}::eval_init_assignment(void){{
@@ -2142,6 +3740,17 @@ void {}::eval_init_assignment(void){{
                                                 translator.mathToString(ar.getMath()))       
         source += s        
     """
+    if moieties:
+        source += '    //Conserved totals of species removed from y\n'
+    for k, (sid, terms) in enumerate(moieties):
+        v = '_species_other[{}]'.format(varlist['sp_other'].index(sid))
+        total = getSpeciesAmountString(model, sid, v, convert_unit, translator)
+        for (j, c) in terms:
+            total += ' + ' if c > 0 else ' - '
+            if abs(c) != 1:
+                total += '{}*'.format(abs(c))
+            total += getSpeciesAmountString(model, j, translator.fname(j), convert_unit, translator)
+        source += '    _moiety_total[{}] = {};\n'.format(k, total)
     source += """
     updateVar();
     
@@ -2154,14 +3763,16 @@ void {}::eval_init_assignment(void){{
 """
 Event setup
 """
-def getSourceFileEventSetup(class_name, model, allTriggers, triggerParser, translator):
+def getSourceFileEventSetup(class_name, model, allTriggers, triggerCompTime, triggerParser, translator):
     source = 'void {}::setupEvents(void){{\n\n'.format(class_name)
 
+    nrTimed = sum(1 for x in triggerCompTime if x is not None)
     source += '    _nevent = {};\n'.format(model.getNumEvents())
-    source += '    _nroot = {};\n\n'.format(len(allTriggers))
+    source += '    _nroot = {};\n'.format(len(allTriggers) - nrTimed)
+    source += '    _ntimed = {};\n\n'.format(nrTimed)
     
-    source += '    _trigger_element_type = std::vector<EVENT_TRIGGER_ELEM_TYPE>(_nroot, TRIGGER_NON_INSTANT);\n'
-    source += '    _trigger_element_satisfied = std::vector<bool>(_nroot, false);\n'
+    source += '    _trigger_element_type = std::vector<EVENT_TRIGGER_ELEM_TYPE>(_nroot + _ntimed, TRIGGER_NON_INSTANT);\n'
+    source += '    _trigger_element_satisfied = std::vector<bool>(_nroot + _ntimed, false);\n'
     source += '    _event_triggered = std::vector<bool>(_nevent, false);\n\n'
     
     for i, trigger in enumerate(allTriggers):
@@ -2180,101 +3791,836 @@ def getSourceFileEventSetup(class_name, model, allTriggers, triggerParser, trans
     return source
 
 """
-reactions
-abm: array of type bool. True if abm assumes part of the reaction
+compartment to multiply reaction flux with, when kinetic law
+is in unit of substance per volume per time.
+Return None if no conversion is needed.
 """
-def getSourceFileReaction(class_name, model, assignmentRuleOrder, 
-                          speciesStoichiometry, convert_unit, key2var,hybrid_elements, trans, fname):
-    model_level = model.getLevel()
-    model_version = model.getVersion()
-    source = """
+def getReactionFluxCompartment(model, i, convert_unit):
+    r = model.getReaction(i)
+    ud = r.getKineticLaw().getDerivedUnitDefinition()
+    isSPT = ud.isVariantOfSubstancePerTime()
+    if convert_unit and not isSPT:
+        isSubstancePerVolTime = isVariantOfSubstancePerVolumeTime(ud, model.getLevel(), model.getVersion())
+        if isSubstancePerVolTime:
+            sr = None
+            if len(r.getListOfProducts()):
+                sr = r.getListOfProducts()[0]
+            elif len(r.getListOfReactants()):
+                sr = r.getListOfReactants()[0]
+            if sr:
+                sp = model.getElementBySId(sr.getSpecies())
+                return sp.getCompartment()
+            else:
+                print('Error: no product or reactant in reaction {}. cannot determine compartment.'.format(i))
+        else:
+            print('Error: reaction {} is not substance per time nor substance per volume per time'.format(i))
+    return None
+
+"""
+reaction flux in unit of substance per time
+math: kinetic law math to use in place of that of the reaction
+"""
+def getReactionFluxString(model, i, convert_unit, hybrid_elements, trans, math = None):
+    r = model.getReaction(i)
+    if math is None:
+        math = r.getKineticLaw().getMath()
+    reactionFluxSPT =  trans.mathToString(math)
+    c = getReactionFluxCompartment(model, i, convert_unit)
+    if c:
+        reactionFluxSPT = '(' + reactionFluxSPT + ')*{}'.format(trans.fname(c))
+    #if abm[i]:
+    if r.getId() in hybrid_elements:
+        reactionFluxSPT = '{} * ('.format(QSP_WEIGHT_NAME) + reactionFluxSPT + ')'
+    return reactionFluxSPT
+
+"""
+dydt of one species: stoichiometry weighted sum of reaction fluxes,
+formatted with fflux(reaction_idx).
+finv: name of precomputed compartment reciprocal, None to divide by compartment
+"""
+def getSpeciesRateString(sp, speciesStoichiometry, convert_unit, trans, fflux, finv = None):
+    dydt = ''
+    for i, (r, stoic) in enumerate(speciesStoichiometry[sp.getId()]):
+        pre = (' + '*(i!=0) if stoic > 0 else ' - ' ) + \
+              ('{}*'.format(int(abs(stoic))) if abs(stoic) != 1 else '')
+        #y += '+({})*ReactionFlux{}'.format(stoic, r+1)
+        dydt += pre + fflux(r)
+    if convert_unit and not sp.getHasOnlySubstanceUnits():
+        if finv:
+            dydt = '{}*('.format(finv(sp.getCompartment())) + dydt + ')'
+        else:
+            dydt = '1/{}*('.format(trans.fname(sp.getCompartment())) + dydt + ')'
+    return dydt
+
+"""
+Stoichiometry table of the rhs (table-driven f()), CSR with one row per rate
+of a species in y, rows in order of y.
+returns:
+1. y index of each row
+2. row pointers, len(rows) + 1
+3. reaction index of each entry
+4. stoichiometric coefficient of each entry
+5. compartment of each row, None if the rate is not scaled
+"""
+def getRhsTable(model, speciesStoichiometry, convert_unit, key2var):
+    rows = []
+    for sp in model.getListOfSpecies():
+        sid = sp.getId()
+        # same species as unrolled dydt
+        if sid in speciesStoichiometry and sid in key2var:
+            rows.append((key2var[sid]['idx'], sp))
+    rows.sort(key = lambda x: x[0])
+    rowptrs = [0]
+    fluxes = []
+    stoich = []
+    compartments = []
+    for idx, sp in rows:
+        for (r, stoic) in speciesStoichiometry[sp.getId()]:
+            fluxes.append(r)
+            stoich.append(int(abs(stoic)) * (1 if stoic > 0 else -1))
+        rowptrs.append(len(fluxes))
+        scaled = convert_unit and not sp.getHasOnlySubstanceUnits()
+        compartments.append(sp.getCompartment() if scaled else None)
+    return [idx for idx, sp in rows], rowptrs, fluxes, stoich, compartments
+
+# number of stoichiometric coefficients in the rhs, size measure of the table-driven f()
+def getRhsTableNNZ(speciesStoichiometry, key2var):
+    return sum(len(v) for (sid, v) in speciesStoichiometry.items() if sid in key2var)
+
+def getSourceRhsTable(model, speciesStoichiometry, convert_unit, key2var):
+    rows, rowptrs, fluxes, stoich, compartments = getRhsTable(model, speciesStoichiometry,
+                                                              convert_unit, key2var)
+    scales = [None] + sorted({c for c in compartments if c is not None}, key = compartments.index)
+    source = '\n//Stoichiometry table of the rhs (CSR, one row per species rate)\n'
+    source += 'static const int _rhs_rows[{}] = {{{}}};\n'.format(len(rows),
+               ', '.join(str(i) for i in rows))
+    source += 'static const int _rhs_rowptrs[{}] = {{{}}};\n'.format(len(rowptrs),
+               ', '.join(str(k) for k in rowptrs))
+    source += 'static const int _rhs_fluxes[{}] = {{{}}};\n'.format(len(fluxes),
+               ', '.join(str(r) for r in fluxes))
+    source += 'static const realtype _rhs_stoich[{}] = {{{}}};\n'.format(len(stoich),
+               ', '.join(str(c) for c in stoich))
+    source += '//compartment reciprocal of each row, 0: not scaled\n'
+    source += 'static const int _rhs_scale[{}] = {{{}}};\n'.format(len(rows),
+               ', '.join(str(scales.index(c)) for c in compartments))
+    return source
+
+"""
+Species removed from y by conserved moieties (getConservedMoieties).
+Amount of a species: value times compartment, unless in substance units.
+"""
+def getSpeciesAmountString(model, sid, value, convert_unit, trans):
+    sp = model.getSpecies(sid)
+    if convert_unit and not sp.getHasOnlySubstanceUnits():
+        return '{}*{}'.format(trans.fname(sp.getCompartment()), value)
+    return value
+
+def getMoietySpeciesString(model, sid, terms, convert_unit, trans, total):
+    s = total
+    for (j, c) in terms:
+        s += ' - ' if c > 0 else ' + '
+        if abs(c) != 1:
+            s += '{}*'.format(abs(c))
+        s += getSpeciesAmountString(model, j, trans.fname(j), convert_unit, trans)
+    sp = model.getSpecies(sid)
+    if convert_unit and not sp.getHasOnlySubstanceUnits():
+        s = '({})/{}'.format(s, trans.fname(sp.getCompartment()))
+    return s
+
+def getMoietyDerivativeString(model, sid, j, c, convert_unit, trans):
+    factors = ['{}'.format(abs(c))] if abs(c) != 1 else []
+    sp = model.getSpecies(j)
+    if convert_unit and not sp.getHasOnlySubstanceUnits():
+        factors.append(trans.fname(sp.getCompartment()))
+    s = ('-' if c > 0 else '') + ('*'.join(factors) if factors else '1')
+    sp = model.getSpecies(sid)
+    if convert_unit and not sp.getHasOnlySubstanceUnits():
+        s += '/{}'.format(trans.fname(sp.getCompartment()))
+    return s
+
+"""
+values of the dependent species referenced in names, from the conserved totals
+ftotal: format string of the total, taking the index of the moiety
+"""
+def getSourceMoietySpecies(model, moieties, names, convert_unit, trans, ftotal, indent):
+    source = ''
+    for k, (sid, terms) in enumerate(moieties):
+        if sid in names:
+            source += indent + 'realtype {} = {};\n'.format(trans.fname(sid),
+                getMoietySpeciesString(model, sid, terms, convert_unit, trans, ftotal.format(k)))
+    return source
+
+"""
+temporaries created by common subexpression elimination
+"""
+def getSourceTemporaries(defs, trans, indent):
+    source = ''
+    for (name, math) in defs:
+        source += indent + 'const realtype {} = {};\n'.format(name, trans.mathToString(math))
+    return source
+
+"""
+Profiling counters: one counter per assignment rule and reaction flux in f(),
+root function in g() and event in eventExecution(). Counting and timing are
+compiled in with -DQSP_PROFILE only; counters are written to a csv file at exit.
+Returns dict: (type, index) -> counter index
+"""
+def getProfileSlots(model, assignmentRuleOrderReaction, nrRoot):
+    labels = [('rule', i) for i in assignmentRuleOrderReaction]
+    labels += [('flux', i) for i in range(model.getNumReactions())]
+    labels += [('trigger', i) for i in range(nrRoot)]
+    labels += [('event', i) for i in range(model.getNumEvents())]
+    return {label: n for n, label in enumerate(labels)}
+
+"""
+statements s timed and counted with counter of label
+"""
+def getSourceProfiled(s, profile, label, indent):
+    if not profile:
+        return s
+    return (indent + 'QSP_PROFILE_TIC;\n' + s +
+            indent + 'QSP_PROFILE_TOC({});\n'.format(profile[label]))
+
+"""
+part: 'all' for a single source file. With split source, 'declaration' (internal header:
+counter type, counters declared extern, macros) and 'definition' (counters and dump, one unit),
+so all units count into the same counters.
+"""
+def getSourceFileProfile(profile, part = 'all'):
+    labels = sorted(profile, key = lambda label: profile[label])
+    source = """
+//Profiling counters (compile with -DQSP_PROFILE)
+#ifdef QSP_PROFILE
+"""
+    if part != 'definition':
+        source += """struct ProfileCounter{{
+    unsigned long long count;
+    double seconds;
+}};
+"""
+    if part == 'declaration':
+        source += 'extern ProfileCounter _profile_counter[{0}];\n'
+    else:
+        source += """{3}ProfileCounter _profile_counter[{0}];
+static const char* _profile_type[{0}] = {{{1}}};
+static const int _profile_index[{0}] = {{{2}}};
+//! write counters at exit, to $QSP_PROFILE_FILE (default: qsp_profile.csv)
+struct ProfileDump{{
+    ~ProfileDump(){{
+        const char* filename = std::getenv("QSP_PROFILE_FILE");
+        std::ofstream f(filename ? filename : "qsp_profile.csv", std::ios::trunc);
+        f << "type,index,count,seconds" << std::endl;
+        for (int i = 0; i < {0}; i++)
+        {{
+            f << _profile_type[i] << "," << _profile_index[i] << ","
+                << _profile_counter[i].count << "," << _profile_counter[i].seconds << std::endl;
+        }}
+    }}
+}};
+static ProfileDump _profile_dump;
+"""
+    if part == 'definition':
+        source += '#endif\n'
+    else:
+        source += """#define QSP_PROFILE_START std::chrono::steady_clock::time_point _profile_tic
+#define QSP_PROFILE_TIC _profile_tic = std::chrono::steady_clock::now()
+#define QSP_PROFILE_TOC(n) _profile_counter[n].count++; \\
+    _profile_counter[n].seconds += std::chrono::duration<double>(std::chrono::steady_clock::now() - _profile_tic).count()
+#else
+#define QSP_PROFILE_START
+#define QSP_PROFILE_TIC
+#define QSP_PROFILE_TOC(n)
+#endif
+"""
+    return source.format(len(labels), ', '.join('"{}"'.format(t) for (t, i) in labels),
+                         ', '.join(str(i) for (t, i) in labels), 'static ' if part == 'all' else '')
+
+"""
+reactions
+abm: array of type bool. True if abm assumes part of the reaction
+cse: CommonSubexpressionEliminator, None if not used
+simplifier: AstSimplifier, None if not used. Compartment reciprocals
+    are also precomputed when used.
+table: dydt from the stoichiometry table (getSourceRhsTable) instead of unrolled sums
+"""
+def getSourceFileReaction(class_name, model, assignmentRuleOrder,
+                          speciesStoichiometry, convert_unit, key2var,hybrid_elements, trans, fname,
+                          cse = None, simplifier = None, moieties = (), profile = None, table = False):
+    source = ''
+    if table:
+        source += getSourceRhsTable(model, speciesStoichiometry, convert_unit, key2var)
+    source += """
 int {}::f(realtype t, N_Vector y, N_Vector ydot, void *user_data){{
 
 """.format(class_name)
     source += '    {0}* ptrOde = static_cast<{0}*>(user_data);\n\n'.format(class_name)
+    if profile:
+        source += '    QSP_PROFILE_START;\n\n'
+    source += getSourceReactionBody(model, assignmentRuleOrder, speciesStoichiometry, convert_unit,
+                                    key2var, hybrid_elements, trans, fname, 'NV_DATA_S(ydot)[{}]',
+                                    cse, simplifier, moieties, profile, table)
+    source += '    return(0);\n}'
+    return source
+
+"""
+body of f(): assignment rules, reaction fluxes and dydt, assigned to fydot
+(format string taking the index of y)
+moieties: species removed from y, evaluated from conserved totals
+profile: counter index of ('rule', rule index) and ('flux', reaction index) (getProfileSlots)
+table: fluxes in an array, dydt as product of the stoichiometry table (getSourceRhsTable)
+    and the fluxes
+"""
+def getSourceReactionBody(model, assignmentRuleOrder, speciesStoichiometry, convert_unit,
+                          key2var, hybrid_elements, trans, fname, fydot, cse = None, simplifier = None,
+                          moieties = (), profile = None, table = False):
+    source = ''
+    statements = [model.getRule(i).getMath() for i in assignmentRuleOrder]
+    statements += [model.getReaction(i).getKineticLaw().getMath() for i in range(model.getNumReactions())]
+    if moieties:
+        names = {n for m in statements for n in get_variable_names_from_astnodes(m)}
+        source += '    //Species from conserved totals:\n\n'
+        source += getSourceMoietySpecies(model, moieties, names, convert_unit, trans,
+                                         'ptrOde->_moiety_total[{}]', '    ') + '\n'
+    defs = [[] for m in statements]
+    if simplifier:
+        statements = [simplifier.simplify(m) for m in statements]
+    if cse:
+        original = statements
+        defs, statements = cse.eliminate(original)
+        cse.addReport('f', original, defs, statements)
+        trans = cse.getTranslator(trans)
     # assignment rules
     source += '    //Assignment rules:\n\n'
-    for i in assignmentRuleOrder:
+    for k, i in enumerate(assignmentRuleOrder):
         ar = model.getRule(i)
-        source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
-                                                trans.mathToString(ar.getMath()))
+        source += getSourceTemporaries(defs[k], trans, '    ')
+        s = '    realtype {} = {};\n'.format(trans.fname(ar.getVariable()),
+                                         trans.mathToString(statements[k]))
+        source += getSourceProfiled(s, profile, ('rule', i), '    ') + '\n'
+    if table:
+        return source + getSourceReactionTable(model, assignmentRuleOrder, speciesStoichiometry,
+                                               convert_unit, key2var, hybrid_elements, trans,
+                                               fydot, statements, defs, profile)
+    # compartment reciprocals
+    finv = None
+    if simplifier and convert_unit:
+        finv = lambda c: 'INV_{}'.format(fname(c))
+        compartments = []
+        for sp in model.getListOfSpecies():
+            c = sp.getCompartment()
+            if (sp.getId() in speciesStoichiometry and not sp.getHasOnlySubstanceUnits()
+                and c not in compartments):
+                compartments.append(c)
+        if compartments:
+            source += '    //Compartment reciprocals:\n\n'
+            for c in compartments:
+                source += '    const realtype {} = 1/{};\n'.format(finv(c), trans.fname(c))
+            source += '\n'
     # reaction flux
     source += '    //Reaction fluxes:\n\n'
     for i in range(model.getNumReactions()):
-        r = model.getReaction(i)
-        key = r.getId()
-        k = r.getKineticLaw()
-        m = k.getMath()
-        ud = r.getKineticLaw().getDerivedUnitDefinition()
-        isSPT = ud.isVariantOfSubstancePerTime()
-        reactionFluxSPT =  trans.mathToString(m)
-        if convert_unit and not isSPT:
-            isSubstancePerVolTime = isVariantOfSubstancePerVolumeTime(ud, model_level, model_version)
-            if isSubstancePerVolTime:
-                sr = None
-                if len(r.getListOfProducts()):
-                    sr = r.getListOfProducts()[0]
-                elif len(r.getListOfReactants()):
-                    sr = r.getListOfReactants()[0]
-                if sr:
-                    sp = model.getElementBySId(sr.getSpecies())
-                    reactionFluxSPT = '(' + reactionFluxSPT + ')*{}'.format(trans.fname(sp.getCompartment()))
-                else:
-                    print('Error: no product or reactant in reaction {}. cannot determine compartment.'.format(i))
-            else:
-                print('Error: reaction {} is not substance per time nor substance per volume per time'.format(i)) 
-        #if abm[i]:
-        if key in hybrid_elements:
-            reactionFluxSPT = '{} * ('.format(QSP_WEIGHT_NAME) + reactionFluxSPT + ')'
-        source += '    realtype ReactionFlux{} = {};\n\n'.format(i+1, reactionFluxSPT)
-    
+        k = len(assignmentRuleOrder) + i
+        source += getSourceTemporaries(defs[k], trans, '    ')
+        reactionFluxSPT = getReactionFluxString(model, i, convert_unit, hybrid_elements, trans,
+                                                statements[k])
+        s = '    realtype ReactionFlux{} = {};\n'.format(i+1, reactionFluxSPT)
+        source += getSourceProfiled(s, profile, ('flux', i), '    ') + '\n'
+
     # dydt
     source += '    //dydt:\n\n'
     for sp in model.getListOfSpecies():
         sid = sp.getId()
-        # species not product nor reactant are excluded
-        if sid in speciesStoichiometry: 
-            isConcentration = False
-            if not sp.getHasOnlySubstanceUnits():
-                isConcentration = True
+        # species not product nor reactant, or removed by conserved moieties, are excluded
+        if sid in speciesStoichiometry and sid in key2var:
             source += '    //d({})/dt\n'.format(fname(sid))
-            lhs = '    NV_DATA_S(ydot)[{}] = '.format(key2var[sid]['idx'])
-            dydt = ''
-            for i, (r, stoic) in enumerate(speciesStoichiometry[sid]):
-                pre = (' + '*(i!=0) if stoic > 0 else ' - ' ) + \
-                      ('{}*'.format(int(abs(stoic))) if abs(stoic) != 1 else '')
-                #y += '+({})*ReactionFlux{}'.format(stoic, r+1)
-                dydt += pre + 'ReactionFlux{}'.format(r+1)
-            if convert_unit and isConcentration:
-                dydt = '1/{}*('.format(trans.fname(sp.getCompartment())) + dydt + ')'
+            lhs = '    {} = '.format(fydot.format(key2var[sid]['idx']))
+            dydt = getSpeciesRateString(sp, speciesStoichiometry, convert_unit, trans,
+                                        lambda r: 'ReactionFlux{}'.format(r+1), finv)
             source += (lhs+dydt) + ';\n\n'
-        
-    source += '    return(0);\n}'
     return source
-    
+
+"""
+fluxes and dydt of the table-driven f(), after the assignment rules.
+Coefficients are summed in the order of the unrolled dydt, so the result is the same.
+"""
+def getSourceReactionTable(model, assignmentRuleOrder, speciesStoichiometry, convert_unit,
+                           key2var, hybrid_elements, trans, fydot, statements, defs, profile = None):
+    rows, rowptrs, fluxes, stoich, compartments = getRhsTable(model, speciesStoichiometry,
+                                                              convert_unit, key2var)
+    scales = [None] + sorted({c for c in compartments if c is not None}, key = compartments.index)
+    # reaction flux
+    source = '    //Reaction fluxes:\n\n'
+    source += '    realtype _flux[{}];\n'.format(max(model.getNumReactions(), 1))
+    for i in range(model.getNumReactions()):
+        k = len(assignmentRuleOrder) + i
+        source += getSourceTemporaries(defs[k], trans, '    ')
+        reactionFluxSPT = getReactionFluxString(model, i, convert_unit, hybrid_elements, trans,
+                                                statements[k])
+        s = '    _flux[{}] = {};\n'.format(i, reactionFluxSPT)
+        source += getSourceProfiled(s, profile, ('flux', i), '    ')
+    source += '\n    //Compartment reciprocals:\n\n'
+    source += '    const realtype _scale[{}] = {{{}}};\n\n'.format(len(scales),
+               ', '.join(['1'] + ['1/{}'.format(trans.fname(c)) for c in scales[1:]]))
+    # dydt
+    source += '    //dydt:\n\n'
+    source += '    for (int r = 0; r < {}; r++)\n'.format(len(rows))
+    source += '    {\n'
+    source += '        realtype _rate = 0;\n'
+    source += '        for (int k = _rhs_rowptrs[r]; k < _rhs_rowptrs[r+1]; k++)\n'
+    source += '            _rate += _rhs_stoich[k] * _flux[_rhs_fluxes[k]];\n'
+    source += '        {} = _scale[_rhs_scale[r]] * _rate;\n'.format(fydot.format('_rhs_rows[r]'))
+    source += '    }\n\n'
+    return source
+
+"""
+Analytic Jacobian of the rhs, J[i][j] = d(dydt_i)/d(y_j).
+Reaction fluxes and assignment rules are differentiated symbolically;
+dependency of fluxes on y through assignment rules is resolved with
+the chain rule, using intermediate derivatives of assignment rule
+variables (d<rule variable>_dy<j>).
+sensParams: constant parameter sids. Derivatives with respect to them
+(d<rule variable>_dp<k>, k: position in sensParams) are also resolved,
+for forward sensitivity analysis.
+
+returns:
+1. source of the intermediate derivatives, to be placed in the function body
+2. list of Jacobian entries (i, j, expression, description), ordered by i, then j
+3. list of parameter derivatives (i, k, expression, description), ordered by i, then k
+moieties: species removed from y, linear in y (getConservedMoieties)
+"""
+def getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                          convert_unit, key2var, hybrid_elements, trans, fname, sensParams = [],
+                          moieties = ()):
+    diff = AstDifferentiator()
+    algebraic = {sid: {j for (j, c) in terms} for (sid, terms) in moieties}
+    depAR = getAssignmentRuleSpeciesDependency(model, assignmentRuleOrder, key2var, sensParams,
+                                               algebraic)
+    fluxDep = getReactionFluxSpeciesDependency(model, convert_unit, key2var, depAR, sensParams)
+    idxAssignmentRule = {}
+    for i in range(model.getNumRules()):
+        idxAssignmentRule[model.getRule(i).getVariable()] = i
+    # names referenced by the derivatives. assignment rules needed.
+    namesUsed = set()
+    # y first, then parameters
+    idxSens = {sid: k for k, sid in enumerate(sensParams)}
+    def varOrder(j):
+        return (j in idxSens, idxSens[j] if j in idxSens else key2var[j]['idx'])
+    def varStr(j):
+        return 'p{}'.format(idxSens[j]) if j in idxSens else 'y{}'.format(key2var[j]['idx'])
+
+    # d(name)/d(y_j), None if 0
+    def dNameStr(name, j):
+        if name == j:
+            return '1'
+        elif name in depAR and j in depAR[name]:
+            return 'd{}_d{}'.format(trans.fname(name), varStr(j))
+        return None
+
+    # total derivative of math wrt each y in dep
+    # return {sid_j: expression}
+    def totalDerivative(math, dep, extraNames = []):
+        partials = {}
+        terms = {j: [] for j in dep}
+        for name in set(get_variable_names_from_astnodes(math)) | set(extraNames):
+            dn = {j: dNameStr(name, j) for j in dep}
+            if not any(dn.values()):
+                continue
+            if name not in partials:
+                p = diff.derivative(math, name)
+                if p is None:
+                    continue
+                namesUsed.update(get_variable_names_from_astnodes(p))
+                partials[name] = '1' if diff.isOne(p) else trans.mathToString(p)
+            p = partials[name]
+            for j in dep:
+                if dn[j] is None:
+                    continue
+                if p == '1':
+                    terms[j].append(dn[j])
+                elif dn[j] == '1':
+                    terms[j].append('({})'.format(p))
+                else:
+                    terms[j].append('({}) * {}'.format(p, dn[j]))
+        return {j: ' + '.join(terms[j]) for j in dep if terms[j]}
+
+    source = ''
+    # assignment rules
+    sourceRule = '    //Assignment rule derivatives:\n\n'
+    referenced = {n for i in assignmentRuleOrder
+                  for n in get_variable_names_from_astnodes(model.getRule(i).getMath())}
+    referenced |= {n for r in model.getListOfReactions()
+                   for n in get_variable_names_from_astnodes(r.getKineticLaw().getMath())}
+    for (sid, terms) in moieties:
+        if sid not in referenced:
+            continue
+        for (j, c) in terms:
+            sourceRule += '    realtype {} = {};\n'.format(dNameStr(sid, j),
+                getMoietyDerivativeString(model, sid, j, c, convert_unit, trans))
+    for i in assignmentRuleOrder:
+        ar = model.getRule(i)
+        sid = ar.getVariable()
+        d = totalDerivative(ar.getMath(), sorted(depAR[sid], key = varOrder))
+        for j, e in d.items():
+            sourceRule += '    realtype {} = {};\n'.format(dNameStr(sid, j), e)
+        # derivative is identically zero
+        for j in depAR[sid]:
+            if j not in d:
+                sourceRule += '    realtype {} = 0;\n'.format(dNameStr(sid, j))
+    # reaction flux
+    sourceFlux = '\n    //Reaction flux derivatives:\n\n'
+    fluxDerivative = []
+    for i in range(model.getNumReactions()):
+        r = model.getReaction(i)
+        m = r.getKineticLaw().getMath().deepCopy()
+        c = getReactionFluxCompartment(model, i, convert_unit)
+        if c:
+            compNode = lsb.ASTNode(lsb.AST_NAME)
+            compNode.setName(c)
+            m = diff.times(m, compNode)
+        dep = sorted(fluxDep[i], key = varOrder)
+        d = totalDerivative(m, dep)
+        fluxDerivative.append(d)
+        for j, e in d.items():
+            if r.getId() in hybrid_elements:
+                e = '{} * ('.format(QSP_WEIGHT_NAME) + e + ')'
+            sourceFlux += '    realtype dReactionFlux{}_d{} = {};\n'.format(i+1, varStr(j), e)
+    # assignment rules required for evaluating derivatives
+    ruleUsed = {k for name in namesUsed if name in idxAssignmentRule
+                for k in arGraph.getDependent(idxAssignmentRule[name])}
+    if moieties:
+        names = namesUsed | {n for i in ruleUsed
+                             for n in get_variable_names_from_astnodes(model.getRule(i).getMath())}
+        source += '    //Species from conserved totals:\n\n'
+        source += getSourceMoietySpecies(model, moieties, names, convert_unit, trans,
+                                         'ptrOde->_moiety_total[{}]', '    ') + '\n'
+    source += '    //Assignment rules:\n\n'
+    for i in assignmentRuleOrder:
+        if i in ruleUsed:
+            ar = model.getRule(i)
+            source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
+                                                    trans.mathToString(ar.getMath()))
+    source += sourceRule + sourceFlux
+
+    # Jacobian entries
+    entries = []
+    sensEntries = []
+    fluxValueUsed = set()
+    for sp in model.getListOfSpecies():
+        sid = sp.getId()
+        if sid not in speciesStoichiometry or sid not in key2var:
+            continue
+        i = key2var[sid]['idx']
+        dep = {j for (r, stoic) in speciesStoichiometry[sid] for j in fluxDerivative[r]}
+        comp = sp.getCompartment()
+        scaleDep = set()
+        if convert_unit and not sp.getHasOnlySubstanceUnits():
+            # d(1/V)/dy_j != 0:
+            if comp in depAR:
+                scaleDep = depAR[comp]
+            elif comp in idxSens:
+                scaleDep = {comp}
+        for j in sorted(dep | scaleDep, key = varOrder):
+            # fluxes independent of y_j are skipped
+            fflux = lambda r: 'dReactionFlux{}_d{}'.format(r+1, varStr(j)) \
+                if j in fluxDerivative[r] else '0'
+            e = getSpeciesRateString(sp, speciesStoichiometry, convert_unit, trans, fflux)
+            if j in scaleDep:
+                # -1/V^2*dV/dy_j*sum(flux)
+                fluxValueUsed.update(r for (r, stoic) in speciesStoichiometry[sid])
+                e += ' - {}/({}*{})*({})'.format(dNameStr(comp, j), trans.fname(comp), trans.fname(comp),
+                     getSpeciesRateString(sp, speciesStoichiometry, False, trans,
+                                          lambda r: 'ReactionFlux{}'.format(r+1)))
+            desc = 'd(d({})/dt)/d({})'.format(fname(sid), fname(j))
+            if j in idxSens:
+                sensEntries.append((i, idxSens[j], e, desc))
+            else:
+                entries.append((i, key2var[j]['idx'], e, desc))
+    if fluxValueUsed:
+        source += '\n    //Reaction fluxes:\n\n'
+        for i in sorted(fluxValueUsed):
+            source += '    realtype ReactionFlux{} = {};\n'.format(i+1,
+                getReactionFluxString(model, i, convert_unit, hybrid_elements, trans))
+    return source, entries, sensEntries
+
+def getSourceFileJacobian(class_name, model, assignmentRuleOrder, arGraph,
+                          speciesStoichiometry, convert_unit, key2var, hybrid_elements, trans, fname,
+                          moieties = ()):
+    source = """
+int {0}::Jac(realtype t, N_Vector y, N_Vector fy, SUNMatrix J, void *user_data,
+    N_Vector tmp1, N_Vector tmp2, N_Vector tmp3){{
+
+""".format(class_name)
+    source += '    {0}* ptrOde = static_cast<{0}*>(user_data);\n\n'.format(class_name)
+    v, entries, sensEntries = getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                                                    convert_unit, key2var, hybrid_elements, trans, fname,
+                                                    moieties = moieties)
+    source += v
+    source += '\n    //Jacobian:\n\n'
+    for (i, j, e, desc) in entries:
+        source += '    //{}\n'.format(desc)
+        source += '    SM_ELEMENT_D(J, {}, {}) = {};\n'.format(i, j, e)
+    source += '\n    return(0);\n}\n'
+    return source
+
+"""
+Sparsity pattern of Jacobian in compressed sparse column (CSC) format.
+Diagonal elements are always included (zero if structurally zero),
+so that the solver can add the identity matrix in place.
+entries: [(i, j, expression, description)]
+returns:
+1. column pointers (size nrVar+1)
+2. list of (i, j, expression, description), ordered by column
+"""
+def getJacobianSparsity(entries, nrVar):
+    elements = {(j, i): (i, j, e, desc) for (i, j, e, desc) in entries}
+    for i in range(nrVar):
+        if (i, i) not in elements:
+            elements[(i, i)] = (i, i, '0', '')
+    ordered = [elements[k] for k in sorted(elements)]
+    colptrs = [0]*(nrVar+1)
+    for (i, j, e, desc) in ordered:
+        colptrs[j+1] += 1
+    for j in range(nrVar):
+        colptrs[j+1] += colptrs[j]
+    return colptrs, ordered
+
+"""
+Sparse analytic Jacobian, filling a CSC SUNSparseMatrix (KLU solver)
+"""
+def getSourceFileJacobianSparse(class_name, model, assignmentRuleOrder, arGraph,
+                                speciesStoichiometry, convert_unit, key2var, varlist,
+                                hybrid_elements, trans, fname, moieties = ()):
+    v, entries, sensEntries = getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                                                    convert_unit, key2var, hybrid_elements, trans, fname,
+                                                    moieties = moieties)
+    colptrs, ordered = getJacobianSparsity(entries, len(varlist['sp_var']))
+    nnz = len(ordered)
+    source = '\n//Jacobian sparsity pattern (CSC)\n'
+    source += 'static const sunindextype _jac_colptrs[{}] = {{{}}};\n'.format(len(colptrs),
+               ', '.join(str(c) for c in colptrs))
+    source += 'static const sunindextype _jac_rowvals[{}] = {{{}}};\n'.format(nnz,
+               ', '.join(str(i) for (i, j, e, desc) in ordered))
+    source += """
+sunindextype {0}::getJacobianNNZ(void) const{{
+    return {1};
+}}
+
+int {0}::Jac(realtype t, N_Vector y, N_Vector fy, SUNMatrix J, void *user_data,
+    N_Vector tmp1, N_Vector tmp2, N_Vector tmp3){{
+
+""".format(class_name, nnz)
+    source += '    {0}* ptrOde = static_cast<{0}*>(user_data);\n\n'.format(class_name)
+    source += v
+    source += '\n    //Jacobian:\n\n'
+    source += '    sunindextype* colptrs = SUNSparseMatrix_IndexPointers(J);\n'
+    source += '    sunindextype* rowvals = SUNSparseMatrix_IndexValues(J);\n'
+    source += '    realtype* data = SUNSparseMatrix_Data(J);\n\n'
+    source += '    for (sunindextype k = 0; k < {}; k++)\n'.format(len(colptrs))
+    source += '        colptrs[k] = _jac_colptrs[k];\n'
+    source += '    for (sunindextype k = 0; k < {}; k++)\n'.format(nnz)
+    source += '        rowvals[k] = _jac_rowvals[k];\n\n'
+    for k, (i, j, e, desc) in enumerate(ordered):
+        if desc:
+            source += '    //{}\n'.format(desc)
+        source += '    data[{}] = {};\n'.format(k, e)
+    source += '\n    return(0);\n}\n'
+    return source
+
+"""
+Diagonal blocks of the block triangular Jacobian (y in block order, getSpeciesBlocks).
+The dense linear solver only factorizes these blocks.
+"""
+def getSourceFileJacobianBlocks(class_name, blocks):
+    starts = [0]
+    for b in blocks[:-1]:
+        starts.append(starts[-1] + len(b))
+    source = '\nstd::vector<sunindextype> {}::getJacobianBlocks(void) const{{\n\n'.format(class_name)
+    source += '    //{} blocks, largest: {}\n'.format(len(blocks), max(len(b) for b in blocks))
+    source += '    static std::vector<sunindextype> start = {{{}}};\n'.format(', '.join(str(k) for k in starts))
+    source += '    return start;\n}\n'
+    return source
+
+"""
+Forward sensitivity rhs (CVODES) for constant parameters sensParams:
+ySdot_k = J*yS_k + df/dp_k
+and sensitivity update by event assignments
+"""
+def getSourceFileSensitivity(class_name, model, assignmentRuleOrder, arGraph,
+                             speciesStoichiometry, convert_unit, key2var, varlist, key2name,
+                             hybrid_elements, sensParams, trans, transInSim, fname):
+    v, entries, sensEntries = getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                                                    convert_unit, key2var, hybrid_elements, trans, fname,
+                                                    sensParams)
+    source = """
+int {0}::fS(int Ns, realtype t, N_Vector y, N_Vector ydot, N_Vector *yS, N_Vector *ySdot,
+    void *user_data, N_Vector tmp1, N_Vector tmp2){{
+
+""".format(class_name)
+    source += '    {0}* ptrOde = static_cast<{0}*>(user_data);\n\n'.format(class_name)
+    source += v
+    source += '\n    //Jacobian:\n\n'
+    rows = [[] for sid in varlist['sp_var']]
+    for (i, j, e, desc) in entries:
+        source += '    //{}\n'.format(desc)
+        source += '    realtype J_{}_{} = {};\n'.format(i, j, e)
+        rows[i].append(j)
+    source += '\n    //J*yS:\n\n'
+    source += '    for (int k = 0; k < Ns; k++)\n    {\n'
+    source += '        realtype* s = NV_DATA_S(yS[k]);\n'
+    source += '        realtype* ds = NV_DATA_S(ySdot[k]);\n'
+    for i, r in enumerate(rows):
+        e = ' + '.join('J_{0}_{1}*s[{1}]'.format(i, j) for j in r)
+        source += '        ds[{}] = {};\n'.format(i, e if e else 0)
+    source += '    }\n'
+    source += '\n    //Parameter derivatives:\n\n'
+    for (i, k, e, desc) in sensEntries:
+        source += '    //{}\n'.format(desc)
+        source += '    NV_DATA_S(ySdot[{}])[{}] += {};\n'.format(k, i, e)
+    source += '\n    return(0);\n}\n'
+
+    # event assignments to species: s = d(ea)/dy*s + d(ea)/dp, with y before
+    # the assignment. Trigger times are taken as independent of parameters.
+    diff = AstDifferentiator()
+    idxSens = {sid: k for k, sid in enumerate(sensParams)}
+    source += '\nvoid {}::eventSensitivity(int i){{\n\n'.format(class_name)
+    source += '    if (_ns == 0)\n        return;\n\n'
+    source += '    switch(i)\n    {\n'
+    for n, e in enumerate(model.getListOfEvents()):
+        assigned = [ea for ea in e.getListOfEventAssignments() if ea.getVariable() in key2var
+                    and key2var[ea.getVariable()]['vartype'] == 'sp_var']
+        if not assigned:
+            continue
+        source += '    case {}:\n'.format(n)
+        sourceParam = ''
+        sourceAssign = ''
+        source += '        for (int k = 0; k < _ns; k++)\n        {\n'
+        source += '            realtype* s = NV_DATA_S(_yS[k]);\n'
+        for ea in assigned:
+            sid = ea.getVariable()
+            i = key2var[sid]['idx']
+            m = ea.getMath().deepCopy()
+            for r in reversed(assignmentRuleOrder):
+                ar = model.getRule(r)
+                m.replaceArgument(ar.getVariable(), ar.getMath())
+            terms = []
+            for name in sorted(set(get_variable_names_from_astnodes(m))):
+                isY = name in key2var and key2var[name]['vartype'] == 'sp_var'
+                if not isY and name not in idxSens:
+                    continue
+                d = diff.derivative(m, name)
+                if d is None:
+                    continue
+                d = '1' if diff.isOne(d) else transInSim.mathToString(d)
+                if isY:
+                    j = key2var[name]['idx']
+                    terms.append('s[{}]'.format(j) if d == '1' else '({})*s[{}]'.format(d, j))
+                else:
+                    sourceParam += '        //d({})/d({})\n'.format(fname(sid), fname(name))
+                    sourceParam += '        NV_DATA_S(_yS[{}])[{}] += {};\n'.format(idxSens[name], i, d)
+            source += '            realtype s_{} = {};\n'.format(i, ' + '.join(terms) if terms else 0)
+            sourceAssign += '            s[{0}] = s_{0};\n'.format(i)
+        source += sourceAssign + '        }\n' + sourceParam
+        source += '        break;\n'
+    source += '    default:\n        break;\n'
+    source += '    }\n    return;\n}\n'
+
+    source += '\nrealtype {}::getSensitivityParam(int k) const{{\n\n'.format(class_name)
+    source += '    static std::vector<int> idx = {{{}}};\n'.format(
+        ', '.join(str(key2var[sid]['idx']) for sid in sensParams))
+    source += '    return _class_parameter[idx[k]];\n}\n'
+
+    source += '\nrealtype {}::get_unit_conversion_sensitivity(int k) const{{\n\n'.format(class_name)
+    source += '    static std::vector<realtype> scalor = {\n'
+    for sid in sensParams:
+        source += '        {},//{}\n'.format(key2name[sid]['scaling_use'], fname(sid))
+    source += '    };\n    return scalor[k];\n}\n'
+
+    source += '\nstd::string {}::getSensitivityHeader(){{\n\n'.format(class_name)
+    source += '    std::string s = "";\n'
+    for sid in sensParams:
+        source += '    s += ",{}";\n'.format(fname(sid))
+    source += '    return s;\n}\n'
+    return source
+
+"""
+Body of triggerComponentEvaluateAll: assignment rules of trigger components once,
+then the condition of each component into satisfied[index(i)]. A continuous
+component keeps its current condition while its difference is zero.
+trans: comments; transSim: assignment rules and trigger conditions.
+"""
+def getSourceTriggerComponentsAll(model, allTriggers, triggerCompDep, assignmentRuleOrderTrigger,
+                                  trans, transSim, triggerParser, index, indent,
+                                  simplifier = None):
+    if not allTriggers:
+        return ''
+    source = indent + '//Assignment rules:\n\n'
+    for i in assignmentRuleOrderTrigger:
+        ar = model.getRule(i)
+        m = simplifier.simplify(ar.getMath()) if simplifier else ar.getMath()
+        source += indent + 'realtype {} = {};\n\n'.format(transSim.fname(ar.getVariable()),
+                                                        transSim.mathToString(m))
+    if any(triggerCompDep):
+        source += indent + 'realtype diff = 0;\n\n'
+    for i, trigger in enumerate(allTriggers):
+        source += indent + '//{}\n'.format(trans.mathToString(trigger))
+        if triggerCompDep[i]:
+            rel, cs = triggerParser.parseComponentCondition(trigger, transSim)
+            source += indent + 'diff = {};\n'.format(cs)
+            source += indent + 'if (diff != 0){{\n{0}    satisfied[{1}] = diff > 0;\n{0}}}\n'.format(indent, index(i))
+        else:
+            source += indent + 'satisfied[{}] = {};\n'.format(index(i), transSim.mathToString(trigger))
+    return source
+
 """
 event rootfinding, evaluation and execution
 """
 def getSourceFileEventDetails(class_name, model, allTriggers, triggerCompDep, eventToTrigger,
-                              assignmentRuleOrderTrigger, assignmentRuleOrderEA,
+                              triggerCompTime, assignmentRuleOrderRoot,
+                              assignmentRuleOrderTrigger, assignmentRuleOrderEvent,
                               trans, transStatic, translatorInSim, transMember, 
-                              triggerParser):
+                              triggerParser, cse = None, simplifier = None,
+                              sensitivityEvents = (), reinitEvents = (), profile = None):
                             
     # rootfinding
     source = '\nint {}::g(realtype t, N_Vector y, realtype *gout, void *user_data){{\n\n'.format(class_name)
     
     source += '    {0}* ptrOde = static_cast<{0}*>(user_data);\n\n'.format(class_name)
+    if profile:
+        source += '    QSP_PROFILE_START;\n\n'
+
+    # time-only components are not root functions
+    rootTriggers = [trigger for i, trigger in enumerate(allTriggers) if triggerCompTime[i] is None]
+    statements = [model.getRule(i).getMath() for i in assignmentRuleOrderRoot]
+    statements += [trigger for i, trigger in enumerate(rootTriggers) if triggerCompDep[i]]
+    defs = [[] for m in statements]
+    transRule = trans
+    transTrigger = transStatic
+    if simplifier:
+        statements = [simplifier.simplify(m) for m in statements]
+    if cse:
+        original = statements
+        defs, statements = cse.eliminate(original)
+        cse.addReport('g', original, defs, statements)
+        transRule = cse.getTranslator(trans)
+        transTrigger = cse.getTranslator(transStatic)
     
     source += '    //Assignment rules:\n\n'
-    for i in assignmentRuleOrderTrigger:
+    for k, i in enumerate(assignmentRuleOrderRoot):
         ar = model.getRule(i)
+        source += getSourceTemporaries(defs[k], transRule, '    ')
         source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
-                                                trans.mathToString(ar.getMath()))
-                                                
-    for i, trigger in enumerate(allTriggers):
-        rel, cs = triggerParser.parseComponentCondition(trigger, transStatic)
+                                                transRule.mathToString(statements[k]))
+
+    k = len(assignmentRuleOrderRoot)
+    for i, trigger in enumerate(rootTriggers):
+        cs = 1
+        if triggerCompDep[i]:
+            source += getSourceTemporaries(defs[k], transTrigger, '    ')
+            rel, cs = triggerParser.parseComponentCondition(statements[k], transTrigger)
+            k += 1
         source += '    //{}\n'.format(trans.mathToString(trigger))
-        source += '    gout[{}] = {};\n\n'.format(i, cs if triggerCompDep[i] else 1)
+        source += getSourceProfiled('    gout[{}] = {};\n'.format(i, cs), profile, ('trigger', i), '    ')
+        source += '\n'
         
     source += '    return(0);\n}\n'
 
@@ -2291,8 +4637,8 @@ def getSourceFileEventDetails(class_name, model, allTriggers, triggerCompDep, ev
     source += '    //Assignment rules:\n\n'
     for i in assignmentRuleOrderTrigger:
         ar = model.getRule(i)
-        source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
-                                                trans.mathToString(ar.getMath()))
+        source += '    realtype {} = {};\n\n'.format(translatorInSim.fname(ar.getVariable()),
+                                                translatorInSim.mathToString(ar.getMath()))
     source += '    switch(i)\n    {\n'                                            
     for i, trigger in enumerate(allTriggers):
         source += '    case {}:\n'.format(i)        
@@ -2309,6 +4655,38 @@ def getSourceFileEventDetails(class_name, model, allTriggers, triggerCompDep, ev
 	   
     source += '    return eval;\n}\n'
 
+    sourceFull += source
+
+    # evaluating all trigger components, sharing the assignment rules
+    source = '\nvoid {}::triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied) {{\n\n'.format(class_name)
+    source += getSourceTriggerComponentsAll(model, allTriggers, triggerCompDep, assignmentRuleOrderTrigger,
+                                            trans, translatorInSim, triggerParser,
+                                            lambda i: str(i), '    ')
+    source += '    return;\n}\n'
+
+    sourceFull += source
+    
+    # time at which one time-only trigger component changes
+    source = '\nrealtype {}::triggerComponentTime(int i, int& direction) {{\n\n'.format(class_name)
+    source += '    realtype tTrigger = 0;\n'
+    source += '    //Assignment rules:\n\n'
+    for i in assignmentRuleOrderTrigger:
+        ar = model.getRule(i)
+        source += '    realtype {} = {};\n\n'.format(translatorInSim.fname(ar.getVariable()),
+                                                translatorInSim.mathToString(ar.getMath()))
+    source += '    switch(i)\n    {\n'
+    for i, trigger in enumerate(allTriggers):
+        if triggerCompTime[i] is None:
+            continue
+        direction, math = triggerCompTime[i]
+        source += '    case {}:\n'.format(i)
+        source += '        //{}\n'.format(trans.mathToString(trigger))
+        source += '        direction = {};\n'.format(direction)
+        source += '        tTrigger = {};\n'.format(translatorInSim.mathToString(math))
+        source += '        break;\n'
+    source += '    default:\n        break;\n    }\n'
+    source += '    return tTrigger;\n}\n'
+
     sourceFull += source
     
     # event evaluation
@@ -2327,54 +4705,101 @@ def getSourceFileEventDetails(class_name, model, allTriggers, triggerCompDep, ev
     
     # event execution
     idt0 = '    '
-    def eventAssignmentStr(e, n):
+    # each event: assignment rules it depends on, then its assignments.
+    # assignments within one event change variables, which
+    # are excluded from elimination.
+    groups = []
+    for i, e in enumerate(model.getListOfEvents()):
+        groups.append([model.getRule(k).getMath() for k in assignmentRuleOrderEvent[i]] +
+                      [ea.getMath() for ea in e.getListOfEventAssignments()])
+    if simplifier:
+        groups = [[simplifier.simplify(m) for m in g] for g in groups]
+    groupDefs = [[[] for m in g] for g in groups]
+    transEA = translatorInSim
+    if cse:
+        original = []
+        rewritten = []
+        allDefs = []
+        nrTemp = 0
+        for k, e in enumerate(model.getListOfEvents()):
+            excluded = {ea.getVariable() for ea in e.getListOfEventAssignments()}
+            d, r = cse.eliminate(groups[k], excluded, nrTemp)
+            nrTemp += sum(len(x) for x in d)
+            original += groups[k]
+            rewritten += r
+            allDefs += d
+            groups[k] = r
+            groupDefs[k] = d
+        cse.addReport('eventExecution', original, allDefs, rewritten)
+        transEA = cse.getTranslator(translatorInSim)
+
+    def eventAssignmentStr(i, e, n, maths, defs):
         s = ''
-        for ea in e.getListOfEventAssignments():
+        # assignment rules of this event
+        nr = len(assignmentRuleOrderEvent[i])
+        for k, r in enumerate(assignmentRuleOrderEvent[i]):
+            s += getSourceTemporaries(defs[k], transEA, idt0*n)
+            s += idt0*n + 'realtype {} = {};\n'.format(translatorInSim.fname(model.getRule(r).getVariable()),
+                                                     transEA.mathToString(maths[k]))
+        if i in sensitivityEvents:
+            # before the assignments change y
+            s += idt0*n + 'eventSensitivity(i);\n'
+        for k, ea in enumerate(e.getListOfEventAssignments()):
+            s += getSourceTemporaries(defs[nr + k], transEA, idt0*n)
             s += (idt0*n + translatorInSim.fname(ea.getVariable()) + ' = ' + 
-                        translatorInSim.mathToString(ea.getMath()) + ';\n')
+                        transEA.mathToString(maths[nr + k]) + ';\n')
         return s
         
     source = '\nbool {}::eventExecution(int i, bool delayed, realtype& dt)'.format(class_name)
     source += '{\n\n'
     source += '    bool setDelay = false;\n\n'
+    if profile:
+        source += '    QSP_PROFILE_START;\n\n'
         
-        # assignment rules
-    source += '    //Assignment rules:\n\n'
-    for i in assignmentRuleOrderEA:
-        ar = model.getRule(i)
-        source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
-                                                trans.mathToString(ar.getMath()))
     source += '    switch(i)\n    {\n'
     for i, e in enumerate(model.getListOfEvents()):
         source += '    case {}:\n'.format(i)
-        execution = ''
-        n = 0        
+        before = ''
+        after = ''
+        n = 2
         if e.isSetDelay():
             n = 4
             t = e.getDelay()
             persist = e.getTrigger().getPersistent()
-            execution += (idt0*2 + 'if (!delayed) { \n')
-            execution += (idt0*3 + 'setDelay = true;\n')
-            execution += (idt0*3 + 'dt = {};\n'.format(t))
-            execution += (idt0*2 + '} else {\n')            
+            before += (idt0*2 + 'if (!delayed) { \n')
+            before += (idt0*3 + 'setDelay = true;\n')
+            before += (idt0*3 + 'dt = {};\n'.format(t))
+            before += (idt0*2 + '} else {\n')            
             if persist:
-                execution += (idt0*3 + 'bool trigger = true;\n')
+                before += (idt0*3 + 'bool trigger = true;\n')
             else:
-                execution += (idt0*3 + 'bool trigger = eventEvaluate(i);\n')
-            execution += (idt0*3 + 'if (trigger) {\n')
-            execution += '{}'
-            execution += (idt0*3 + '}\n')
-            execution += (idt0*2 + '}\n')            
-        else:
-            execution = '{}'
-            n = 2
-        eaStr = eventAssignmentStr(e, n)
-        executionFull = execution.format(eaStr)
-
-        source += executionFull
+                before += (idt0*3 + 'bool trigger = eventEvaluate(i);\n')
+            before += (idt0*3 + 'if (trigger) {\n')
+            after += (idt0*3 + '}\n')
+            after += (idt0*2 + '}\n')            
+        elif assignmentRuleOrderEvent[i] or any(groupDefs[i]):
+            # rules and temporaries need their own scope within the case
+            before = idt0*2 + '{\n'
+            after = idt0*2 + '}\n'
+            n = 3
+        eaStr = getSourceProfiled(eventAssignmentStr(i, e, n, groups[i], groupDefs[i]),
+                                  profile, ('event', i), idt0*n)
+
+        source += before + eaStr + after
         source += '        break;\n' 
     source += '    default:\n        break;\n'    
-    source += '    }\n    return setDelay;\n}'
+    source += '    }\n    return setDelay;\n}\n'
+    sourceFull += source
+
+    # events changing y, rhs or root functions
+    source = '\nbool {}::eventNeedsReinit(int i) const {{\n'.format(class_name)
+    source += '    switch(i)\n    {\n'
+    for i in sorted(reinitEvents):
+        source += '    case {}:\n'.format(i)
+    if reinitEvents:
+        source += '        return true;\n'
+    source += '    default:\n        return false;\n'
+    source += '    }\n}\n'
     sourceFull += source
     return sourceFull
     
@@ -2383,14 +4808,26 @@ def getSourceFileEventDetails(class_name, model, allTriggers, triggerCompDep, ev
 Header and output handling
 """    
 def getSourceFileHandleOutput(class_name, model, varlist, key2name, trans, translator, 
-                              assignmentRuleOrderExtraSpec):
+                              assignmentRuleOrderExtraSpec, convert_unit = True, moieties = (),
+                              outputOrder = None):
+    if outputOrder is None:
+        outputOrder = varlist['sp_var'] + varlist['sp_other']
     source = '\nvoid {}::update_y_other(void){{\n\n'.format(class_name)
+    # only species in output
+    if moieties:
+        names = set(outputOrder) | {n for i in assignmentRuleOrderExtraSpec
+                                    for n in get_variable_names_from_astnodes(model.getRule(i).getMath())}
+        source += '    //Species from conserved totals:\n\n'
+        source += getSourceMoietySpecies(model, moieties, names,
+                                         convert_unit, trans, '_moiety_total[{}]', '    ') + '\n'
     for i in assignmentRuleOrderExtraSpec:
         ar = model.getRule(i)
         source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
                                                 trans.mathToString(ar.getMath()))
                                                 
     for i, sid in enumerate(varlist['sp_other']):
+        if sid not in outputOrder:
+            continue
         source += '    //{}\n'.format(translator.fname(sid))
         source += '    _species_other[{}] = {};\n\n'.format(i, trans.fname(sid))
     
@@ -2399,13 +4836,25 @@ def getSourceFileHandleOutput(class_name, model, varlist, key2name, trans, trans
     source += 'std::string {}::getHeader(){{\n\n'.format(class_name)
     
     source += '    std::string s = "";\n'
-    for i, sid in enumerate(varlist['sp_var']):
-        source += '    s += ",{}";\n'.format(translator.fname(sid))
-        
-    for i, sid in enumerate(varlist['sp_other']):
+    for i, sid in enumerate(outputOrder):
         source += '    s += ",{}";\n'.format(translator.fname(sid))
     
     source += '    return s;\n}'
+
+    source += '\nstd::vector<std::string> {}::getHeaderUnits(){{\n\n'.format(class_name)
+    source += '    static std::vector<std::string> units = {\n'
+    for sid in outputOrder:
+        unit = key2name[sid]['unit_raw'] or ''
+        source += '        "{}",\n'.format(unit.replace('\\', '\\\\').replace('"', '\\"'))
+    source += '    };\n    return units;\n}'
+
+    # y in block order, species removed from y are stored after the other species
+    storage = varlist['sp_var'] + varlist['sp_other']
+    if storage != outputOrder:
+        source += '\nint {}::get_output_index(int i) const{{\n\n'.format(class_name)
+        source += '    static std::vector<int> idx = {{{}}};\n'.format(
+            ', '.join(str(storage.index(sid)) for sid in outputOrder))
+        source += '    return idx[i];\n}'
     
     source += '\nrealtype {}::get_unit_conversion_species(int i) const{{\n\n'.format(class_name)
     source += '    static std::vector<realtype> scalor = {\n'
@@ -2424,41 +4873,575 @@ def getSourceFileHandleOutput(class_name, model, varlist, key2name, trans, trans
     source += '    };\n    return scalor[i];\n}'
     return source
 
-def getParamSourceConetent(name_space, model, key2name):
-    n_param = 0
-    source = """#include "Param.h"
+"""
+Ensemble class: one solver for many members (parameter sets, e.g. virtual patients).
+y holds one block of NR_Y species per member; non-species variables and constant
+parameters are also stored per member. Generated code for one member is the same
+as in the single class, with the SPVAR, NSPVAR and PARAM macros pointing into the
+block of member m (getEnsembleMemberBlock).
+Trigger components: all rootfinding ones (member-major), then all time-only ones.
+"""
+def getEnsembleHeaderContent(class_name, name_space):
+    header = """#pragma once
 
-#include <boost/property_tree/xml_parser.hpp>
-#include <iostream>
-#include <string>
-#include <math.h>
+#include "CVODEBase.h"
+#include "Param.h"
 
-namespace pt = boost::property_tree;
+namespace {1}{{
+
+//! Model with many parameter sets (members), integrated by one solver.
+//! The Jacobian is block diagonal, one block per member (sparse, KLU).
+class {0} :
+	public CVODEBase
+{{
+public:
+    //! ODE right hand side of all members
+    static int f(realtype t, N_Vector y, N_Vector ydot, void *user_data);
+    //! Root finding (for events) of all members
+    static int g(realtype t, N_Vector y, realtype *gout, void *user_data);
+    //! block diagonal Jacobian of ODE right hand side
+    static int Jac(realtype t, N_Vector y, N_Vector fy, SUNMatrix J, void *user_data,
+        N_Vector tmp1, N_Vector tmp2, N_Vector tmp3);
+    //! variable names of one member
+    static std::string getHeader();
+public:
+    {0}(int n);
+    ~{0}();
+
+    //! number of members
+    int getNumMembers(void) const {{ return _nmember; }};
+    // read tolerance from parameter file
+    void setup_instance_tolerance(Param& param);
+    // read parameters and variables of member m from parameter file, evaluate initial assignment
+    void setup_member(int m, Param& param);
+    //! species i of member m (y, then other species), with original units
+    double getMemberVar(int m, unsigned int i) const;
+protected:
+    void setupVariables(void);
+    void setupEvents(void);
+    void initSolver(realtype t0);
+    void update_y_other(void);
+    //! update species not in y of member m
+    void update_member_y_other(int m);
+    bool triggerComponentEvaluate(int i, realtype t, bool curr);
+    //! evaluate all trigger components, assignment rules once
+    void triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied);
+    //! time when a time-only trigger component changes
+    realtype triggerComponentTime(int i, int& direction);
+    //! evaluate one event trigger
+    bool eventEvaluate(int i);
+    //! execute one event
+    bool eventExecution(int i, bool delay, realtype& dt);
+    //! if event i changes y, rhs or root functions
+    bool eventNeedsReinit(int i) const;
+    //! unit conversion factor for species (y and non-y)
+    realtype get_unit_conversion_species(int i) const;
+    //! unit conversion foactor for non-species variables
+    realtype get_unit_conversion_nspvar(int i) const;
+    //! analytic Jacobian passed to the solver
+    CVLsJacFn getJacobianFn(void) const {{ return Jac; }};
+    //! number of nonzero elements in sparse Jacobian
+    sunindextype getJacobianNNZ(void) const;
+private:
+    //! index of trigger component k of member m
+    int triggerIndex(int m, int k) const;
+    //! member m and its trigger component k of trigger component i
+    void triggerMember(int i, int& m, int& k) const;
+
+    //! number of members
+    int _nmember;
+    //! constant parameters, one block per member
+    state_type _member_parameter;
+}};
+
+}};
 """
-    source += 'namespace {}'.format(name_space)
-    source += """{
-using std::string;
-using std::vector;
+    return header.format(class_name, name_space)
 
-#define PARAM_DESCRIPTION_FIELD_COUNT 3
-const char* _description[][PARAM_DESCRIPTION_FIELD_COUNT] =
-{
 """
-    source += '    //simulation settings\n'
-    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_START
-    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
-    n_param += 1
-    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_STEP
-    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
-    n_param += 1
-    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_NSTEP
-    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
-    n_param += 1
-    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_TOL_REL
-    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
-    n_param += 1
-    path = XML_ROOT+ '.' + XML_SIM+ '.' + XML_TOL_ABS
-    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+pointers to the block of member m, used by the SPVAR, NSPVAR and PARAM macros.
+y: species array; owner: prefix to members of the ensemble object.
+"""
+def getEnsembleMemberBlock(y, owner, indent):
+    source = indent + 'realtype* _ym = {} + m * NR_Y;\n'.format(y)
+    source += indent + 'realtype* _nspm = {}_nonspecies_var.data() + m * NR_NSPVAR;\n'.format(owner)
+    source += indent + 'realtype* _pm = {}_member_parameter.data() + m * NR_PARAM;\n\n'.format(owner)
+    return source
+
+"""
+macros and block sizes of one member
+"""
+def getSourceFileEnsembleMacro(class_name, model, varlist, triggerCompTime):
+    nrTimed = sum(1 for x in triggerCompTime if x is not None)
+    source = '#include "{}.h"\n\n'.format(class_name)
+    source += """#define SPVAR(x) _ym[x]
+#define NSPVAR(x) _nspm[x]
+#define PARAM(x) _pm[x]
+#define PFILE(x) param.getVal(x)
+
+"""
+    source += '//block sizes of one member\n'
+    source += '#define NR_Y {}\n'.format(len(varlist['sp_var']))
+    source += '#define NR_OTHER {}\n'.format(len(varlist['sp_other']))
+    source += '#define NR_NSPVAR {}\n'.format(len(varlist['nsp_var']))
+    source += '#define NR_PARAM {}\n'.format(len(varlist['p_const']))
+    source += '#define NR_ROOT {}\n'.format(len(triggerCompTime) - nrTimed)
+    source += '#define NR_TIMED {}\n'.format(nrTimed)
+    source += '#define NR_EVENT {}\n\n'.format(model.getNumEvents())
+    return source
+
+def getSourceFileEnsembleSetup(class_name, model, key2name, key2var, varlist, allTriggers,
+                               triggerCompTime, id_reltol, id_abstol,
+                               assignmentRuleOrderIA, initialAssignmentOrder,
+                               triggerParser, trans, fname, fold = False):
+    nrTimed = sum(1 for x in triggerCompTime if x is not None)
+    nrRoot = len(allTriggers) - nrTimed
+    source = """
+{0}::{0}(int n)
+:CVODEBase()
+, _nmember(n)
+, _member_parameter(n * NR_PARAM, 0)
+{{
+    setupVariables();
+    setupEvents();
+    setupCVODE();
+    update_y_other();
+}}
+
+{0}::~{0}()
+{{
+}}
+""".format(class_name)
+    source += getSourceFileInitSolver(class_name)
+
+    source += """
+void {}::setupVariables(void){{
+
+    _species_var = std::vector<realtype>(_nmember * NR_Y, 0);
+    _nonspecies_var = std::vector<realtype>(_nmember * NR_NSPVAR, 0);
+    //species not part of ode left-hand side
+    _species_other =  std::vector<realtype>(_nmember * NR_OTHER, 0);
+    return;
+}}
+""".format(class_name)
+
+    source += """
+void {}::setup_instance_tolerance(Param& param){{
+
+    //Tolerance
+    realtype reltol = PFILE({});
+    realtype abstol_base = PFILE({});
+    N_Vector abstol = N_VNew_Serial(_neq);
+
+    for (int i = 0; i < _neq; i++)
+    {{
+        NV_DATA_S(abstol)[i] = abstol_base * get_unit_conversion_species(i);
+    }}
+    int flag = CVodeSVtolerances(_cvode_mem, reltol, abstol);
+    check_flag(&flag, "CVodeSVtolerances", 1);
+    N_VDestroy_Serial(abstol);
+    return;
+}}
+""".format(class_name, id_reltol, id_abstol)
+
+    # parameters, variables and initial assignments of one member
+    source += '\nvoid {}::setup_member(int m, Param& param){{\n\n'.format(class_name)
+    source += '    if (m < 0 || m >= _nmember)\n'
+    source += '        throw std::invalid_argument("Ensemble member: out of range");\n\n'
+    source += getEnsembleMemberBlock('_species_var.data()', '', '    ')
+    for vartype in ['p_const', 'sp_var', 'nsp_var']:
+        for key in varlist[vartype]:
+            e = key2name[key]
+            source += '    //{}, {}, index: {}\n'.format(fname(key), key, key2var[key]['idx'])
+            source += '    //Unit: {}\n'.format(e['unit_use'])
+            source += '    {} = {};\n'.format(trans.fname(key), getScaledParamString(e, fold))
+    source += '    //Assignment Rules required before IA\n'
+    for i in assignmentRuleOrderIA:
+        ar = model.getRule(i)
+        source += '    realtype {} = {};\n'.format(trans.fname(ar.getVariable()),
+                                                trans.mathToString(ar.getMath()))
+    source += '    //InitialAssignment\n'
+    for i in initialAssignmentOrder:
+        ia = model.getInitialAssignment(i)
+        sid = ia.getSymbol()
+        if sid in key2var:
+            source += '    {} = {};\n'.format(trans.fname(sid), trans.mathToString(ia.getMath()))
+    source += """
+    for (int i = 0; i < NR_Y; i++)
+    {
+        NV_DATA_S(_y)[m * NR_Y + i] = _ym[i];
+    }
+    update_member_y_other(m);
+    return;
+}
+"""
+
+    # events
+    source += '\nvoid {}::setupEvents(void){{\n\n'.format(class_name)
+    source += '    _nevent = _nmember * NR_EVENT;\n'
+    source += '    _nroot = _nmember * NR_ROOT;\n'
+    source += '    _ntimed = _nmember * NR_TIMED;\n\n'
+    source += '    _trigger_element_type = std::vector<EVENT_TRIGGER_ELEM_TYPE>(_nroot + _ntimed, TRIGGER_NON_INSTANT);\n'
+    source += '    _trigger_element_satisfied = std::vector<bool>(_nroot + _ntimed, false);\n'
+    source += '    _event_triggered = std::vector<bool>(_nevent, false);\n\n'
+    source += '    for (int m = 0; m < _nmember; m++)\n    {\n'
+    for i, trigger in enumerate(allTriggers):
+        rel, cs = triggerParser.parseComponentCondition(trigger, trans)
+        source += '        //{}\n'.format(trans.mathToString(trigger))
+        source += '        _trigger_element_type[triggerIndex(m, {})] = {};\n'.format(i, rel)
+    for i in range(model.getNumEvents()):
+        init = model.getEvent(i).getTrigger().getInitialValue()
+        source += '        _event_triggered[m * NR_EVENT + {}] = {};\n'.format(i, 'true' if init else 'false')
+    source += '    }\n    return;\n}\n'
+
+    source += '\nint {}::triggerIndex(int m, int k) const{{\n'.format(class_name)
+    source += '    return k < NR_ROOT ? m * NR_ROOT + k : _nroot + m * NR_TIMED + k - NR_ROOT;\n}\n'
+    source += '\nvoid {}::triggerMember(int i, int& m, int& k) const{{\n'.format(class_name)
+    if nrRoot:
+        source += '    if (i < _nroot)\n    {\n'
+        source += '        m = i / NR_ROOT;\n'
+        source += '        k = i % NR_ROOT;\n'
+        source += '        return;\n    }\n'
+    if nrTimed:
+        source += '    m = (i - _nroot) / NR_TIMED;\n'
+        source += '    k = NR_ROOT + (i - _nroot) % NR_TIMED;\n'
+    source += '    return;\n}\n'
+    return source
+
+def getSourceFileEnsembleRhs(class_name, model, assignmentRuleOrder, arGraph,
+                             assignmentRuleOrderReaction, speciesStoichiometry, convert_unit,
+                             key2var, varlist, trans, fname, cse = None, simplifier = None,
+                             table = False):
+    idt = '    '
+    # rhs
+    source = ''
+    if table:
+        source += getSourceRhsTable(model, speciesStoichiometry, convert_unit, key2var)
+    source += """
+int {0}::f(realtype t, N_Vector y, N_Vector ydot, void *user_data){{
+
+    {0}* ptrOde = static_cast<{0}*>(user_data);
+
+    for (int m = 0; m < ptrOde->_nmember; m++)
+    {{
+""".format(class_name)
+    source += getEnsembleMemberBlock('NV_DATA_S(y)', 'ptrOde->', idt*2)
+    source += idt*2 + 'realtype* _dm = NV_DATA_S(ydot) + m * NR_Y;\n\n'
+    body = getSourceReactionBody(model, assignmentRuleOrderReaction, speciesStoichiometry,
+                                 convert_unit, key2var, set(), trans, fname, '_dm[{}]', cse, simplifier,
+                                 table = table)
+    source += textwrap.indent(body, idt)
+    source += '    }\n    return(0);\n}\n'
+
+    # block diagonal Jacobian
+    v, entries, sensEntries = getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                                                    convert_unit, key2var, set(), trans, fname)
+    colptrs, ordered = getJacobianSparsity(entries, len(varlist['sp_var']))
+    nnz = len(ordered)
+    source += '\n//Jacobian sparsity pattern of one member (CSC)\n'
+    source += 'static const sunindextype _jac_colptrs[{}] = {{{}}};\n'.format(len(colptrs),
+               ', '.join(str(c) for c in colptrs))
+    source += 'static const sunindextype _jac_rowvals[{}] = {{{}}};\n'.format(nnz,
+               ', '.join(str(i) for (i, j, e, desc) in ordered))
+    source += """
+sunindextype {0}::getJacobianNNZ(void) const{{
+    return _nmember * {1};
+}}
+
+int {0}::Jac(realtype t, N_Vector y, N_Vector fy, SUNMatrix J, void *user_data,
+    N_Vector tmp1, N_Vector tmp2, N_Vector tmp3){{
+
+    {0}* ptrOde = static_cast<{0}*>(user_data);
+
+    sunindextype* colptrs = SUNSparseMatrix_IndexPointers(J);
+    sunindextype* rowvals = SUNSparseMatrix_IndexValues(J);
+    realtype* data = SUNSparseMatrix_Data(J);
+
+    for (int m = 0; m < ptrOde->_nmember; m++)
+    {{
+""".format(class_name, nnz)
+    source += getEnsembleMemberBlock('NV_DATA_S(y)', 'ptrOde->', idt*2)
+    source += idt*2 + 'sunindextype offset = m * {};\n'.format(nnz)
+    source += idt*2 + 'for (sunindextype k = 0; k < NR_Y; k++)\n'
+    source += idt*3 + 'colptrs[m * NR_Y + k] = offset + _jac_colptrs[k];\n'
+    source += idt*2 + 'for (sunindextype k = 0; k < {}; k++)\n'.format(nnz)
+    source += idt*3 + 'rowvals[offset + k] = m * NR_Y + _jac_rowvals[k];\n'
+    source += idt*2 + 'realtype* _jm = data + offset;\n\n'
+    source += textwrap.indent(v, idt)
+    source += '\n        //Jacobian:\n\n'
+    for k, (i, j, e, desc) in enumerate(ordered):
+        if desc:
+            source += idt*2 + '//{}\n'.format(desc)
+        source += idt*2 + '_jm[{}] = {};\n'.format(k, e)
+    source += '    }\n'
+    source += '    colptrs[ptrOde->_nmember * NR_Y] = ptrOde->_nmember * {};\n'.format(nnz)
+    source += '\n    return(0);\n}\n'
+    return source
+
+def getSourceFileEnsembleEvents(class_name, model, allTriggers, triggerCompDep, eventToTrigger,
+                                triggerCompTime, assignmentRuleOrderRoot,
+                                assignmentRuleOrderTrigger, assignmentRuleOrderEvent,
+                                trans, triggerParser, simplifier = None, reinitEvents = ()):
+    idt = '    '
+    def rules(order, indent):
+        s = ''
+        for i in order:
+            ar = model.getRule(i)
+            m = ar.getMath()
+            if simplifier:
+                m = simplifier.simplify(m)
+            s += indent + 'realtype {} = {};\n'.format(trans.fname(ar.getVariable()), trans.mathToString(m))
+        return s
+
+    # rootfinding
+    source = """
+int {0}::g(realtype t, N_Vector y, realtype *gout, void *user_data){{
+
+    {0}* ptrOde = static_cast<{0}*>(user_data);
+
+    for (int m = 0; m < ptrOde->_nmember; m++)
+    {{
+""".format(class_name)
+    source += getEnsembleMemberBlock('NV_DATA_S(y)', 'ptrOde->', idt*2)
+    source += idt*2 + 'realtype* _gm = gout + m * NR_ROOT;\n\n'
+    source += idt*2 + '//Assignment rules:\n\n'
+    source += rules(assignmentRuleOrderRoot, idt*2)
+    for i, trigger in enumerate(allTriggers):
+        if triggerCompTime[i] is not None:
+            continue
+        cs = 1
+        if triggerCompDep[i]:
+            rel, cs = triggerParser.parseComponentCondition(
+                simplifier.simplify(trigger) if simplifier else trigger, trans)
+        source += idt*2 + '//{}\n'.format(trans.mathToString(trigger))
+        source += idt*2 + '_gm[{}] = {};\n'.format(i, cs)
+    source += '    }\n    return(0);\n}\n'
+
+    # evaluating one trigger component
+    source += '\nbool {}::triggerComponentEvaluate(int i, realtype t, bool curr) {{\n\n'.format(class_name)
+    source += '    int m = 0, k = 0;\n'
+    source += '    triggerMember(i, m, k);\n'
+    source += getEnsembleMemberBlock('NV_DATA_S(_y)', '', idt)
+    source += '    bool discrete = false;\n'
+    source += '    realtype diff = 0;\n'
+    source += '    bool eval = false;\n'
+    source += '    //Assignment rules:\n\n'
+    source += rules(assignmentRuleOrderTrigger, idt)
+    source += '    switch(k)\n    {\n'
+    for i, trigger in enumerate(allTriggers):
+        source += '    case {}:\n'.format(i)
+        source += '        //{}\n'.format(trans.mathToString(trigger))
+        if triggerCompDep[i]:
+            rel, cs = triggerParser.parseComponentCondition(trigger, trans)
+            source += '        diff = {};\n'.format(cs)
+        else:
+            source += '        eval = {};\n'.format(trans.mathToString(trigger))
+            source += '        discrete = true;\n'
+        source += '        break;\n'
+    source += '    default:\n        break;\n    }\n'
+    source += '    if (!discrete){\n        eval = diff == 0 ? curr : (diff > 0);\n    }\n'
+    source += '    return eval;\n}\n'
+
+    # evaluating all trigger components, assignment rules once per member
+    source += '\nvoid {}::triggerComponentEvaluateAll(realtype t, std::vector<bool>& satisfied) {{\n\n'.format(class_name)
+    source += '    for (int m = 0; m < _nmember; m++)\n    {\n'
+    source += getEnsembleMemberBlock('NV_DATA_S(_y)', '', idt*2)
+    source += getSourceTriggerComponentsAll(model, allTriggers, triggerCompDep, assignmentRuleOrderTrigger,
+                                            trans, trans, triggerParser,
+                                            lambda i: 'triggerIndex(m, {})'.format(i), idt*2, simplifier)
+    source += '    }\n    return;\n}\n'
+
+    # time at which one time-only trigger component changes
+    source += '\nrealtype {}::triggerComponentTime(int i, int& direction) {{\n\n'.format(class_name)
+    source += '    int m = 0, k = 0;\n'
+    source += '    triggerMember(i, m, k);\n'
+    source += getEnsembleMemberBlock('NV_DATA_S(_y)', '', idt)
+    source += '    realtype tTrigger = 0;\n'
+    source += '    //Assignment rules:\n\n'
+    source += rules(assignmentRuleOrderTrigger, idt)
+    source += '    switch(k)\n    {\n'
+    for i, trigger in enumerate(allTriggers):
+        if triggerCompTime[i] is None:
+            continue
+        direction, math = triggerCompTime[i]
+        source += '    case {}:\n'.format(i)
+        source += '        //{}\n'.format(trans.mathToString(trigger))
+        source += '        direction = {};\n'.format(direction)
+        source += '        tTrigger = {};\n'.format(trans.mathToString(math))
+        source += '        break;\n'
+    source += '    default:\n        break;\n    }\n'
+    source += '    return tTrigger;\n}\n'
+
+    # event evaluation
+    g = lambda x: 'getSatisfied(triggerIndex(m, {}))'.format(x)
+    source += '\nbool {}::eventEvaluate(int i) {{\n'.format(class_name)
+    source += '    int m = i / NR_EVENT;\n'
+    source += '    bool eval = false;\n    switch(i % NR_EVENT)\n    {\n'
+    for i, e in enumerate(model.getListOfEvents()):
+        s, c = triggerParser.parseTrigger(e.getTrigger().getMath())
+        source += '    case {}:\n'.format(i)
+        source += '        eval = ' + s.format(*(map(g, eventToTrigger[i]))) + ';\n'
+        source += '        break;\n'
+    source += '    default:\n        break;\n'
+    source += '    }\n    return eval;\n}\n'
+
+    # event execution
+    source += '\nbool {}::eventExecution(int i, bool delayed, realtype& dt){{\n\n'.format(class_name)
+    source += '    int m = i / NR_EVENT;\n'
+    source += getEnsembleMemberBlock('NV_DATA_S(_y)', '', idt)
+    source += '    bool setDelay = false;\n\n'
+    source += '    switch(i % NR_EVENT)\n    {\n'
+    for i, e in enumerate(model.getListOfEvents()):
+        source += '    case {}:\n'.format(i)
+        n = 2
+        if e.isSetDelay():
+            n = 4
+            source += idt*2 + 'if (!delayed) {\n'
+            source += idt*3 + 'setDelay = true;\n'
+            source += idt*3 + 'dt = {};\n'.format(trans.mathToString(e.getDelay().getMath()))
+            source += idt*2 + '} else {\n'
+            if e.getTrigger().getPersistent():
+                source += idt*3 + 'bool trigger = true;\n'
+            else:
+                source += idt*3 + 'bool trigger = eventEvaluate(i);\n'
+            source += idt*3 + 'if (trigger) {\n'
+        elif assignmentRuleOrderEvent[i]:
+            # rules need their own scope within the case
+            n = 3
+            source += idt*2 + '{\n'
+        source += rules(assignmentRuleOrderEvent[i], idt*n)
+        for ea in e.getListOfEventAssignments():
+            m = ea.getMath()
+            if simplifier:
+                m = simplifier.simplify(m)
+            source += idt*n + '{} = {};\n'.format(trans.fname(ea.getVariable()), trans.mathToString(m))
+        if e.isSetDelay():
+            source += idt*3 + '}\n'
+            source += idt*2 + '}\n'
+        elif assignmentRuleOrderEvent[i]:
+            source += idt*2 + '}\n'
+        source += '        break;\n'
+    source += '    default:\n        break;\n'
+    source += '    }\n    return setDelay;\n}\n'
+
+    # events changing y, rhs or root functions of a member
+    source += '\nbool {}::eventNeedsReinit(int i) const {{\n'.format(class_name)
+    source += '    switch(i % NR_EVENT)\n    {\n'
+    for i in sorted(reinitEvents):
+        source += '    case {}:\n'.format(i)
+    if reinitEvents:
+        source += '        return true;\n'
+    source += '    default:\n        return false;\n'
+    source += '    }\n}\n'
+    return source
+
+def getSourceFileEnsembleOutput(class_name, model, varlist, key2name, trans, fname,
+                                assignmentRuleOrderExtraSpec):
+    source = """
+void {0}::update_y_other(void){{
+
+    for (int m = 0; m < _nmember; m++)
+    {{
+        update_member_y_other(m);
+    }}
+    return;
+}}
+""".format(class_name)
+    source += '\nvoid {}::update_member_y_other(int m){{\n\n'.format(class_name)
+    source += getEnsembleMemberBlock('NV_DATA_S(_y)', '', '    ')
+    for i in assignmentRuleOrderExtraSpec:
+        ar = model.getRule(i)
+        source += '    realtype {} = {};\n\n'.format(trans.fname(ar.getVariable()),
+                                                trans.mathToString(ar.getMath()))
+    for i, sid in enumerate(varlist['sp_other']):
+        source += '    //{}\n'.format(fname(sid))
+        source += '    _species_other[m * NR_OTHER + {}] = {};\n\n'.format(i, trans.fname(sid))
+    source += '    return;\n}\n'
+
+    source += '\nstd::string {}::getHeader(){{\n\n'.format(class_name)
+    source += '    std::string s = "";\n'
+    for sid in varlist['sp_var'] + varlist['sp_other']:
+        source += '    s += ",{}";\n'.format(fname(sid))
+    source += '    return s;\n}\n'
+
+    source += """
+double {0}::getMemberVar(int m, unsigned int i) const{{
+
+    if (m < 0 || m >= _nmember || i >= NR_Y + NR_OTHER)
+        throw std::invalid_argument("Accessing ensemble member variable: out of range");
+    return getVarOriginalUnit(i < NR_Y ? m * NR_Y + i : _neq + m * NR_OTHER + i - NR_Y);
+}}
+""".format(class_name)
+
+    source += '\nrealtype {}::get_unit_conversion_species(int i) const{{\n\n'.format(class_name)
+    source += '    static std::vector<realtype> scalor = {\n'
+    source += '        //sp_var\n'
+    for sid in varlist['sp_var']:
+        source += '        {},\n'.format(key2name[sid]['scaling_use'])
+    source += '        //sp_other\n'
+    for sid in varlist['sp_other']:
+        source += '        {},\n'.format(key2name[sid]['scaling_use'])
+    source += '    };\n'
+    if varlist['sp_other']:
+        source += '    return scalor[i < _neq ? i % NR_Y : NR_Y + (i - _neq) % NR_OTHER];\n}\n'
+    else:
+        source += '    return scalor[i % NR_Y];\n}\n'
+
+    source += '\nrealtype {}::get_unit_conversion_nspvar(int i) const{{\n\n'.format(class_name)
+    source += '    static std::vector<realtype> scalor = {\n'
+    for sid in varlist['nsp_var']:
+        source += '        {},\n'.format(key2name[sid]['scaling_use'])
+    source += '    };\n'
+    source += '    return scalor[i % NR_NSPVAR];\n}\n' if varlist['nsp_var'] else '    return 1;\n}\n'
+    return source
+
+def getParamSourceConetent(name_space, model, key2name):
+    n_param = 0
+    paths = []
+    source = """#include "Param.h"
+
+#include <boost/property_tree/xml_parser.hpp>
+#include <boost/interprocess/file_mapping.hpp>
+#include <boost/interprocess/mapped_region.hpp>
+#include <iostream>
+#include <fstream>
+#include <string>
+#include <cstring>
+#include <cstdint>
+#include <math.h>
+
+namespace pt = boost::property_tree;
+namespace bip = boost::interprocess;
+"""
+    source += 'namespace {}'.format(name_space)
+    source += """{
+using std::string;
+using std::vector;
+
+#define PARAM_DESCRIPTION_FIELD_COUNT 3
+const char* _description[][PARAM_DESCRIPTION_FIELD_COUNT] =
+{
+"""
+    source += '    //simulation settings\n'
+    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_START
+    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+    paths.append(path)
+    n_param += 1
+    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_STEP
+    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+    paths.append(path)
+    n_param += 1
+    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_T_NSTEP
+    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+    paths.append(path)
+    n_param += 1
+    path = XML_ROOT + '.' + XML_SIM+ '.' + XML_TOL_REL
+    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+    paths.append(path)
+    n_param += 1
+    path = XML_ROOT+ '.' + XML_SIM+ '.' + XML_TOL_ABS
+    source += '    {{"{}","",""}},//{}\n'.format(path, n_param)
+    paths.append(path)
     n_param += 1
     source += '    //compartments\n'
     for n in range(model.getNumCompartments()):
@@ -2467,6 +5450,7 @@ const char* _description[][PARAM_DESCRIPTION_FIELD_COUNT] =
                 TYPE_TO_STRING[ELEMENT_TYPE_COMPARTMENT] + '.' +\
                 c.getName()
         source += '    {{"{}","",""}},//{}|{}\n'.format(path, n_param, key2name[c.getId()]['init_id'] )
+        paths.append(path)
         n_param += 1
     source += '    //species\n'
     for n in range(model.getNumSpecies()):
@@ -2476,6 +5460,7 @@ const char* _description[][PARAM_DESCRIPTION_FIELD_COUNT] =
                 TYPE_TO_STRING[ELEMENT_TYPE_SPECIES] + '.' +\
                 compartmentName + '_' + s.getName()
         source += '    {{"{}","",""}},//{}|{}\n'.format(path, n_param, key2name[s.getId()]['init_id'] )
+        paths.append(path)
         n_param += 1
     source += '    //parameters\n'
     for n in range(model.getNumParameters()):
@@ -2484,9 +5469,13 @@ const char* _description[][PARAM_DESCRIPTION_FIELD_COUNT] =
                 TYPE_TO_STRING[ELEMENT_TYPE_PARAMETER] + '.' +\
                 p.getName()
         source += '    {{"{}","",""}},//{}|{}\n'.format(path, n_param, key2name[p.getId()]['init_id'] )
+        paths.append(path)
         n_param += 1
-    source += """};
-
+    source += '};\n\n'
+    source += '//binary parameter image (paramBinary.py)\n'
+    source += '#define PARAM_BINARY_MAGIC "{}"\n'.format(pb.PARAM_BINARY_MAGIC.decode())
+    source += '#define PARAM_LAYOUT_HASH {:#x}ULL\n'.format(pb.layout_hash(paths))
+    source += """
 Param::Param()
     :ParamBase()
 {
@@ -2506,6 +5495,723 @@ void Param::setupParam(){
     source +="""
 }
 
+/*! xml parameter file or binary parameter image (paramBinary.py)
+    \\param [in] inFileName: parameter file name.
+*/
+void Param::initializeParams(std::string inFileName){
+
+    if (!isBinaryParamFile(inFileName))
+    {
+        ParamBase::initializeParams(inFileName);
+        return;
+    }
+    if (!readParamsFromBinary(inFileName))
+    {
+        std::cerr << "Error reading paramters, exiting" << std::endl;
+        exit(1);
+    }
+    processInternalParams();
+}
+
+bool Param::isBinaryParamFile(std::string inFileName){
+
+    char magic[sizeof(PARAM_BINARY_MAGIC) - 1] = {0};
+    std::ifstream f(inFileName, std::ios::binary);
+    f.read(magic, sizeof(magic));
+    return f && std::memcmp(magic, PARAM_BINARY_MAGIC, sizeof(magic)) == 0;
+}
+
+/*! header (magic, layout hash, number of values), then float64 values in order of _description
+    \\param [in] inFileName: parameter file name.
+*/
+bool Param::readParamsFromBinary(std::string inFileName){
+
+    struct header{
+        char magic[8];
+        uint64_t hash;
+        uint64_t n;
+    };
+    try{
+        bip::file_mapping file(inFileName.c_str(), bip::read_only);
+        bip::mapped_region region(file, bip::read_only);
+        const char* data = static_cast<const char*>(region.get_address());
+        // only the magic is checked by isBinaryParamFile
+        if (region.get_size() < sizeof(header))
+        {
+            std::cerr << inFileName << ": truncated binary parameter file" << std::endl;
+            return false;
+        }
+        header h;
+        std::memcpy(&h, data, sizeof(header));
+        if (h.hash != PARAM_LAYOUT_HASH || h.n != _paramFloat.size() ||
+            region.get_size() < sizeof(header) + h.n * sizeof(double))
+        {
+            std::cerr << inFileName << ": parameter layout does not match model" << std::endl;
+            return false;
+        }
+        std::memcpy(_paramFloat.data(), data + sizeof(header), h.n * sizeof(double));
+        return true;
+    }
+    catch(std::exception& e){
+        std::cerr << "Error reading " << inFileName << ": " << e.what() << std::endl;
+        return false;
+    }
+}
+
+/*! values in order of _description, as in the binary parameter image
+    \param [in] values: parameter values.
+    \param [in] n: number of values.
+*/
+bool Param::setVals(const double* values, size_t n){
+
+    if (n != _paramFloat.size())
+    {
+        return false;
+    }
+    std::memcpy(_paramFloat.data(), values, n * sizeof(double));
+    processInternalParams();
+    return true;
+}
+
 };
 """
-    return source
\ No newline at end of file
+    return source
+
+"""
+Benchmark driver: mean time of f() and g() on the initial state, wall time and
+solver statistics of full simulations, as one header line and one value line.
+The benchmark itself is qsp_bench_main (QSP_CVODE_Adaptor/QSPBench.h), shared
+with example/cpp/benchmark/QSP_bench.cpp.
+time_scale: simulation time unit per day (times in parameter file are in days)
+rhs: emission mode of f(), 'unrolled' or 'table'
+"""
+def getBenchmarkSourceContent(class_name, name_space, time_scale, rhs = 'unrolled'):
+    source = """/*
+Benchmark of {1}::{0}, generated with the model (see QSPBench.h).
+Usage: <executable> param_file [nr_call] [nr_repeat]
+*/
+
+#include "{0}.h"
+#include "Param.h"
+#include "QSPBench.h"
+
+int main(int argc, char* argv[])
+{{
+    return qsp_bench_main<{1}::{0}, {1}::Param>(argc, argv, {2}, "{3}");
+}}
+"""
+    return source.format(class_name, name_space, time_scale, rhs)
+
+"""
+C interface of {1}::{0} for a shared library (ctypes, see qspLibrary.py).
+One handle per simulation; class parameters are thread-local, so handles
+can be used concurrently from different threads.
+time_scale: simulation time unit per day (times in parameter file are in days)
+nr_class_param: number of class parameters, saved with each handle
+"""
+def getSharedLibrarySourceContent(class_name, name_space, time_scale, nr_class_param):
+    source = """/*
+C interface of {1}::{0}, generated with the model.
+Build: build_{0}_lib.sh; load: qspLibrary.py.
+Parameter values: in order of the parameter file (<class_name>_params.xml), as in
+the binary parameter image (paramBinary.py). Times: days, as in the parameter file.
+Output: columns of the model header (qsp_header), original units.
+All functions return 0 on success.
+*/
+
+#include "{0}.h"
+#include "Param.h"
+
+#include <string>
+#include <vector>
+#include <memory>
+
+#define TIME_SCALE {2}
+#define NR_CLASS_PARAM {3}
+
+namespace {{
+
+struct qsp_handle
+{{
+    {1}::Param param;
+    std::unique_ptr<{1}::{0}> ode;
+    // class parameters after initial assignments
+    std::vector<double> class_param;
+}};
+
+}};
+
+extern "C" {{
+
+void* qsp_create(void)
+{{
+    try{{
+        return new qsp_handle();
+    }}
+    catch (...){{
+        return nullptr;
+    }}
+}}
+
+void qsp_destroy(void* h)
+{{
+    delete static_cast<qsp_handle*>(h);
+}}
+
+//! number of values of a parameter file
+int qsp_nr_param(void)
+{{
+    {1}::Param param;
+    return int(param.getNumVals());
+}}
+
+//! number of output columns
+int qsp_nr_output(void)
+{{
+    {1}::Param param;
+    {1}::{0}::setup_class_parameters(param);
+    {1}::{0} ode;
+    return ode.getNumOutput();
+}}
+
+//! output column names, separated by ","
+const char* qsp_header(void)
+{{
+    static const std::string header = {1}::{0}::getHeader().substr(1);
+    return header.c_str();
+}}
+
+//! set parameter values (nr_param values) and initial state
+int qsp_setup(void* h, const double* values, int n)
+{{
+    auto q = static_cast<qsp_handle*>(h);
+    try{{
+        if (!q->param.setVals(values, n))
+        {{
+            return 1;
+        }}
+        {1}::{0}::setup_class_parameters(q->param);
+        q->ode.reset(new {1}::{0}());
+        q->ode->setup_instance_tolerance(q->param);
+        q->ode->setup_instance_varaibles(q->param);
+        q->ode->eval_init_assignment();
+        q->class_param.resize(NR_CLASS_PARAM);
+        for (int i = 0; i < NR_CLASS_PARAM; i++)
+        {{
+            q->class_param[i] = {1}::{0}::get_class_param(i);
+        }}
+    }}
+    catch (...){{
+        return 2;
+    }}
+    return 0;
+}}
+
+/*! simulate from t[0] to t[nt-1] (days, increasing); out: nt x nr_output, row major.
+    Row 0 is the state after qsp_setup.
+*/
+int qsp_simulate(void* h, const double* t, int nt, double* out)
+{{
+    auto q = static_cast<qsp_handle*>(h);
+    if (!q->ode)
+    {{
+        return 1;
+    }}
+    try{{
+        // class parameters of this handle in the calling thread
+        for (int i = 0; i < NR_CLASS_PARAM; i++)
+        {{
+            {1}::{0}::set_class_param(i, q->class_param[i]);
+        }}
+        int nrOutput = q->ode->getNumOutput();
+        q->ode->getOutput(out);
+        for (int k = 1; k < nt; k++)
+        {{
+            q->ode->simOdeStep(t[k-1] * TIME_SCALE, (t[k] - t[k-1]) * TIME_SCALE);
+            q->ode->getOutput(out + k * nrOutput);
+        }}
+    }}
+    catch (...){{
+        return 2;
+    }}
+    return 0;
+}}
+
+}};
+"""
+    return source.format(class_name, name_space, time_scale, nr_class_param)
+
+"""
+Build script of the shared library lib<class_name>.so: model, Param, C interface
+and the CVODE adaptor. Paths of boost and sundials from environment variables.
+"""
+# sources: model source files, [<class_name>.cpp] if empty (split source: getSplitSourceFiles)
+def getSharedLibraryBuildScript(class_name, adaptor_dir, sources = ()):
+    script = """#!/bin/bash
+# build lib{0}.so from {0}.cpp, Param.cpp and {0}_capi.cpp; see qspLibrary.py
+# environment: ADAPTOR_DIR, BOOST_DIR, SUNDIALS_DIR, CXX, CXXFLAGS; USE_KLU=1 for sparse Jacobian
+set -e
+cd "$(dirname "$0")"
+
+ADAPTOR_DIR=${{ADAPTOR_DIR:-{1}}}
+BOOST_DIR=${{BOOST_DIR:-$HOME/lib/boost_1_70_0}}
+SUNDIALS_DIR=${{SUNDIALS_DIR:-$HOME/lib/sundials-4.0.1}}
+CXX=${{CXX:-g++}}
+CXXFLAGS=${{CXXFLAGS:--w -std=c++11 -O3 -DNDEBUG}}
+
+LIBS="-lsundials_cvode -lsundials_nvecserial -lboost_serialization"
+if [ "$USE_KLU" = "1" ]; then
+    CXXFLAGS="$CXXFLAGS -DQSP_USE_KLU"
+    LIBS="$LIBS -lsundials_sunlinsolklu -lklu -lamd -lcolamd -lbtf -lsuitesparseconfig"
+fi
+
+$CXX $CXXFLAGS -fPIC -shared -o lib{0}.so \\
+    -I. -I"$ADAPTOR_DIR" -I"$BOOST_DIR/include" -I"$SUNDIALS_DIR/include" \\
+    {2} Param.cpp {0}_capi.cpp "$ADAPTOR_DIR/CVODEBase.cpp" "$ADAPTOR_DIR/ParamBase.cpp" \\
+    -L"$BOOST_DIR/lib" -L"$SUNDIALS_DIR/lib" $LIBS \\
+    -Wl,-rpath,"$BOOST_DIR/lib" -Wl,-rpath,"$SUNDIALS_DIR/lib"
+"""
+    return script.format(class_name, adaptor_dir, ' '.join(sources) if sources else class_name + '.cpp')
+
+"""
+Multi-sample driver: parameter matrix (paramBinary.py), samples distributed over a
+pool of threads, one model instance per thread reused from sample to sample
+(CVODEBase::resetSimulation). Requires thread-local class parameters.
+time_scale: simulation time unit per day (times in parameter file are in days)
+time_unit: name of simulation time unit, for the sidecar of binary output
+"""
+def getMultiSampleSourceContent(class_name, name_space, time_scale, time_unit):
+    source = """/*
+Multi-sample driver of {1}::{0}, generated with the model.
+Input: parameter matrix (csv), a header line with one column per value of the parameter
+file, then one row per sample (python paramBinary.py template.xml param_*.xml params.csv).
+Samples are distributed over a pool of threads. Each thread keeps one model instance and
+reuses its solver memory (CVodeReInit) from sample to sample.
+Output: one csv file, "sample,t,<species>", the rows of each sample as written by QSP_vct,
+samples in order of the matrix. Binary output (-b): the same rows as float64 frames (.bin),
+with column names and units in a json sidecar (.json); see outputBinary.py.
+*/
+
+#include "{0}.h"
+#include "Param.h"
+
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <string>
+#include <vector>
+#include <thread>
+#include <mutex>
+#include <atomic>
+#include <chrono>
+#include <algorithm> // min
+
+#include <boost/program_options.hpp>
+#include <boost/filesystem.hpp>
+
+#define TIME_SCALE {2}
+#define TIME_UNIT "{3}"
+
+namespace po = boost::program_options;
+typedef {1}::{0} ODE;
+using {1}::Param;
+
+// quoted json string
+std::string json_string(const std::string& s)
+{{
+    std::string q = "\\"";
+    for (char c : s)
+    {{
+        if (c == '"' || c == '\\\\')
+        {{
+            q += '\\\\';
+        }}
+        q += c;
+    }}
+    return q + "\\"";
+}}
+
+// sidecar of binary output: frame file name, value type, column names and units
+bool write_sidecar(const std::string& filename, const std::string& frameFile)
+{{
+    std::vector<std::string> columns = {{"sample", "t"}};
+    std::vector<std::string> units = {{"", TIME_UNIT}};
+    std::stringstream ss(ODE::getHeader());
+    std::string name;
+    while (std::getline(ss, name, ','))
+    {{
+        if (!name.empty())
+        {{
+            columns.push_back(name);
+        }}
+    }}
+    std::vector<std::string> u = ODE::getHeaderUnits();
+    units.insert(units.end(), u.begin(), u.end());
+    uint16_t one = 1;
+    bool little_endian = *reinterpret_cast<char*>(&one) == 1;
+
+    std::ofstream f(filename, std::ios::trunc);
+    f << "{{\\n    \\"frames\\": " << json_string(frameFile) << ",\\n";
+    f << "    \\"dtype\\": \\"" << (little_endian ? "<f8" : ">f8") << "\\",\\n";
+    f << "    \\"columns\\": [";
+    for (size_t i = 0; i < columns.size(); i++)
+    {{
+        f << (i ? ", " : "") << json_string(columns[i]);
+    }}
+    f << "],\\n    \\"units\\": [";
+    for (size_t i = 0; i < units.size(); i++)
+    {{
+        f << (i ? ", " : "") << json_string(units[i]);
+    }}
+    f << "]\\n}}\\n";
+    return bool(f);
+}}
+
+// one output row: csv line, or frame of float64 values (binary output)
+void write_row(std::ostream& os, const ODE& ode, int k, double t, bool binary)
+{{
+    if (binary)
+    {{
+        std::vector<double> frame(ode.getNumOutput() + 2);
+        frame[0] = k;
+        frame[1] = t;
+        ode.getOutput(frame.data() + 2);
+        os.write(reinterpret_cast<const char*>(frame.data()), frame.size() * sizeof(double));
+    }}
+    else
+    {{
+        os << k << "," << t << ode << std::endl;
+    }}
+}}
+
+// rows of the parameter matrix; false if a row does not match the header
+bool read_matrix(const std::string& filename, std::vector<std::vector<double> >& rows, size_t& nrCol)
+{{
+    std::ifstream f(filename);
+    std::string line;
+    if (!std::getline(f, line))
+    {{
+        return false;
+    }}
+    nrCol = std::count(line.begin(), line.end(), ',') + 1;
+    while (std::getline(f, line))
+    {{
+        if (line.empty())
+        {{
+            continue;
+        }}
+        std::vector<double> row;
+        std::stringstream ss(line);
+        std::string v;
+        while (std::getline(ss, v, ','))
+        {{
+            row.push_back(std::stod(v));
+        }}
+        if (row.size() != nrCol)
+        {{
+            return false;
+        }}
+        rows.push_back(row);
+    }}
+    return true;
+}}
+
+// one sample on the model instance of this thread
+bool simulate_sample(ODE& ode, Param& param, const std::vector<double>& values, int k,
+                     bool binary, std::string& out)
+{{
+    if (!param.setVals(values.data(), values.size()))
+    {{
+        return false;
+    }}
+    ODE::setup_class_parameters(param);
+    ode.resetSimulation();
+    ode.setup_instance_tolerance(param);
+    ode.setup_instance_varaibles(param);
+    ode.eval_init_assignment();
+
+    double t_start = param.getVal(0) * TIME_SCALE;
+    double t_step = param.getVal(1) * TIME_SCALE;
+    int nrStep = int(param.getVal(2));
+    auto t_end = t_start + t_step * nrStep;
+
+    std::ostringstream os;
+    write_row(os, ode, k, t_start, binary);
+
+    // write every n-th output time, and the last one
+    int stride = ode.getOutputStride();
+    int step = 0;
+    while (t_start < t_end)
+    {{
+        double t_step_sim = std::min(t_end - t_start, t_step);
+        ode.simOdeStep(t_start, t_step_sim);
+        t_start += t_step_sim;
+        step++;
+        if (step % stride == 0 || t_start >= t_end)
+        {{
+            write_row(os, ode, k, t_start, binary);
+        }}
+    }}
+    out = os.str();
+    return true;
+}}
+
+int main(int argc, char* argv[])
+{{
+    std::string _inputParam;
+    std::string _outPath;
+    std::string _outfile;
+    int _nrThread;
+    bool _binary = false;
+    // command line options
+    try {{
+        po::options_description desc("Allowed options");
+        desc.add_options()
+            ("help,h", "produce help message")
+            ("input-file,i", po::value<std::string>(&_inputParam), "parameter matrix file name (csv)")
+            ("output-path,o", po::value<std::string>(&_outPath)->default_value("output"), "output file path")
+            ("output-file-name,n", po::value<std::string>(&_outfile)->default_value("solution.csv"), "output file name")
+            ("threads,t", po::value<int>(&_nrThread)->default_value(std::thread::hardware_concurrency()), "number of threads")
+            ("binary,b", po::bool_switch(&_binary), "binary output: float64 frames (.bin), column names and units (.json)")
+            ;
+        po::variables_map vm;
+        po::store(po::parse_command_line(argc, argv, desc), vm);
+        po::notify(vm);
+
+        if (vm.count("help")) {{
+            std::cout << desc << "\\n";
+            return 0;
+        }}
+
+        if (!vm.count("input-file"))
+        {{
+            std::cout << desc << "\\n";
+            std::cerr << "no input file specified!\\n";
+            return 1;
+        }}
+
+    }}catch (std::exception& e) {{
+        std::cerr << "error: " << e.what() << "\\n";
+        return 1;
+    }}
+
+    std::vector<std::vector<double> > samples;
+    size_t nrCol = 0;
+    if (!read_matrix(_inputParam, samples, nrCol) || nrCol != Param().getNumVals())
+    {{
+        std::cerr << _inputParam << ": parameter matrix does not match model ("
+            << Param().getNumVals() << " values per sample)" << std::endl;
+        return 1;
+    }}
+    int nrSample = samples.size();
+    _nrThread = std::max(1, std::min(_nrThread, nrSample));
+
+    // output directory
+    boost::filesystem::path pOut(_outPath);
+    boost::filesystem::create_directories(pOut);// create output directory
+    std::ofstream f;
+    if (_binary)
+    {{
+        boost::filesystem::path frameFile = boost::filesystem::path(_outfile).replace_extension(".bin");
+        boost::filesystem::path sidecar = pOut / boost::filesystem::path(_outfile).replace_extension(".json");
+        if (!write_sidecar(sidecar.string(), frameFile.filename().string()))
+        {{
+            std::cerr << "Cannot write " << sidecar.string() << std::endl;
+            return 1;
+        }}
+        f.open((pOut / frameFile).string(), std::ios::trunc | std::ios::binary);
+    }}
+    else
+    {{
+        f.open(_outPath + "/" + _outfile, std::ios::trunc);
+        f << "sample,t" << ODE::getHeader() << std::endl;
+    }}
+
+    // output of each sample, written in order as soon as all previous samples are done
+    std::vector<std::string> slots(nrSample);
+    std::vector<bool> done(nrSample, false);
+    int nextWrite = 0;
+    int nrFailed = 0;
+    std::mutex lock;
+    std::atomic<int> nextSample(0);
+
+    auto worker = [&]()
+    {{
+        Param param;
+        ODE ode;
+        for (int k = nextSample++; k < nrSample; k = nextSample++)
+        {{
+            std::string out;
+            bool success = false;
+            try{{
+                success = simulate_sample(ode, param, samples[k], k, _binary, out);
+            }}
+            catch (std::string s){{
+                std::cerr << s << std::endl;
+            }}
+            catch (std::exception& e){{
+                std::cerr << e.what() << std::endl;
+            }}
+            catch (...){{
+            }}
+            std::lock_guard<std::mutex> guard(lock);
+            if (!success)
+            {{
+                std::cerr << "sample " << k << " failed" << std::endl;
+                nrFailed++;
+                out.clear();
+            }}
+            slots[k].swap(out);
+            done[k] = true;
+            for (; nextWrite < nrSample && done[nextWrite]; nextWrite++)
+            {{
+                f << slots[nextWrite];
+                std::string().swap(slots[nextWrite]);
+            }}
+        }}
+    }};
+
+    auto tic = std::chrono::steady_clock::now();
+    std::vector<std::thread> threads;
+    for (int i = 0; i < _nrThread; i++)
+    {{
+        threads.emplace_back(worker);
+    }}
+    for (auto& t : threads)
+    {{
+        t.join();
+    }}
+    f.close();
+    std::cout << nrSample << " samples, " << nrFailed << " failed, " << _nrThread << " threads, "
+        << std::chrono::duration<double>(std::chrono::steady_clock::now() - tic).count() << " s" << std::endl;
+
+    return nrFailed ? 1 : 0;
+}}
+"""
+    return source.format(class_name, name_space, time_scale, time_unit)
+
+"""
+Python module with the rhs vectorized over samples (NumPy):
+f(t, Y, P), Y: (n_samples, NEQ) species in y, P: (n_samples, NR_PARAM + NR_NSPVAR)
+class parameters followed by non-species variables, in units used in simulation.
+init(V) sets up Y and P from values of parameter files (V: (n_samples, n_values),
+order of paramBinary), including initial assignments. Events are not handled.
+arGraph: if given, also jac(t, Y, P), the analytic Jacobian (n_samples, NEQ, NEQ)
+"""
+def getNumpyModuleContent(model, assignmentRuleOrder, assignmentRuleOrderIA, initialAssignmentOrder,
+                          speciesStoichiometry, convert_unit, key2var, key2name, varlist, fname,
+                          simplifier = None, arGraph = None):
+    nrParam = len(varlist['p_const'])
+    column = {'sp_var': 'Y[:, {}]', 'p_const': 'P[:, {}]'}
+    def npVariable(varName):
+        if varName == LC_TIME_NAME:
+            return ODE_TIME_NAME
+        elif varName in key2var:
+            e = key2var[varName]
+            if e['vartype'] == 'nsp_var':
+                return 'P[:, {}]'.format(nrParam + e['idx'])
+            return column[e['vartype']].format(e['idx'])
+        else:
+            return 'AUX_VAR_{}'.format(key2name[varName]['name'])
+    trans = AstTranslatorNumpy(npVariable)
+    simplify = simplifier.simplify if simplifier else (lambda m: m)
+    names = lambda keys: ''.join('    {!r},\n'.format(fname(k)) for k in keys)
+    initId = lambda keys: ', '.join(str(key2name[k]['init_id']) for k in keys)
+    scaling = lambda keys: ', '.join(str(key2name[k]['scaling_use']) for k in keys)
+    pKeys = varlist['p_const'] + varlist['nsp_var']
+
+    source = '''"""
+Vectorized rhs of SBML model {0}, generated by libsbmlCvode.
+
+Y: (n_samples, NEQ), species in y
+P: (n_samples, NR_PARAM + NR_NSPVAR), class parameters followed by non-species variables
+All values in units used in simulation. Events are not handled.
+"""
+
+import numpy as np
+
+NEQ = {1}
+NR_PARAM = {2}
+NR_NSPVAR = {3}
+
+'''.format(model.getId(), len(varlist['sp_var']), nrParam, len(varlist['nsp_var']))
+    source += 'SPECIES = [\n{}]\n\n'.format(names(varlist['sp_var']))
+    source += 'PARAMETERS = [\n{}]\n\n'.format(names(pKeys))
+    source += '# position in parameter file (paramBinary order) and unit conversion\n'
+    source += 'Y_INIT_ID = np.array([{}], dtype=int)\n'.format(initId(varlist['sp_var']))
+    source += 'Y_SCALING = np.array([{}])\n'.format(scaling(varlist['sp_var']))
+    source += 'P_INIT_ID = np.array([{}], dtype=int)\n'.format(initId(pKeys))
+    source += 'P_SCALING = np.array([{}])\n'.format(scaling(pKeys))
+
+    # initial assignments
+    source += '''
+def init(V, t = 0.0):
+    """Y, P from parameter file values V (n_samples, n_values), with initial assignments"""
+    V = np.atleast_2d(V)
+    Y = V[:, Y_INIT_ID] * Y_SCALING
+    P = V[:, P_INIT_ID] * P_SCALING
+    #Assignment rules required before IA
+'''
+    for i in assignmentRuleOrderIA:
+        ar = model.getRule(i)
+        source += '    {} = {}\n'.format(trans.fname(ar.getVariable()), trans.mathToString(simplify(ar.getMath())))
+    source += '    #InitialAssignment\n'
+    for i in initialAssignmentOrder:
+        ia = model.getInitialAssignment(i)
+        sid = ia.getSymbol()
+        if sid in key2var:
+            source += '    {} = {}\n'.format(trans.fname(sid), trans.mathToString(simplify(ia.getMath())))
+    source += '    return Y, P\n'
+
+    # rhs
+    source += '''
+def f(t, Y, P):
+    """dY/dt, (n_samples, NEQ)"""
+    #Assignment rules:
+'''
+    for i in assignmentRuleOrder:
+        ar = model.getRule(i)
+        source += '    {} = {}\n'.format(trans.fname(ar.getVariable()), trans.mathToString(simplify(ar.getMath())))
+    source += '    #Reaction fluxes:\n'
+    for i in range(model.getNumReactions()):
+        source += '    ReactionFlux{} = {}\n'.format(i+1, getReactionFluxString(model, i, convert_unit, (), trans,
+                                                      simplify(model.getReaction(i).getKineticLaw().getMath())))
+    source += '    #dydt:\n'
+    source += '    dY = np.zeros(Y.shape)\n'
+    for sp in model.getListOfSpecies():
+        sid = sp.getId()
+        if sid in speciesStoichiometry and sid in key2var:
+            source += '    #d({})/dt\n'.format(fname(sid))
+            source += '    dY[:, {}] = {}\n'.format(key2var[sid]['idx'], 
+                getSpeciesRateString(sp, speciesStoichiometry, convert_unit, trans,
+                                     lambda r: 'ReactionFlux{}'.format(r+1)))
+    source += '    return dY\n'
+
+    source += '''
+def f_ivp(t, y, P):
+    """f for flat y (n_samples * NEQ), e.g. for scipy.integrate.solve_ivp"""
+    return f(t, y.reshape(P.shape[0], NEQ), P).ravel()
+'''
+    if arGraph is None:
+        return source
+
+    # analytic Jacobian: statements of the C++ Jac() (getJacobianComponents)
+    v, entries, sensEntries = getJacobianComponents(model, assignmentRuleOrder, arGraph, speciesStoichiometry,
+                                                    convert_unit, key2var, (), trans, fname)
+    source += '''
+def jac(t, Y, P):
+    """d(dY/dt)/dY, (n_samples, NEQ, NEQ)"""
+'''
+    for line in v.splitlines():
+        line = line.strip()
+        if line.startswith('//'):
+            source += '    #{}\n'.format(line[2:])
+        elif line.startswith('realtype '):
+            source += '    {}\n'.format(line[len('realtype '):].rstrip(';'))
+    source += '    #Jacobian:\n'
+    source += '    J = np.zeros((Y.shape[0], NEQ, NEQ))\n'
+    for (i, j, e, desc) in entries:
+        source += '    #{}\n'.format(desc)
+        source += '    J[:, {}, {}] = {}\n'.format(i, j, e)
+    source += '    return J\n'
+    return source
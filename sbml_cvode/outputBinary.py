@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Read binary output of the generated multi-sample driver (<class_name>_multi.cpp, -b).
+
+The output is a pair of files with the same name:
+1. <name>.json: sidecar, with
+   frames: name of the frame file, in the same folder
+   dtype: value type of the frames, "<f8" (float64, little endian) or ">f8"
+   columns: column names, "sample", "t", then the output species (getHeader)
+   units: unit of each column, simulation time unit for "t", original (SBML) units
+          for species ("" if dimensionless or not defined)
+2. <name>.bin: frames, one row of len(columns) values per output time, no header.
+   The number of rows follows from the file size, so a file that is still being
+   written can be read; an incomplete last row is left out.
+
+Frames are memory-mapped, not read: only the parts used are loaded.
+
+### Usage
+
+frames, columns, units = read_output('out/solution.json')
+t = frames[frames[:, 0] == 0, 1]  # times of sample 0
+python outputBinary.py out/solution.json out/solution.csv
+'''
+
+import os
+import sys
+import json
+import numpy as np
+
+# sidecar content; filename: sidecar (.json) or frame file (.bin)
+def read_sidecar(filename):
+    sidecar = os.path.splitext(filename)[0] + '.json'
+    with open(sidecar) as f:
+        info = json.load(f)
+    if len(info['columns']) != len(info['units']):
+        raise ValueError('{}: {} columns, {} units.'.format(sidecar, len(info['columns']), len(info['units'])))
+    info['frames'] = os.path.join(os.path.dirname(sidecar), info['frames'])
+    return info
+
+# frames (n_rows, n_columns, read-only memory map), column names, units
+def read_output(filename):
+    info = read_sidecar(filename)
+    columns = info['columns']
+    dtype = np.dtype(info['dtype'])
+    nr_row = os.path.getsize(info['frames']) // (dtype.itemsize * len(columns))
+    if nr_row == 0:
+        frames = np.zeros((0, len(columns)), dtype = dtype)
+    else:
+        frames = np.memmap(info['frames'], dtype = dtype, mode = 'r', shape = (nr_row, len(columns)))
+    return frames, columns, info['units']
+
+# csv file as written by the driver without -b
+def output_to_csv(filename, csv_file):
+    frames, columns, units = read_output(filename)
+    with open(csv_file, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for row in frames:
+            f.write('{:d},'.format(int(row[0])) + ','.join(repr(float(v)) for v in row[1:]) + '\n')
+    return
+
+if (__name__ == '__main__'):
+
+    if len(sys.argv) != 3:
+        print('Usage:')
+        print('python outputBinary.py solution.json solution.csv')
+        exit(1)
+
+    output_to_csv(sys.argv[1], sys.argv[2])
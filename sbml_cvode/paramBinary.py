@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Convert parameter files between xml and the flat binary parameter image.
+
+The xml parameter file remains the source of truth. The binary image is a copy
+of its values which the generated Param class maps into memory without parsing.
+
+### Format (native byte order, little endian on all supported platforms)
+
+1. magic: 8 bytes, "QSPPARAM"
+2. layout hash: uint64, FNV-1a hash of the parameter paths (see layout_hash)
+3. number of values: uint64
+4. values: float64, in order of the leaf elements of the template parameter file
+   (init_id order, same as _description in the generated Param.cpp)
+
+The template is the parameter file exported with the model (<class_name>_params.xml),
+which defines the paths and their order.
+
+### Parameter matrix
+
+Input of the generated multi-sample driver (<class_name>_multi.cpp): csv with the paths
+as header line, then the values of one parameter file per row, in the same order.
+
+### Usage
+
+python paramBinary.py template.xml param.xml param.bin
+python paramBinary.py template.xml param.bin param.xml
+python paramBinary.py template.xml param_1.xml [param_2.xml ...] params.csv
+'''
+
+import sys
+import struct
+import numpy as np
+import lxml.etree as ET
+
+PARAM_BINARY_MAGIC = b'QSPPARAM'
+PARAM_BINARY_HEADER = struct.Struct('<8sQQ')
+
+FNV_OFFSET_BASIS = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+
+# paths of leaf elements in document order, in the format of "QSP.simulation.start"
+def get_layout(root):
+    paths = []
+    for e in root.iter():
+        if len(e):
+            continue
+        paths.append('.'.join([a.tag for a in reversed(list(e.iterancestors()))] + [e.tag]))
+    return paths
+
+# FNV-1a (64 bit) of paths joined by newline
+def layout_hash(paths):
+    h = FNV_OFFSET_BASIS
+    for b in '\n'.join(paths).encode('utf-8'):
+        h = ((h ^ b) * FNV_PRIME) & 0xffffffffffffffff
+    return h
+
+def write_binary(filename, paths, values):
+    if len(paths) != len(values):
+        raise ValueError('Binary parameter file: {} values for {} paths.'.format(len(values), len(paths)))
+    with open(filename, 'wb') as f:
+        f.write(PARAM_BINARY_HEADER.pack(PARAM_BINARY_MAGIC, layout_hash(paths), len(paths)))
+        f.write(np.asarray(values, dtype='<f8').tobytes())
+    return
+
+def read_binary(filename, paths):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, h, n = PARAM_BINARY_HEADER.unpack_from(data)
+    if magic != PARAM_BINARY_MAGIC:
+        raise ValueError('{}: not a binary parameter file.'.format(filename))
+    if h != layout_hash(paths) or n != len(paths):
+        raise ValueError('{}: parameter layout does not match template.'.format(filename))
+    return np.frombuffer(data, dtype='<f8', count=n, offset=PARAM_BINARY_HEADER.size)
+
+# values of xml parameter file, in order of template paths
+def xml_to_values(root, paths):
+    values = []
+    for path in paths:
+        e = root.find('/'.join(path.split('.')[1:]))
+        if e is None:
+            raise ValueError('Parameter file: {} not found.'.format(path))
+        values.append(float(e.text))
+    return values
+
+def xml_to_binary(template_file, xml_file, bin_file):
+    paths = get_layout(ET.parse(template_file).getroot())
+    write_binary(bin_file, paths, xml_to_values(ET.parse(xml_file).getroot(), paths))
+    return
+
+def write_matrix(filename, paths, rows):
+    with open(filename, 'w') as f:
+        f.write(','.join(paths) + '\n')
+        for values in rows:
+            if len(values) != len(paths):
+                raise ValueError('Parameter matrix: {} values for {} paths.'.format(len(values), len(paths)))
+            f.write(','.join(repr(float(v)) for v in values) + '\n')
+    return
+
+def xml_to_matrix(template_file, xml_files, csv_file):
+    paths = get_layout(ET.parse(template_file).getroot())
+    write_matrix(csv_file, paths, [xml_to_values(ET.parse(x).getroot(), paths) for x in xml_files])
+    return
+
+def binary_to_xml(template_file, bin_file, xml_file):
+    root = ET.parse(template_file).getroot()
+    paths = get_layout(root)
+    values = read_binary(bin_file, paths)
+    for path, v in zip(paths, values):
+        root.find('/'.join(path.split('.')[1:])).text = repr(float(v))
+    with open(xml_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write(ET.tostring(root, pretty_print = True, encoding='unicode'))
+    return
+
+if (__name__ == '__main__'):
+
+    if len(sys.argv) < 4:
+        print('Usage:')
+        print('python paramBinary.py template.xml param.xml param.bin')
+        print('python paramBinary.py template.xml param.bin param.xml')
+        print('python paramBinary.py template.xml param_1.xml [param_2.xml ...] params.csv')
+        exit(1)
+
+    template_file, in_file, out_file = sys.argv[1], sys.argv[2], sys.argv[-1]
+    if out_file.endswith('.csv'):
+        xml_to_matrix(template_file, sys.argv[2:-1], out_file)
+    elif in_file.endswith('.bin'):
+        binary_to_xml(template_file, in_file, out_file)
+    else:
+        xml_to_binary(template_file, in_file, out_file)
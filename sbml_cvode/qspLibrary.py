@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''
+Load a model exported as shared library (use_shared_library, build_<class_name>_lib.sh)
+and simulate parameter sets in process.
+
+Parameter values are in order of the exported parameter file (paramBinary.get_layout),
+times in days. Each sample is set up and simulated on its own handle; class parameters
+are thread-local in the library, and ctypes releases the GIL during the calls, so
+samples of a batch run in parallel threads.
+
+### Usage
+
+lib = QSPLibrary('libODE_system.so')
+V = np.tile(paramBinary.xml_to_values(root, paramBinary.get_layout(root)), (100, 1))
+out, status = lib.simulate_batch(V, np.linspace(0, 10, 101), nr_thread = 8)
+# out: (n_samples, len(t), lib.nr_output); status: 0 where successful
+'''
+
+import ctypes
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+_double_p = ctypes.POINTER(ctypes.c_double)
+
+class QSPLibrary:
+    def __init__(self, path):
+        lib = ctypes.CDLL(path)
+        lib.qsp_create.restype = ctypes.c_void_p
+        lib.qsp_create.argtypes = []
+        lib.qsp_destroy.restype = None
+        lib.qsp_destroy.argtypes = [ctypes.c_void_p]
+        lib.qsp_nr_param.restype = ctypes.c_int
+        lib.qsp_nr_output.restype = ctypes.c_int
+        lib.qsp_header.restype = ctypes.c_char_p
+        lib.qsp_setup.restype = ctypes.c_int
+        lib.qsp_setup.argtypes = [ctypes.c_void_p, _double_p, ctypes.c_int]
+        lib.qsp_simulate.restype = ctypes.c_int
+        lib.qsp_simulate.argtypes = [ctypes.c_void_p, _double_p, ctypes.c_int, _double_p]
+        self.lib = lib
+        self.nr_param = lib.qsp_nr_param()
+        self.nr_output = lib.qsp_nr_output()
+        self.header = lib.qsp_header().decode().split(',')
+        return
+
+    # one sample into out (len(t), nr_output); returns status
+    def _run(self, values, t, out):
+        h = self.lib.qsp_create()
+        if not h:
+            return -1
+        try:
+            status = self.lib.qsp_setup(h, values.ctypes.data_as(_double_p), len(values))
+            if status == 0:
+                status = self.lib.qsp_simulate(h, t.ctypes.data_as(_double_p), len(t),
+                                               out.ctypes.data_as(_double_p))
+        finally:
+            self.lib.qsp_destroy(h)
+        return status
+
+    def _check_input(self, t, nr_value):
+        t = np.ascontiguousarray(t, dtype=np.float64)
+        if t.ndim != 1 or len(t) == 0 or np.any(np.diff(t) <= 0):
+            raise ValueError('Time points must be a non-empty increasing sequence.')
+        if nr_value != self.nr_param:
+            raise ValueError('{} parameter values, model has {}.'.format(nr_value, self.nr_param))
+        return t
+
+    # values: nr_param values; returns (len(t), nr_output)
+    def simulate(self, values, t):
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        t = self._check_input(t, len(values))
+        out = np.zeros((len(t), self.nr_output))
+        status = self._run(values, t, out)
+        if status:
+            raise RuntimeError('Simulation failed, status {}.'.format(status))
+        return out
+
+    # V: (n_samples, nr_param); returns (n_samples, len(t), nr_output), status (n_samples,)
+    # results of failed samples (status != 0) are not defined
+    def simulate_batch(self, V, t, nr_thread = 1):
+        V = np.ascontiguousarray(V, dtype=np.float64)
+        t = self._check_input(t, V.shape[1])
+        out = np.zeros((V.shape[0], len(t), self.nr_output))
+        status = np.zeros(V.shape[0], dtype=int)
+        def task(k):
+            status[k] = self._run(V[k], t, out[k])
+        with ThreadPoolExecutor(max_workers = nr_thread) as executor:
+            list(executor.map(task, range(V.shape[0])))
+        return out, status